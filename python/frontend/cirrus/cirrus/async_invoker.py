@@ -0,0 +1,136 @@
+""" Invoke preprocessing Lambdas from a bounded thread pool.
+
+One coordinating thread submits the invocations to a pool of at most
+max_concurrency threads, and schedules the retries of throttled ones
+itself, so a call waiting to be retried holds no thread of the pool. """
+
+import heapq
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import boto3
+from botocore.config import Config
+from cirrus.lambda_thread import LambdaExecutor, LAMBDA_NAME, \
+    LAMBDA_READ_TIMEOUT, parse_lambda_response, with_nonce
+from cirrus.utilities import jitter
+from cirrus.utils import ChunkResult
+
+MAX_CONCURRENCY = 1000
+
+# The errors after which an invocation is retried. These are the error codes
+# of ClientErrors, or the names of other exception classes.
+RETRY_ERRORS = ("TooManyRequestsException", "ServiceException",
+                "EC2ThrottledException", "ThrottlingException")
+
+
+def error_name(exc):
+    """ Get the error code of a ClientError, or the class name of any other
+    exception. """
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict) and "Code" in response.get("Error", {}):
+        return response["Error"]["Code"]
+    return type(exc).__name__
+
+
+class AsyncInvoker(object):
+    """ Run a function on many payloads, with at most max_concurrency calls
+    in flight.
+
+    Calls that raise one of retry_errors are retried with a jittered
+    exponential backoff, as in utilities.jittery_exponential_backoff. The
+    wait does not count against the concurrency limit. """
+
+    def __init__(self, invoke, max_concurrency=MAX_CONCURRENCY,
+                 retry_errors=RETRY_ERRORS, initial_wait=0.1,
+                 wait_multiplier=2, max_retries=8):
+        assert max_concurrency > 0
+        assert initial_wait > 0
+        assert wait_multiplier > 0
+        self.invoke = invoke
+        self.max_concurrency = max_concurrency
+        self.retry_errors = set(retry_errors)
+        self.initial_wait = initial_wait
+        self.wait_multiplier = wait_multiplier
+        self.max_retries = max_retries
+
+    def run(self, keys, payloads):
+        """ Invoke every payload and wait for all of them. Returns a
+        ChunkResult for each key, in order. """
+        keys = list(keys)
+        payloads = list(payloads)
+        results = [None] * len(payloads)
+        retries = [0] * len(payloads)
+        # (time at which the call can start, index of the payload)
+        ready = [(0.0, idx) for idx in range(len(payloads))]
+        running = {}
+        pool = ThreadPoolExecutor(min(self.max_concurrency,
+                                      max(1, len(payloads))))
+        try:
+            while ready or running:
+                now = time.time()
+                while ready and ready[0][0] <= now and \
+                        len(running) < self.max_concurrency:
+                    _, idx = heapq.heappop(ready)
+                    running[pool.submit(self.invoke, payloads[idx])] = idx
+                timeout = None
+                if ready and len(running) < self.max_concurrency:
+                    timeout = max(0.0, ready[0][0] - now)
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(list(running), timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx = running.pop(future)
+                    exc = future.exception()
+                    if exc is None:
+                        results[idx] = ChunkResult(keys[idx], future.result(),
+                                                   None)
+                    elif error_name(exc) in self.retry_errors and \
+                            retries[idx] < self.max_retries:
+                        backoff = self.initial_wait * \
+                            self.wait_multiplier ** retries[idx]
+                        retries[idx] += 1
+                        heapq.heappush(ready,
+                                       (time.time() + jitter(backoff), idx))
+                    else:
+                        results[idx] = ChunkResult(keys[idx], None, exc)
+        finally:
+            pool.shutdown()
+        return results
+
+
+class AsyncLambdaExecutor(LambdaExecutor):
+    """ Invoke the preprocessing Lambda function on AWS, keeping every
+    invocation of a launch_threads call in flight from an AsyncInvoker.
+
+    endpoint_url can point the client at a local stand-in for the Lambda
+    API. """
+
+    def __init__(self, function_name=LAMBDA_NAME, endpoint_url=None,
+                 **invoker_args):
+        LambdaExecutor.__init__(self, function_name)
+        self.endpoint_url = endpoint_url
+        self.invoker_args = invoker_args
+
+    def invoke_all(self, keys, payloads, max_concurrency):
+        # Throttled calls are retried by the invoker, not by botocore
+        config = Config(max_pool_connections=max_concurrency,
+                        read_timeout=LAMBDA_READ_TIMEOUT, retries={
+                            "max_attempts": 0})
+        l_client = boto3.client("lambda", endpoint_url=self.endpoint_url,
+                                config=config)
+
+        def invoke(payload):
+            """ Invoke the Lambda on one payload """
+            payload = with_nonce(payload)
+            response = l_client.invoke(
+                FunctionName=self.function_name,
+                InvocationType="RequestResponse",
+                Payload=json.dumps(payload))
+            return parse_lambda_response(payload, response,
+                                         response["Payload"].read())
+
+        invoker = AsyncInvoker(invoke, max_concurrency, **self.invoker_args)
+        return invoker.run(keys, payloads)
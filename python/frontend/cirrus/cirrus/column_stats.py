@@ -0,0 +1,401 @@
+""" Mergeable per-column statistics of a sparse dataset.
+
+Shipped to the preprocessing Lambdas as a top level module by
+lambdas/deploy.sh, so it must not import anything from cirrus. """
+
+import struct
+
+import numpy as np
+
+MAGIC = b"CSTA"
+HEADER = struct.Struct("<4sq")
+# The statistics of a ColumnStats, in the order they are serialized after
+# its column indices
+FIELDS = ("min", "max", "mean", "m2", "count")
+TABLE_MAGIC = b"CTAB"
+TABLE_HEADER = struct.Struct("<4sqq")
+SKETCH_MAGIC = b"CQSK"
+SKETCH_HEADER = struct.Struct("<4sqq")
+COLUMN_HEADER = struct.Struct("<qqqq")
+# The accuracy parameter of QuantileSketch
+DEFAULT_K = 200
+
+
+class ColumnStats(object):
+    """ The min, max, mean, sum of squared deviations from the mean (M2)
+    and count of the values in each column of a dataset that has values.
+    Like a ColumnTable, only the columns present are stored: columns is a
+    sorted array of their indices, and each statistic is an array aligned
+    with it, so stats stay small for sparse datasets with many columns.
+
+    Stats of disjoint parts of a dataset merge into the stats of their
+    union, so each chunk's stats can be computed separately and reduced.
+    Means and M2s are merged with Chan et al.'s parallel algorithm, which
+    stays accurate where E[X^2] - E[X]^2 would cancel. """
+
+    def __init__(self, columns=()):
+        self.columns = np.asarray(columns, dtype=np.int64)
+        n_present = len(self.columns)
+        self.min = np.full(n_present, np.inf)
+        self.max = np.full(n_present, -np.inf)
+        self.mean = np.zeros(n_present)
+        self.m2 = np.zeros(n_present)
+        self.count = np.zeros(n_present, dtype=np.int64)
+
+    @property
+    def n_cols(self):
+        """ One more than the largest column index that has values """
+        return int(self.columns[-1]) + 1 if len(self.columns) else 0
+
+    @classmethod
+    def from_arrays(cls, indices, values):
+        """ Get the stats of the values in a CSR chunk, given its indices
+        and values arrays. """
+        indices = np.asarray(indices, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        columns, positions = np.unique(indices, return_inverse=True)
+        positions = positions.reshape(-1)
+        n_present = len(columns)
+        stats = cls(columns)
+        np.minimum.at(stats.min, positions, values)
+        np.maximum.at(stats.max, positions, values)
+        stats.count = np.bincount(positions, minlength=n_present).astype(
+            np.int64)
+        stats.mean = np.bincount(positions, values, n_present) / \
+            np.maximum(stats.count, 1)
+        deviations = values - stats.mean[positions]
+        stats.m2 = np.bincount(positions, deviations * deviations, n_present)
+        return stats
+
+    @classmethod
+    def from_rows(cls, data):
+        """ Get the stats of a chunk given as a list of rows of
+        (index, value) pairs. """
+        n_values = sum(len(row) for row in data)
+        indices = np.fromiter((int(idx) for row in data for idx, _ in row),
+                              np.int64, n_values)
+        values = np.fromiter((val for row in data for _, val in row),
+                             np.float64, n_values)
+        return cls.from_arrays(indices, values)
+
+    def _expand(self, columns):
+        """ Get a copy of these stats over a sorted superset of their
+        columns, the new ones without values. """
+        stats = ColumnStats(columns)
+        positions = np.searchsorted(columns, self.columns)
+        for name in FIELDS:
+            getattr(stats, name)[positions] = getattr(self, name)
+        return stats
+
+    def merge(self, other):
+        """ Get the stats of the union of the datasets described by these
+        stats and other. """
+        columns = np.union1d(self.columns, other.columns)
+        stats = self._expand(columns)
+        other = other._expand(columns)
+        np.minimum(stats.min, other.min, out=stats.min)
+        np.maximum(stats.max, other.max, out=stats.max)
+        count = stats.count + other.count
+        weight = other.count / np.maximum(count, 1).astype(np.float64)
+        delta = other.mean - stats.mean
+        stats.mean = stats.mean + delta * weight
+        stats.m2 = stats.m2 + other.m2 + delta * delta * stats.count * weight
+        stats.count = count
+        return stats
+
+    @staticmethod
+    def merge_all(stats, map_fn=map):
+        """ Merge a list of stats with a tree reduction, merging the pairs
+        at each level with map_fn, which can be a parallel map. """
+        return _tree_merge(stats, map_fn, ColumnStats)
+
+    @property
+    def sum(self):
+        """ The sum of each column """
+        return self.mean * self.count
+
+    def std_dev(self):
+        """ Get the population standard deviation of each column, which is
+        exactly 0 for columns holding a single value """
+        return np.where(self.max > self.min,
+                        np.sqrt(self.m2 / np.maximum(self.count, 1)), 0.0)
+
+    def bounds(self):
+        """ Get a ColumnTable of the min and max of each column """
+        return ColumnTable(self.columns,
+                           np.column_stack([self.min, self.max]))
+
+    def normal_table(self):
+        """ Get a ColumnTable of the mean and std. dev. of each column """
+        return ColumnTable(self.columns,
+                           np.column_stack([self.mean, self.std_dev()]))
+
+    def serialize(self):
+        """ Encode these stats as bytes """
+        return HEADER.pack(MAGIC, len(self.columns)) + \
+            self.columns.astype("<i8").tobytes() + b"".join(
+                getattr(self, name).astype("<f8").tobytes()
+                for name in FIELDS[:-1]) + \
+            self.count.astype("<i8").tobytes()
+
+    @classmethod
+    def deserialize(cls, b_data):
+        """ Decode stats encoded by serialize """
+        magic, n_present = HEADER.unpack_from(b_data)
+        if magic != MAGIC:
+            raise ValueError("Not a ColumnStats object")
+        if len(b_data) != HEADER.size + 48 * n_present:
+            raise ValueError("ColumnStats object of {0} columns has {1} "
+                             "bytes".format(n_present, len(b_data)))
+        offset = HEADER.size
+        stats = cls(np.frombuffer(b_data, "<i8", n_present, offset))
+        offset += 8 * n_present
+        for name in FIELDS[:-1]:
+            setattr(stats, name, np.frombuffer(
+                b_data, "<f8", n_present, offset).astype(np.float64))
+            offset += 8 * n_present
+        stats.count = np.frombuffer(b_data, "<i8", n_present, offset).astype(
+            np.int64)
+        return stats
+
+
+class ColumnTable(object):
+    """ A row of floats for each of a sorted array of column indices, like
+    the bounds of the columns that have values. Only the columns present
+    in a dataset are stored, so tables stay small for sparse datasets with
+    many columns. """
+
+    def __init__(self, columns=(), table=None):
+        self.columns = np.asarray(columns, dtype=np.int64)
+        if table is None:
+            table = np.empty((len(self.columns), 0))
+        self.table = np.asarray(table, dtype=np.float64)
+        if self.table.ndim == 1:
+            self.table = self.table[:, np.newaxis]
+        if len(self.table) != len(self.columns):
+            raise ValueError("Table has {0} rows for {1} columns".format(
+                len(self.table), len(self.columns)))
+
+    def dense(self, n_cols=None, fill=np.nan):
+        """ Get the table as an array with a row for each column index
+        below n_cols, so it can be indexed by a chunk's indices. Missing
+        columns are filled with fill. """
+        if n_cols is None:
+            n_cols = int(self.columns[-1]) + 1 if len(self.columns) else 0
+        dense = np.full((n_cols, self.table.shape[1]), fill)
+        present = self.columns < n_cols
+        dense[self.columns[present]] = self.table[present]
+        return dense
+
+    def serialize(self):
+        """ Encode this table as bytes """
+        return TABLE_HEADER.pack(TABLE_MAGIC, len(self.columns),
+                                 self.table.shape[1]) + \
+            self.columns.astype("<i8").tobytes() + \
+            self.table.astype("<f8").tobytes()
+
+    @classmethod
+    def deserialize(cls, b_data):
+        """ Decode a table encoded by serialize """
+        magic, n_rows, width = TABLE_HEADER.unpack_from(b_data)
+        if magic != TABLE_MAGIC:
+            raise ValueError("Not a ColumnTable object")
+        if len(b_data) != TABLE_HEADER.size + 8 * n_rows * (width + 1):
+            raise ValueError("ColumnTable object of {0} rows has {1} "
+                             "bytes".format(n_rows, len(b_data)))
+        columns = np.frombuffer(b_data, "<i8", n_rows, TABLE_HEADER.size)
+        table = np.frombuffer(b_data, "<f8", n_rows * width,
+                              TABLE_HEADER.size + 8 * n_rows)
+        return cls(columns, table.reshape(n_rows, width))
+
+
+class QuantileSketch(object):
+    """ A KLL sketch of the values in one column, from which quantiles can
+    be estimated with a rank error on the order of 1 / k.
+
+    Items at level h stand for 2^h values. When a level grows past its
+    capacity, it is sorted and every other item moves up a level; lower
+    levels have smaller capacities. Compactions alternate between keeping
+    the even and the odd items, so sketches are deterministic. """
+
+    def __init__(self, k=DEFAULT_K):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.offset = 0
+
+    def update(self, values):
+        """ Add an array of values to the sketch """
+        self.levels[0] = np.concatenate(
+            [self.levels[0], np.asarray(values, dtype=np.float64)])
+        self.n += len(values)
+        self._compress()
+
+    def merge(self, other):
+        """ Get a sketch of the values in this sketch and other """
+        sketch = QuantileSketch(max(self.k, other.k))
+        sketch.n = self.n + other.n
+        sketch.offset = self.offset ^ other.offset
+        n_levels = max(len(self.levels), len(other.levels))
+        sketch.levels = [np.concatenate(
+            [levels[h] for levels in (self.levels, other.levels)
+             if h < len(levels)]) for h in range(n_levels)]
+        sketch._compress()
+        return sketch
+
+    def quantiles(self, fractions):
+        """ Estimate the values at the given fractions of the ranks """
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0**h)
+                                  for h, items in enumerate(self.levels)])
+        order = np.argsort(values, kind="mergesort")
+        values = values[order]
+        ranks = np.cumsum(weights[order])
+        positions = np.searchsorted(
+            ranks, np.asarray(fractions) * ranks[-1], side="left")
+        return values[np.minimum(positions, len(values) - 1)]
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2.0 / 3)**depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # An odd item out stays at this level
+                n_paired = len(items) - len(items) % 2
+                self.levels[level] = items[n_paired:]
+                self.levels[level + 1] = np.concatenate(
+                    [self.levels[level + 1],
+                     items[self.offset:n_paired:2]])
+                self.offset ^= 1
+            level += 1
+
+
+class ColumnSketches(object):
+    """ A QuantileSketch of each column of a dataset that has values,
+    mergeable like ColumnStats. """
+
+    def __init__(self, k=DEFAULT_K):
+        self.k = k
+        self.sketches = {}
+
+    @property
+    def n_cols(self):
+        """ One more than the largest column index that has values """
+        return max(self.sketches) + 1 if self.sketches else 0
+
+    @classmethod
+    def from_arrays(cls, indices, values, k=DEFAULT_K):
+        """ Sketch the values in a CSR chunk, given its indices and values
+        arrays. """
+        indices = np.asarray(indices, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        order = np.argsort(indices, kind="mergesort")
+        columns, starts = np.unique(indices[order], return_index=True)
+        sketches = cls(k)
+        for col, col_values in zip(columns.tolist(),
+                                   np.split(values[order], starts[1:])):
+            sketch = QuantileSketch(k)
+            sketch.update(col_values)
+            sketches.sketches[col] = sketch
+        return sketches
+
+    @classmethod
+    def from_rows(cls, data, k=DEFAULT_K):
+        """ Sketch a chunk given as a list of rows of (index, value)
+        pairs. """
+        n_values = sum(len(row) for row in data)
+        indices = np.fromiter((int(idx) for row in data for idx, _ in row),
+                              np.int64, n_values)
+        values = np.fromiter((val for row in data for _, val in row),
+                             np.float64, n_values)
+        return cls.from_arrays(indices, values, k)
+
+    def merge(self, other):
+        """ Get the sketches of the union of the datasets sketched by
+        these sketches and other. """
+        merged = ColumnSketches(max(self.k, other.k))
+        merged.sketches = dict(self.sketches)
+        for col, sketch in other.sketches.items():
+            if col in merged.sketches:
+                sketch = merged.sketches[col].merge(sketch)
+            merged.sketches[col] = sketch
+        return merged
+
+    @staticmethod
+    def merge_all(sketches, map_fn=map):
+        """ Merge a list of sketches with a tree reduction, merging the
+        pairs at each level with map_fn, which can be a parallel map. """
+        return _tree_merge(sketches, map_fn, ColumnSketches)
+
+    def quantiles(self, fractions):
+        """ Get a ColumnTable with a row for each column that has values,
+        holding the estimated values at the given fractions of the
+        ranks. """
+        columns = sorted(self.sketches)
+        table = np.empty((len(columns), len(fractions)))
+        for row, col in enumerate(columns):
+            table[row] = self.sketches[col].quantiles(fractions)
+        return ColumnTable(columns, table)
+
+    def serialize(self):
+        """ Encode these sketches as bytes """
+        parts = [SKETCH_HEADER.pack(SKETCH_MAGIC, self.k, len(self.sketches))]
+        for col in sorted(self.sketches):
+            sketch = self.sketches[col]
+            parts.append(COLUMN_HEADER.pack(col, sketch.n, sketch.offset,
+                                            len(sketch.levels)))
+            for items in sketch.levels:
+                parts.append(struct.pack("<q", len(items)))
+                parts.append(items.astype("<f8").tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def deserialize(cls, b_data):
+        """ Decode sketches encoded by serialize """
+        magic, k, n_sketches = SKETCH_HEADER.unpack_from(b_data)
+        if magic != SKETCH_MAGIC:
+            raise ValueError("Not a ColumnSketches object")
+        sketches = cls(k)
+        offset = SKETCH_HEADER.size
+        for _ in range(n_sketches):
+            col, n_values, sketch_offset, n_levels = \
+                COLUMN_HEADER.unpack_from(b_data, offset)
+            offset += COLUMN_HEADER.size
+            sketch = QuantileSketch(k)
+            sketch.n = n_values
+            sketch.offset = sketch_offset
+            sketch.levels = []
+            for _ in range(n_levels):
+                length = struct.unpack_from("<q", b_data, offset)[0]
+                offset += 8
+                sketch.levels.append(np.frombuffer(
+                    b_data, "<f8", length, offset).astype(np.float64))
+                offset += 8 * length
+            sketches.sketches[col] = sketch
+        if offset != len(b_data):
+            raise ValueError("ColumnSketches object has {0} extra bytes"
+                             .format(len(b_data) - offset))
+        return sketches
+
+
+def _tree_merge(items, map_fn, empty):
+    items = list(items)
+    if not items:
+        return empty()
+    while len(items) > 1:
+        pairs = [items[i:i + 2] for i in range(0, len(items), 2)]
+        items = list(map_fn(_merge_pair, pairs))
+    return items[0]
+
+
+def _merge_pair(pair):
+    if len(pair) == 1:
+        return pair[0]
+    return pair[0].merge(pair[1])
@@ -1,46 +1,97 @@
 """ Apply feature hashing to specified columns. """
 
-from cirrus.lambda_thread import LambdaThread
-from cirrus.utils import get_all_keys, launch_threads, Timer,\
-    get_redis_creds
+from cirrus.lambda_thread import LambdaThread, get_executor, key_fields
+from cirrus.utils import get_all_chunks, launch_threads, raise_failures, \
+    Timer, batch_keys, invalidate_manifest, write_output_manifest
 
 MAX_LAMBDAS = 400
 
 
 class HashingThread(LambdaThread):
-    """ Thread to hash the columns for a given chunk. """
-    def __init__(self, s3_key, s3_bucket_input, s3_bucket_output,
-                 columns, n_buckets, creds):
+    """ Thread to hash the columns for a batch of chunks. """
+    def __init__(self, s3_keys, s3_bucket_input, s3_bucket_output,
+                 columns, n_buckets, creds, cache_size=None, hot_values=(),
+                 signed=False, n_hashes=1, keep_values=False, crosses=()):
         LambdaThread.__init__(self)
         self.lamdba_dict = {
             "s3_bucket_input": s3_bucket_input,
             "s3_bucket_output": s3_bucket_output,
-            "s3_key": s3_key,
             "action": "FEATURE_HASHING",
             "columns": columns,
             "n_buckets": n_buckets,
+            "signed": signed,
+            "n_hashes": n_hashes,
+            "keep_values": keep_values,
+            "crosses": [[int(a), int(b)] for a, b in crosses],
             "use_redis": "1",
             "redis_host": creds["host"],
             "redis_db": creds["db"],
             "redis_password": creds["password"],
             "redis_port": creds["port"]
         }
+        self.lamdba_dict.update(key_fields(s3_keys))
+        if cache_size is not None:
+            self.lamdba_dict["hash_cache_size"] = cache_size
+        if hot_values:
+            self.lamdba_dict["hot_values"] = [float(val) for val in hot_values]
 
 
 def feature_hashing(s3_bucket_input, s3_bucket_output, columns,
-                    n_buckets, objects=()):
+                    n_buckets, objects=(), cache_size=None, hot_values=(),
+                    signed=False, n_hashes=1, keep_values=False,
+                    crosses=()):
     """ Take a list of integer values (column indices) to perform
-    the feature hashing for n_buckets buckets. """
+    the feature hashing for n_buckets buckets. Each Lambda keeps the hashes
+    of up to cache_size values between invocations, and never evicts those
+    of hot_values.
+
+    If signed is set, each value adds +1 or -1 to its bucket, picked by
+    another bit of its hash, so that collisions cancel out on average.
+    Each value is hashed into n_hashes buckets with different seeds. If
+    keep_values is set, the hashed columns are also kept, at n_buckets plus
+    their index like every other column.
+
+    For each pair of columns (a, b) in crosses, the pair of values of each
+    row with both columns is hashed into the same buckets, in the same
+    pass. """
+    if n_hashes < 1:
+        raise ValueError("n_hashes must be at least 1")
+    # The output manifest is only written if every chunk is transformed
+    all_chunks = not objects
+    entries = None
     if not objects:
         # Allow user to specify objects, or otherwise get all objects.
-        objects = get_all_keys(s3_bucket_input)
+        entries = get_all_chunks(s3_bucket_input)
+        objects = [entry["Key"] for entry in entries]
 
     # Hash the appropriate columns for each chunk
     timer = Timer("FEATURE_HASHING")
-    # Launch one HashingThread for each object.
-    creds = get_redis_creds()
-    launch_threads(HashingThread, objects, MAX_LAMBDAS,
-                   s3_bucket_input, s3_bucket_output, columns, n_buckets,
-                   creds)
+    # Launch one HashingThread for each batch of objects.
+    creds = get_executor().redis_creds()
+    batches = batch_keys(s3_bucket_input, objects, MAX_LAMBDAS,
+                         entries=entries)
+    # The chunks of the output bucket are about to change
+    invalidate_manifest(s3_bucket_output)
+    results = launch_threads(HashingThread, batches, MAX_LAMBDAS,
+                             s3_bucket_input, s3_bucket_output, columns,
+                             n_buckets, creds, cache_size, hot_values,
+                             signed, n_hashes, keep_values, crosses)
+    raise_failures(results, "HashingThread")
+    write_output_manifest(s3_bucket_output, objects, results, all_chunks)
 
+    report_cache_use(timer, results)
     timer.global_timestamp()
+
+
+def report_cache_use(timer, results):
+    """ Print the hit rate of the Lambdas' hash caches """
+    hits = 0
+    misses = 0
+    for res in results:
+        if isinstance(res.result, dict) and "hash_cache" in res.result:
+            hits += res.result["hash_cache"]["hits"]
+            misses += res.result["hash_cache"]["misses"]
+    timer.report("Hash cache hits", hits).report("Hash cache misses", misses)
+    if hits + misses:
+        timer.report("Hash cache hit rate",
+                     "{0:.3f}".format(hits / float(hits + misses)))
@@ -1,12 +1,24 @@
 """ Run a lambda function on AWS """
 
+from __future__ import absolute_import
+
 import json
+import multiprocessing
+import os
 import random
-from threading import Thread
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
-import boto3
 from botocore.exceptions import ClientError
-from cirrus.utils import retry_loop
+from cirrus.utils import retry_loop, get_client, get_redis_creds, \
+    map_in_threads, set_local_s3_root
+
+# The preprocessing Lambda deployed by lambdas/deploy.sh
+LAMBDA_NAME = "neel_lambda"
+# Longer than the Lambda's timeout, so that invocations aren't cut short
+LAMBDA_READ_TIMEOUT = 330
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "lambdas")
 
 
 def handle_lambda_exception(exception):
@@ -18,27 +30,168 @@ def handle_lambda_exception(exception):
         raise exception
 
 
-class LambdaThread(Thread):
-    """ Run a lambda function on AWS """
+class Executor(object):
+    """ Base class for the backends that run preprocessing Lambdas """
 
-    def __init__(self):
-        Thread.__init__(self)
+    def redis_creds(self):
+        """ Get the credentials of the Redis server used by the Lambdas """
+        raise NotImplementedError()
 
-    def run(self):
-        l_client = boto3.client("lambda")
+    def invoke(self, payload):
+        """ Run the Lambda on a payload and wait for it to finish """
+        raise NotImplementedError()
+
+    def invoke_all(self, keys, payloads, max_concurrency):
+        """ Run the Lambda on each payload, with at most max_concurrency
+        running at once. Returns a ChunkResult for each key, in order. """
+        results = map_in_threads(self.invoke, payloads, max_concurrency)
+        return [res._replace(key=key) for key, res in zip(keys, results)]
+
+
+class LambdaExecutor(Executor):
+    """ Invoke the preprocessing Lambda function on AWS """
+
+    def __init__(self, function_name=LAMBDA_NAME):
+        self.function_name = function_name
+
+    def redis_creds(self):
+        """ Get the credentials of the Redis server used by the Lambdas """
+        return get_redis_creds()
+
+    def invoke(self, payload):
+        """ Invoke the Lambda on a payload and wait for it to finish.
+        Returns the Lambda's response. """
+        l_client = get_client("lambda", read_timeout=LAMBDA_READ_TIMEOUT)
         # Prevent lambdas from launching multiple times
-        self.lamdba_dict["dupe_nonce"] = (random.random() * 1000000) // 1.0
+        payload = with_nonce(payload)
         # Call the lambda invocation in a retry loop
 
         def lambda_invocation():
             """ Wrap the lambda invocation in a closure """
             return l_client.invoke(
-                FunctionName="neel_lambda",
+                FunctionName=self.function_name,
                 InvocationType="RequestResponse",
                 LogType="Tail",
-                Payload=json.dumps(self.lamdba_dict)
+                Payload=json.dumps(payload)
             )
 
-        retry_loop(lambda_invocation, ClientError, handle_lambda_exception,
-                   name="CHUNK_{0}_LAMBDA"
-                   .format(self.lamdba_dict["s3_key"]))
+        response = retry_loop(
+            lambda_invocation, ClientError, handle_lambda_exception,
+            name="CHUNK_{0}_LAMBDA".format(payload["s3_key"]))
+        return parse_lambda_response(payload, response,
+                                     response["Payload"].read())
+
+
+def with_nonce(payload):
+    """ Copy a payload, adding a nonce so that the handler can detect
+    duplicate launches """
+    payload = dict(payload)
+    payload["dupe_nonce"] = (random.random() * 1000000) // 1.0
+    return payload
+
+
+def parse_lambda_response(payload, response, body):
+    """ Decode the body of a Lambda response, raising if the Lambda
+    failed """
+    result = json.loads(body.decode("utf-8"))
+    if "FunctionError" in response:
+        raise RuntimeError("Lambda failed on chunk {0}: {1}".format(
+            payload["s3_key"], result))
+    return result
+
+
+class LocalExecutor(Executor):
+    """ Run the preprocessing Lambda handler in a pool of local processes,
+    against a LocalS3Client rooted at s3_root. If redis_creds is None,
+    the handlers run without Redis, so MinMaxScaler must be run with
+    use_redis=False. """
+
+    def __init__(self, s3_root, redis_creds=None, max_workers=None):
+        self.s3_root = s3_root
+        self.creds = redis_creds
+        self.pool = ProcessPoolExecutor(
+            max_workers or multiprocessing.cpu_count())
+
+    def redis_creds(self):
+        """ Get the credentials of the local Redis server, if any """
+        if self.creds is None:
+            return {"host": None, "port": None, "db": None, "password": None}
+        return self.creds
+
+    def invoke(self, payload):
+        """ Run the handler on a payload and wait for it to finish """
+        payload = dict(payload)
+        payload["local_s3_root"] = self.s3_root
+        if self.creds is None:
+            if payload.get("normalization") == "MIN_MAX" and \
+                    payload.get("use_redis") == "1":
+                raise ValueError("MinMaxScaler needs use_redis=False "
+                                 "without a Redis server")
+            payload["use_redis"] = "0"
+        return self.pool.submit(run_local_handler, payload).result()
+
+    def shutdown(self):
+        """ Stop the worker processes """
+        self.pool.shutdown()
+
+
+def run_local_handler(payload):
+    """ Run the preprocessing Lambda handler in this process """
+    if LAMBDAS_DIR not in sys.path:
+        # The handler imports its helpers and utils.py as top level modules
+        sys.path.insert(0, os.path.dirname(LAMBDAS_DIR))
+        sys.path.insert(0, LAMBDAS_DIR)
+    import handler
+    return handler.handler(payload, None)
+
+
+EXECUTOR = LambdaExecutor()
+
+
+def get_executor():
+    """ Get the executor used to run LambdaThreads """
+    return EXECUTOR
+
+
+def set_executor(executor):
+    """ Set the executor used to run LambdaThreads, returning the
+    previous one """
+    global EXECUTOR
+    previous = EXECUTOR
+    EXECUTOR = executor
+    return previous
+
+
+def use_local_backend(s3_root, redis_creds=None, max_workers=None):
+    """ Run preprocessing on this machine: Lambdas run in a local process
+    pool and S3 requests go to directories under s3_root. """
+    set_local_s3_root(s3_root)
+    return set_executor(LocalExecutor(s3_root, redis_creds, max_workers))
+
+
+def key_fields(s3_keys):
+    """ Get the payload fields naming the chunks that a Lambda processes,
+    given a key or a batch of keys from batch_keys """
+    if not isinstance(s3_keys, (list, tuple)):
+        return {"s3_key": s3_keys}
+    return {"s3_key": s3_keys[0], "s3_keys": list(s3_keys)}
+
+
+class LambdaThread(object):
+    """ Run a lambda function on AWS, or on the executor set with
+    set_executor """
+
+    def __init__(self):
+        pass
+
+    def run(self):
+        return get_executor().invoke(self.lamdba_dict)
+
+    @classmethod
+    def run_all(cls, objects, max_lambdas, *params):
+        """ Run cls(obj, *params) for each of the objects passed in, letting
+        the executor schedule all of them at once. Used by launch_threads.
+        """
+        objects = list(objects)
+        payloads = [cls(obj, *params).lamdba_dict for obj in objects]
+        return get_executor().invoke_all(objects, payloads, max_lambdas)
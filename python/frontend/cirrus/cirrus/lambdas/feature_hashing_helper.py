@@ -1,28 +1,215 @@
 """ Helper functions for feature hashing """
 
+from collections import OrderedDict
+
 import mmh3
+import numpy as np
+
+from utils import arrays_to_rows
 
 HASH_SEED = 42
+# The number of value hashes kept between invocations of a warm Lambda
+CACHE_SIZE = 1 << 20
+
+
+class HashCache(object):
+    """ A bounded LRU memo from values to their murmur3 hashes, kept for
+    the life of the Lambda container. Bucketing only depends on a value, so
+    entries are shared by all columns and numbers of buckets. Entries are
+    keyed by the seed of the hash and the bits of the value. Pinned
+    values, like the hot values sent by the driver, are never evicted.
+
+    hits and misses count lookups of the distinct values of each chunk. """
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, max_size):
+        """ Change the number of entries kept, evicting the oldest ones """
+        self.max_size = max_size
+        while len(self.entries) > max(max_size, 0):
+            self.entries.popitem(last=False)
 
+    def pin(self, values, seeds=(HASH_SEED,)):
+        """ Hash values now with each seed, and keep their hashes for
+        good """
+        values = np.asarray(values, dtype=np.float64)
+        for seed in seeds:
+            for key, val in zip(values.view(np.int64).tolist(),
+                                values.tolist()):
+                if (seed, key) not in self.pinned:
+                    self.pinned[(seed, key)] = mmh3.hash(str(val), seed,
+                                                         signed=False)
 
-def hash_data(data, columns, n_buckets):
-    """ Replace the appropriate columns for this row. """
-    col_set = set([int(i) for i in columns])
-    for idx, row in enumerate(data):
-        row_map = {}
-        for col, val in row:
-            s_c = int(col)
-            if s_c in col_set:
-                hash_val = mmh3.hash(str(val), HASH_SEED, signed=False)
-                bucket = hash_val % n_buckets
-                if bucket not in row_map:
-                    row_map[bucket] = 0
-                row_map[bucket] += 1
+    def hashes(self, values, seed=HASH_SEED):
+        """ Get the unsigned murmur3 hash of the printed form of each value
+        in a float64 array """
+        return self.lookup(values.view(np.int64).tolist(),
+                           [str(val) for val in values.tolist()], seed)
+
+    def lookup(self, keys, texts, seed=HASH_SEED):
+        """ Get the unsigned murmur3 hash of each text, memoized under the
+        matching key """
+        hashes = np.empty(len(keys), dtype=np.int64)
+        for i, (key, text) in enumerate(zip(keys, texts)):
+            key = (seed, key)
+            hash_val = self.pinned.get(key)
+            if hash_val is None:
+                # Move the entry to the most recently used end
+                hash_val = self.entries.pop(key, None)
+                if hash_val is None:
+                    self.misses += 1
+                    hash_val = mmh3.hash(text, seed, signed=False)
+                else:
+                    self.hits += 1
+                if self.max_size > 0:
+                    if len(self.entries) >= self.max_size:
+                        self.entries.popitem(last=False)
+                    self.entries[key] = hash_val
             else:
-                row_map[n_buckets + col] = val
+                self.hits += 1
+            hashes[i] = hash_val
+        return hashes
+
+    def counters(self):
+        """ Get the hit and miss counts, and the number of entries """
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self.entries) + len(self.pinned)}
+
+
+CACHE = HashCache()
 
-        row_values = []
-        for k in row_map:
-            row_values.append((k, row_map[k]))
-        data[idx] = row_values
+
+def hash_data(data, columns, n_buckets, **options):
+    """ Replace the appropriate columns for this row. options are passed
+    to hash_arrays. """
+    n_values = sum(len(row) for row in data)
+    indptr = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in data], out=indptr[1:])
+    indices = np.fromiter((int(col) for row in data for col, _ in row),
+                          np.int64, n_values)
+    values = np.fromiter((val for row in data for _, val in row),
+                         np.float64, n_values)
+    indptr, indices, values = hash_arrays(indptr, indices, values, columns,
+                                          n_buckets, **options)
+    data[:] = arrays_to_rows(indptr, indices, values)
     return data
+
+
+def hash_arrays(indptr, indices, values, columns, n_buckets, cache=CACHE,
+                signed=False, n_hashes=1, keep_values=False, crosses=()):
+    """ Hash the values of the given columns of a CSR chunk into n_buckets
+    buckets, counting the values that land in each bucket. Every other
+    column col is moved to column n_buckets + col. Returns the new indptr,
+    indices and values arrays, with the indices of each row sorted.
+
+    Each distinct value is hashed once, as mmh3.hash(str(val), HASH_SEED),
+    so buckets are the same as hashing every value on its own. values can
+    be float32, as decoded from a chunk, or float64. Hashes are memoized
+    in cache.
+
+    If signed is set, each value adds -1 instead of 1 when the top bit of
+    its hash is set, so that collisions tend to cancel out. With n_hashes
+    above 1, each value is also hashed with the seeds following HASH_SEED,
+    adding to one bucket per hash. If keep_values is set, the hashed
+    columns are also kept, moved like the other columns.
+
+    Each pair of columns (a, b) in crosses adds the hash of the values of
+    both columns in a row, as cross_text(a, val_a, b, val_b), to the same
+    buckets, in the same way. The crossed columns are left as they are. """
+    indices = np.asarray(indices, dtype=np.int64)
+    values = np.asarray(values)
+    bits_type = np.int32 if values.dtype == np.float32 else np.int64
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    selected = np.isin(indices, np.array([int(i) for i in columns],
+                                         dtype=np.int64))
+
+    # Floats that compare equal can print differently, like 0.0 and -0.0,
+    # so values are matched on their bits
+    bits, inverse = np.unique(values[selected].view(bits_type),
+                              return_inverse=True)
+    distinct = bits.view(values.dtype).astype(np.float64)
+    kept = np.ones_like(selected) if keep_values else ~selected
+    out_rows = [rows[kept]]
+    out_cols = [n_buckets + indices[kept]]
+    out_vals = [values[kept]]
+    hashed = [(rows[selected], inverse, cache.hashes, (distinct,))]
+    for col_a, col_b in crosses:
+        hashed.append(_cross(rows, indices, values, int(col_a), int(col_b),
+                             cache))
+    for hashed_rows, inverse, hash_fn, args in hashed:
+        for seed in range(HASH_SEED, HASH_SEED + n_hashes):
+            hashes = hash_fn(*(args + (seed,)))
+            if signed:
+                weights = (1 - 2 * (hashes >> 31)).astype(values.dtype)
+            else:
+                weights = np.ones(len(hashes), dtype=values.dtype)
+            out_rows.append(hashed_rows)
+            out_cols.append((hashes % n_buckets)[inverse])
+            out_vals.append(weights[inverse])
+    return _combine(len(indptr) - 1, np.concatenate(out_rows),
+                    np.concatenate(out_cols), np.concatenate(out_vals),
+                    n_buckets)
+
+
+def cross_text(col_a, val_a, col_b, val_b):
+    """ Get the text hashed for a cross of two columns' values """
+    return "{0}:{1}x{2}:{3}".format(col_a, str(val_a), col_b, str(val_b))
+
+
+def _cross(rows, indices, values, col_a, col_b, cache):
+    """ Find the rows with both columns, and the distinct pairs of their
+    values. Returns the rows, the index of the pair of each row, and a
+    function and its arguments to hash the distinct pairs. """
+    bits_type = np.int32 if values.dtype == np.float32 else np.int64
+    bits = values.view(bits_type)
+    rows_a, first_a = np.unique(rows[indices == col_a], return_index=True)
+    rows_b, first_b = np.unique(rows[indices == col_b], return_index=True)
+    both, in_a, in_b = np.intersect1d(rows_a, rows_b, assume_unique=True,
+                                      return_indices=True)
+    pairs = np.column_stack([bits[indices == col_a][first_a[in_a]],
+                             bits[indices == col_b][first_b[in_b]]])
+    if len(pairs):
+        pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    else:
+        inverse = np.zeros(0, dtype=np.int64)
+    pair_values = pairs.view(values.dtype).astype(np.float64).tolist()
+    keys = [(col_a, col_b) + tuple(pair) for pair in pairs.tolist()]
+    texts = [cross_text(col_a, val_a, col_b, val_b)
+             for val_a, val_b in pair_values]
+    return both, inverse.ravel(), cache.lookup, (keys, texts)
+
+
+def hash_options(event):
+    """ Get the hashing options of an event or pipeline step, as keyword
+    arguments to hash_arrays """
+    return {"signed": bool(event.get("signed", False)),
+            "n_hashes": int(event.get("n_hashes", 1)),
+            "keep_values": bool(event.get("keep_values", False)),
+            "crosses": [tuple(pair) for pair in event.get("crosses", [])]}
+
+
+def _combine(n_rows, rows, cols, vals, n_buckets):
+    """ Build CSR arrays from (row, col, val) triples, summing the values
+    of each bucket below n_buckets and keeping the last value of any other
+    repeated column. """
+    keys = rows * (int(cols.max()) + 1 if len(cols) else 1) + cols
+    order = np.argsort(keys, kind="mergesort")
+    keys = keys[order]
+    vals = vals[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)] - 1
+    out_cols = cols[order][starts]
+    if len(starts):
+        sums = np.add.reduceat(vals, starts)
+    else:
+        sums = vals[:0]
+    out_vals = np.where(out_cols < n_buckets, sums, vals[ends])
+    out_indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[order][starts], minlength=n_rows),
+              out=out_indptr[1:])
+    return out_indptr, out_cols.astype(np.int32), out_vals
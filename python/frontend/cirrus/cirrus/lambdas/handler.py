@@ -1,61 +1,118 @@
 """ AWS Lambda handler to be deployed by the deploy.sh script. """
 
-import boto3
+import numpy as np
 from redis import StrictRedis
 from rediscluster import StrictRedisCluster
-from rediscluster.nodemanager import NodeManager
 
 import feature_hashing_helper
 import lambda_utils
 import min_max_helper
 import normal_helper
-from utils import get_data_from_s3, serialize_data, Timer, prefix_print
+import pipeline_helper
+import quantile_helper
+from column_stats import ColumnStats, ColumnSketches, ColumnTable
+from utils import get_data_from_s3, get_arrays_from_s3, serialize_arrays, \
+    chunk_entry, Timer, prefix_print
 
 CLUSTER = False
+# The scalings whose handlers take CSR arrays rather than rows
+ARRAY_SCALINGS = ("MIN_MAX", "NORMAL", "ROBUST", "QUANTILE")
+# The actions whose handlers take CSR arrays rather than rows
+ARRAY_ACTIONS = ("FEATURE_HASHING", "PIPELINE_STATS", "PIPELINE_TRANSFORM")
 
 def handler(event, context):
-    """ First entry point for lambda function. """
+    """ First entry point for lambda function. Processes the chunk
+    event["s3_key"], or each of the chunks in event["s3_keys"], fetching
+    each chunk from S3 while the previous one is processed. Returns the
+    chunk_entry of each chunk written, for the manifest of the output
+    bucket. """
     timer = Timer("CHUNK{0}".format(event["s3_key"])).set_step(
         "Determining if duplicate")
     assert "s3_bucket_input" in event, "Must specify input bucket."
+    s3_keys = event.get("s3_keys", [event["s3_key"]])
     # Handle duplicate lambda launches
     redis_flag = True
     if "use_redis" in event:
         redis_flag = bool(int(event["use_redis"]))
     redis_client = None
-    node_manager = None
-    # Kill the function if this is a duplicate
     if redis_flag:
-        unique_id = event["s3_key"] + "_nonce_" + str(event["dupe_nonce"])
-        signal = kill_duplicates(event["s3_key"], unique_id,
-                                 event["redis_host"], event["redis_port"],
-                                 event["redis_db"], event["redis_password"])
-        if signal is None:
-            return ["DUPLICATE"]
-        redis_client, node_manager = signal
-
-    timer.timestamp().set_step("Getting S3 data")
-
-    # Get data from S3
-    s3_client = boto3.client("s3")
-    data, labels = get_data_from_s3(
-        s3_client, event["s3_bucket_input"], event["s3_key"], keep_label=True)
+        redis_client = connect_redis(
+            event["s3_key"], event["redis_host"], event["redis_port"],
+            event["redis_db"], event["redis_password"])
+        # Kill the function if this is a duplicate. Local executors never
+        # launch duplicates, so they don't send a nonce.
+        if "dupe_nonce" in event:
+            unique_id = event["s3_key"] + "_nonce_" + str(event["dupe_nonce"])
+            if is_duplicate(event["s3_key"], unique_id, redis_client):
+                return ["DUPLICATE"]
+
     timer.timestamp()
 
-    # Call the appropriate handler
+    s3_client = lambda_utils.get_s3_client(event)
+
+    takes_arrays = event["action"] in ARRAY_ACTIONS or \
+        event.get("normalization") in ARRAY_SCALINGS
+
+    def fetch(s3_key):
+        """ Get a chunk from S3, as CSR arrays for feature hashing,
+        pipelines and scaling, or as rows and labels otherwise """
+        if takes_arrays:
+            return get_arrays_from_s3(s3_client, event["s3_bucket_input"],
+                                      s3_key)
+        return get_data_from_s3(s3_client, event["s3_bucket_input"], s3_key,
+                                keep_label=True)
+
     if event["action"] == "FEATURE_HASHING":
-        feature_hashing_handler(s3_client, data, labels, event)
-    elif event["normalization"] == "MIN_MAX":
-        min_max_handler(s3_client, redis_client, data, labels,
-                        node_manager, event)
-    elif event["normalization"] == "NORMAL":
-        normal_scaling_handler(s3_client, data, labels, event)
+        cache = feature_hashing_helper.CACHE
+        if "hash_cache_size" in event:
+            cache.resize(event["hash_cache_size"])
+        n_hashes = feature_hashing_helper.hash_options(event)["n_hashes"]
+        cache.pin(event.get("hot_values", []),
+                  range(feature_hashing_helper.HASH_SEED,
+                        feature_hashing_helper.HASH_SEED + n_hashes))
+        counters = cache.counters()
+
+    chunks = []
+    for s3_key, chunk in lambda_utils.prefetch(fetch, s3_keys):
+        chunk_event = dict(event, s3_key=s3_key)
+        entry = None
+        # Call the appropriate handler
+        if event["action"] == "FEATURE_HASHING":
+            entry = feature_hashing_handler(s3_client, chunk, chunk_event)
+        elif event["action"] in ("PIPELINE_STATS", "PIPELINE_TRANSFORM"):
+            entry = pipeline_handler(s3_client, chunk, chunk_event)
+        elif event["normalization"] == "MIN_MAX":
+            entry = min_max_handler(s3_client, redis_client, chunk,
+                                    chunk_event)
+        elif event["normalization"] == "NORMAL":
+            entry = normal_scaling_handler(s3_client, chunk, chunk_event)
+        elif event["normalization"] in ("ROBUST", "QUANTILE"):
+            entry = quantile_scaling_handler(s3_client, chunk, chunk_event)
+        if entry is not None:
+            chunks.append(entry)
     timer.global_timestamp()
-    return []
+    result = {"chunks": chunks}
+    if event["action"] == "FEATURE_HASHING":
+        # Report this invocation's use of the hash cache to the driver
+        after = feature_hashing_helper.CACHE.counters()
+        result["hash_cache"] = {
+            "hits": after["hits"] - counters["hits"],
+            "misses": after["misses"] - counters["misses"],
+            "size": after["size"]}
+    return result
 
 
-def kill_duplicates(chunk, unique_id, host, port, db, password):
-    """ Identify duplicates with Redis """
+def put_chunk(s3_client, event, serialized):
+    """ Put a serialized chunk in the output bucket, and get its entry
+    in the manifest """
+    response = s3_client.put_object(
+        Bucket=event["s3_bucket_output"], Key=event["s3_key"],
+        Body=serialized)
+    return chunk_entry(event["s3_key"], serialized, response.get("ETag"))
+
+
+def connect_redis(chunk, host, port, db, password):
+    """ Connect to Redis """
     printer = prefix_print("CHUNK{0}".format(chunk))
     redis_host = host
     redis_port = int(port)
@@ -70,51 +127,80 @@ def kill_duplicates(chunk, unique_id, host, port, db, password):
     else:
         redis_client = StrictRedisCluster(
             startup_nodes=startup_nodes, decode_responses=True,
-            skip_full_coverage_check=True)
+            skip_full_coverage_check=True, password=redis_password)
     printer("Initialized Redis client")
-    node_manager = NodeManager(startup_nodes)
-    printer("Created NodeManager")
+    return redis_client
+
+
+def is_duplicate(chunk, unique_id, redis_client):
+    """ Identify duplicates with Redis """
+    printer = prefix_print("CHUNK{0}".format(chunk))
     k_signal = redis_client.getset(unique_id, "Y")
     printer("Checked if lambda already launched")
     if k_signal == "Y":
         printer("Found duplicate - killing.")
-        return None
+        return True
+    return False
 
-    return redis_client, node_manager
 
-
-def feature_hashing_handler(s3_client, data, labels, event):
-    """ Handle a call for feature hashing """
+def feature_hashing_handler(s3_client, arrays, event):
+    """ Handle a call for feature hashing, given the CSR arrays of a
+    chunk """
     timer = Timer("CHUNK{0}".format(event["s3_key"])).set_step(
         "Feature hashing")
     printer = prefix_print("CHUNK{0}".format(event["s3_key"]))
     printer("Hashing data")
-    hashed = feature_hashing_helper.hash_data(data,
-                                              event["columns"],
-                                              event["n_buckets"])
+    indptr, indices, values, labels = arrays
+    indptr, indices, values = feature_hashing_helper.hash_arrays(
+        indptr, indices, values, event["columns"], event["n_buckets"],
+        **feature_hashing_helper.hash_options(event))
     printer("Serializing data")
-    serialized = serialize_data(hashed, labels)
+    serialized = serialize_arrays(indptr, indices, values, labels)
     printer("Putting object in S3")
-    s3_client.put_object(
-        Bucket=event["s3_bucket_output"], Key=event["s3_key"], Body=serialized)
+    entry = put_chunk(s3_client, event, serialized)
     timer.timestamp()
+    return entry
+
+
+def pipeline_handler(s3_client, arrays, event):
+    """ Run a pass of a compiled preprocessing pipeline, given the CSR
+    arrays of a chunk """
+    indptr, indices, values, labels = arrays
+    if event["action"] == "PIPELINE_STATS":
+        pipeline_helper.stats_pass(s3_client, (indptr, indices, values),
+                                   event)
+    elif event["action"] == "PIPELINE_TRANSFORM":
+        assert "s3_bucket_output" in event, "Must specify output bucket."
+        indptr, indices, values = pipeline_helper.transform_pass(
+            s3_client, (indptr, indices, values), event)
+        serialized = serialize_arrays(indptr, indices, values, labels)
+        return put_chunk(s3_client, event, serialized)
+    return None
 
 
-def min_max_handler(s3_client, redis_client, data, labels,
-                    node_manager, event):
+def min_max_handler(s3_client, redis_client, arrays, event):
     """ Either calculates the local bounds, or scales data and puts
-    the new data in {src_object}_scaled. """
+    the new data in {src_object}_scaled, given the CSR arrays of a
+    chunk. """
     timer = Timer("CHUNK{0}".format(event["s3_key"]))
-    if event["action"] == "LOCAL_BOUNDS":
+    indptr, indices, values, labels = arrays
+    if event["action"] == "LOCAL_BOUNDS" and redis_client is None:
+        timer.set_step("Calculating stats")
+        stats = ColumnStats.from_arrays(indices, values)
+        timer.timestamp().set_step("Putting stats in S3")
+        # The driver merges the stats of all chunks
+        lambda_utils.put_stats_in_s3(s3_client, stats,
+                                     event["s3_bucket_input"],
+                                     event["s3_key"] + "_stats")
+        timer.timestamp()
+    elif event["action"] == "LOCAL_BOUNDS":
         print("Getting local data bounds...")
         timer.set_step("Calculating bounds")
-        bounds = min_max_helper.get_data_bounds(data)
-        timer.timestamp().set_step("Putting bounds in S3 / Redis")
-        print("Putting bounds in S3...")
-        min_max_helper.put_bounds_in_db(
-            s3_client, redis_client, bounds,
-            event["s3_bucket_input"], event["s3_key"],
-            node_manager, event["s3_key"])
+        bounds = ColumnStats.from_arrays(indices, values).bounds()
+        timer.timestamp().set_step("Putting bounds in Redis")
+        print("Putting bounds in Redis...")
+        min_max_helper.put_bounds_in_db(redis_client, bounds,
+                                        event["s3_key"])
         timer.timestamp()
     elif event["action"] == "LOCAL_SCALE":
         assert "s3_bucket_output" in event, "Must specify output bucket."
@@ -122,43 +208,75 @@ def min_max_handler(s3_client, redis_client, data, labels,
         assert "max_v" in event, "Must specify max."
         print("Getting global bounds...")
         timer.set_step("Getting global bounds")
-        bounds = min_max_helper.get_global_bounds(
-            s3_client, redis_client, event["s3_bucket_input"], event["s3_key"],
-            event["s3_key"])
+        if redis_client is None:
+            bounds = lambda_utils.get_stats_from_s3(
+                s3_client, event["s3_bucket_input"], event["table_key"],
+                event["s3_key"], stats_cls=ColumnTable)
+        else:
+            bounds = min_max_helper.get_global_bounds(
+                redis_client, event["s3_key"], np.unique(indices).tolist())
         timer.timestamp().set_step("Scaling data")
         print("Scaling data...")
-        scaled = min_max_helper.scale_data(data, bounds,
+        scaled = min_max_helper.scale_data(indices, values, bounds,
                                            event["min_v"], event["max_v"])
         timer.timestamp().set_step("Serializing")
         print("Serializing...")
-        serialized = serialize_data(scaled, labels)
+        serialized = serialize_arrays(indptr, indices, scaled, labels)
         timer.timestamp().set_step("Putting in S3")
-        s3_client.put_object(
-            Bucket=event["s3_bucket_output"],
-            Key=event["s3_key"], Body=serialized)
+        entry = put_chunk(s3_client, event, serialized)
         timer.timestamp()
+        return entry
+    return None
 
 
-def normal_scaling_handler(s3_client, data, labels, event):
-    """ Scale to a unit normal range """
+def normal_scaling_handler(s3_client, arrays, event):
+    """ Scale to a unit normal range, given the CSR arrays of a chunk """
+    indptr, indices, values, labels = arrays
     if event["action"] == "LOCAL_RANGE":
-        print("Getting local data ranges...")
-        bounds = normal_helper.get_data_ranges(data)
-        print("Putting ranges in S3...")
-        lambda_utils.put_dict_in_s3(
-            s3_client, bounds, event["s3_bucket_input"],
-            event["s3_key"] + "_bounds")
+        print("Getting local data stats...")
+        stats = ColumnStats.from_arrays(indices, values)
+        print("Putting stats in S3...")
+        lambda_utils.put_stats_in_s3(
+            s3_client, stats, event["s3_bucket_input"],
+            event["s3_key"] + "_stats")
     elif event["action"] == "LOCAL_SCALE":
         assert "s3_bucket_output" in event, "Must specify output bucket."
-        print("Getting global bounds...")
-        bounds = lambda_utils.get_dict_from_s3(
-            s3_client, event["s3_bucket_input"],
-            event["s3_key"] + "_final_bounds", event["s3_key"])
+        print("Getting global stats...")
+        table = lambda_utils.get_stats_from_s3(
+            s3_client, event["s3_bucket_input"], event["table_key"],
+            event["s3_key"], stats_cls=ColumnTable)
+        print("Scaling data...")
+        scaled = normal_helper.scale_data(indices, values, table)
+        print("Serializing...")
+        serialized = serialize_arrays(indptr, indices, scaled, labels)
+        print("Putting in S3...")
+        return put_chunk(s3_client, event, serialized)
+    return None
+
+
+def quantile_scaling_handler(s3_client, arrays, event):
+    """ Scale by median and interquartile range, or map to quantiles,
+    given the CSR arrays of a chunk """
+    indptr, indices, values, labels = arrays
+    if event["action"] == "LOCAL_SKETCH":
+        print("Sketching local data...")
+        sketches = ColumnSketches.from_arrays(indices, values,
+                                              event["sketch_k"])
+        print("Putting sketches in S3...")
+        lambda_utils.put_stats_in_s3(
+            s3_client, sketches, event["s3_bucket_input"],
+            event["s3_key"] + "_sketch")
+    elif event["action"] == "LOCAL_SCALE":
+        assert "s3_bucket_output" in event, "Must specify output bucket."
+        print("Getting global quantiles...")
+        table = lambda_utils.get_stats_from_s3(
+            s3_client, event["s3_bucket_input"], event["table_key"],
+            event["s3_key"], stats_cls=ColumnTable)
         print("Scaling data...")
-        scaled = normal_helper.scale_data(data, bounds)
+        scaled = quantile_helper.scale_data(indices, values, table,
+                                            event["normalization"])
         print("Serializing...")
-        serialized = serialize_data(scaled, labels)
+        serialized = serialize_arrays(indptr, indices, scaled, labels)
         print("Putting in S3...")
-        s3_client.put_object(
-            Bucket=event["s3_bucket_output"],
-            Key=event["s3_key"], Body=serialized)
+        return put_chunk(s3_client, event, serialized)
+    return None
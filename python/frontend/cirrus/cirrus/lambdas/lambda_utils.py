@@ -1,21 +1,74 @@
 """ Useful functions for lambdas. """
 
-import json
-from utils import Timer
+import threading
 
-def put_dict_in_s3(s3_client, bounds, dest_bucket,
-                   dest_object):
-    """ Put a dictionary in S3. """
-    serialized = json.dumps(bounds)
+import boto3
+import numpy as np
+from column_stats import ColumnStats
+from utils import Timer, LocalS3Client
 
+
+def get_s3_client(event):
+    """ Get an S3 client, or a LocalS3Client if the event was sent by a
+    local executor. """
+    if "local_s3_root" in event:
+        return LocalS3Client(event["local_s3_root"])
+    return boto3.client("s3")
+
+
+def prefetch(fetch, keys):
+    """ Yield (key, fetch(key)) for each key, fetching the next key in a
+    background thread while the caller works on the current one. """
+    keys = list(keys)
+    slots = [None] * len(keys)
+
+    def fetch_into(idx):
+        """ Fetch a key, keeping the result or the exception raised """
+        try:
+            slots[idx] = (fetch(keys[idx]), None)
+        except Exception as exc:
+            slots[idx] = (None, exc)
+
+    thread = None
+    for idx, key in enumerate(keys):
+        if thread is None:
+            fetch_into(idx)
+        else:
+            thread.join()
+        thread = None
+        if idx + 1 < len(keys):
+            thread = threading.Thread(target=fetch_into, args=(idx + 1,))
+            thread.daemon = True
+            thread.start()
+        value, exc = slots[idx]
+        slots[idx] = None
+        if exc is not None:
+            raise exc
+        yield key, value
+
+
+def apply_affine(indices, values, factors):
+    """ Map each value x in column idx to a[idx] * x + b[idx], given dense
+    per-column arrays factors = (a, b), in one multiply-add over all
+    values. Returns an array of the dtype of values. """
+    scale, shift = factors
+    values = np.asarray(values)
+    return (values * scale[indices] + shift[indices]).astype(values.dtype)
+
+
+def put_stats_in_s3(s3_client, stats, dest_bucket, dest_object):
+    """ Put a ColumnStats object, or any object with a serialize method
+    like a ColumnTable, in S3. """
     s3_client.put_object(Bucket=dest_bucket, Key=dest_object,
-                         Body=serialized)
+                         Body=stats.serialize())
+
 
-def get_dict_from_s3(s3_client, s3_bucket, s3_object, chunk):
-    """ Get a dict from S3. """
+def get_stats_from_s3(s3_client, s3_bucket, s3_object, chunk,
+                      stats_cls=ColumnStats):
+    """ Get a ColumnStats object, or an object of stats_cls, from S3. """
     timer = Timer("CHUNK{0}".format(chunk)).set_step("S3")
     b_data = s3_client.get_object(
-        Bucket=s3_bucket, Key=s3_object)["Body"].read().decode("utf-8")
-    print("[CHUNK{0}] Dict is {1} bytes".format(chunk, len(b_data)))
+        Bucket=s3_bucket, Key=s3_object)["Body"].read()
+    print("[CHUNK{0}] Stats are {1} bytes".format(chunk, len(b_data)))
     timer.timestamp()
-    return json.loads(b_data)
+    return stats_cls.deserialize(b_data)
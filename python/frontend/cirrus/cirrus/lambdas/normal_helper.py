@@ -1,36 +1,26 @@
 """ Helper functions for normal scaling. """
 
+import numpy as np
 
-def get_data_ranges(data):
-    """ Return a dict where each index is a list of [E[X^2], mean, n].
-    Assumes labels are being stored. """
-    x_squared_col = {}
-    x_col = {}
-    n_col = {}
-    for row in data:
-        for idx, val in row:
-            if idx not in x_squared_col:
-                x_squared_col[idx] = 0
-                x_col[idx] = 0
-                n_col[idx] = 0
-            x_squared_col[idx] += float(val)**2
-            x_col[idx] += float(val)
-            n_col[idx] += 1
+from lambda_utils import apply_affine
 
-    final = {}
-    for k in x_squared_col:
-        final[k] = [x_squared_col[k], x_col[k], n_col[k]]
-    return final
 
+def scale_factors(table, n_cols):
+    """ Get dense arrays a and b such that normal scaling maps x in column
+    idx to a[idx] * x + b[idx], given a ColumnTable of the mean and std.
+    dev. of each column. Columns with a std. dev. of 0 map to 0. """
+    lookup = table.dense(n_cols)
+    mean = lookup[:, 0]
+    std_dev = lookup[:, 1]
+    varies = std_dev != 0
+    std_dev = np.where(varies, std_dev, 1.0)
+    return np.where(varies, 1.0 / std_dev, 0.0), \
+        np.where(varies, -mean / std_dev, 0.0)
 
-def scale_data(data, global_map):
-    """ Takes g, a map to [std_dev, mean] """
-    for row in data:
-        for j, tup_val in enumerate(row):
-            idx_t, val = tup_val
-            idx = str(idx_t)
-            scaled = 0
-            if global_map[idx][0] != 0:
-                scaled = (val - global_map[idx][1]) / global_map[idx][0]
-            row[j] = (idx, scaled)
-    return data
+
+def scale_data(indices, values, table):
+    """ Scale the values of a CSR chunk to a unit normal range, given a
+    ColumnTable of the mean and std. dev. of each column. Returns the new
+    values array; indices are unchanged. """
+    n_cols = int(indices.max()) + 1 if len(indices) else 0
+    return apply_affine(indices, values, scale_factors(table, n_cols))
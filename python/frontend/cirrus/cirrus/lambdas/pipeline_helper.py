@@ -0,0 +1,133 @@
+""" Helper functions for running a compiled preprocessing pipeline.
+
+A pipeline is a list of stages, each made of stateless steps (feature
+hashing) followed by scaling steps. Scaling steps are affine maps of each
+column, so all of the scaling steps of a stage can be computed from the
+statistics of the data before the first of them. A chunk is passed
+between the steps as its CSR arrays (indptr, indices, values). """
+
+import numpy as np
+
+import feature_hashing_helper
+from column_stats import ColumnStats, ColumnTable
+from utils import Timer
+from lambda_utils import get_stats_from_s3, put_stats_in_s3, apply_affine
+
+EPSILON = .0001 # Epsilon to determine if two floats are equal
+
+
+def step_factors(step, stats):
+    """ Get arrays a and b such that the step maps x to a[i] * x + b[i] in
+    column stats.columns[i] of a dataset with the given stats. """
+    if step["op"] == "MIN_MAX":
+        new_min = step["min_v"]
+        new_max = step["max_v"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            spread = stats.max - stats.min
+            varies = np.abs(spread) > EPSILON
+            scale = np.where(varies, (new_max - new_min) / spread, 0.0)
+            shift = np.where(varies, new_min - stats.min * scale,
+                             (new_min + new_max) / 2.0)
+        return scale, shift
+    if step["op"] == "NORMAL":
+        std_dev = stats.std_dev()
+        varies = std_dev != 0
+        std_dev = np.where(varies, std_dev, 1.0)
+        return np.where(varies, 1.0 / std_dev, 0.0), \
+            np.where(varies, -stats.mean / std_dev, 0.0)
+    raise ValueError("Not a scaling step: {0}".format(step["op"]))
+
+
+def affine_stats(stats, scale, shift):
+    """ Get the stats of a dataset after mapping each x in column
+    stats.columns[i] to scale[i] * x + shift[i]. """
+    mapped = ColumnStats(stats.columns)
+    low = scale * stats.min + shift
+    high = scale * stats.max + shift
+    mapped.min = np.minimum(low, high)
+    mapped.max = np.maximum(low, high)
+    mapped.mean = scale * stats.mean + shift
+    mapped.m2 = scale**2 * stats.m2
+    mapped.count = stats.count.copy()
+    return mapped
+
+
+def scale_factors(stats, steps):
+    """ Compose the scaling steps into a ColumnTable of a and b for each
+    column, mapping each x in the column to a * x + b, given the stats of
+    the data before the first step. """
+    scale = np.ones(len(stats.columns))
+    shift = np.zeros(len(stats.columns))
+    for step in steps:
+        step_scale, step_shift = step_factors(step, stats)
+        stats = affine_stats(stats, step_scale, step_shift)
+        scale, shift = step_scale * scale, step_scale * shift + step_shift
+    return ColumnTable(stats.columns, np.column_stack([scale, shift]))
+
+
+def apply_steps(arrays, steps):
+    """ Apply the stateless steps of a stage to the CSR arrays of a
+    chunk. """
+    for step in steps:
+        if step["op"] == "FEATURE_HASHING":
+            arrays = feature_hashing_helper.hash_arrays(
+                *arrays, columns=step["columns"],
+                n_buckets=step["n_buckets"],
+                **feature_hashing_helper.hash_options(step))
+        else:
+            raise ValueError("Unknown pipeline step: {0}".format(step["op"]))
+    return arrays
+
+
+def apply_factors(arrays, factors):
+    """ Map each value x of a column to a * x + b, given a ColumnTable of
+    a and b for each column. """
+    indptr, indices, values = arrays
+    n_cols = int(indices.max()) + 1 if len(indices) else 0
+    lookup = factors.dense(n_cols)
+    return indptr, indices, apply_affine(indices, values,
+                                         (lookup[:, 0], lookup[:, 1]))
+
+
+def run_stages(s3_client, arrays, stages, stats_keys, event):
+    """ Apply each stage to the CSR arrays of a chunk, reading the global
+    stats of the stages with scaling steps from stats_keys. """
+    for stage, stats_key in zip(stages, stats_keys):
+        arrays = apply_steps(arrays, stage["steps"])
+        stats = get_stats_from_s3(s3_client, event["s3_bucket_input"],
+                                  stats_key, event["s3_key"])
+        arrays = apply_factors(arrays, scale_factors(stats, stage["scale"]))
+    return arrays
+
+
+def stats_pass(s3_client, arrays, event):
+    """ Run the stages up to the last one given, and put the column stats
+    of the data before its scaling steps in S3. """
+    timer = Timer("CHUNK{0}".format(event["s3_key"])).set_step(
+        "Pipeline stats")
+    stages = event["stages"]
+    arrays = run_stages(s3_client, arrays, stages[:-1], event["stats_keys"],
+                        event)
+    _, indices, values = apply_steps(arrays, stages[-1]["steps"])
+    put_stats_in_s3(s3_client, ColumnStats.from_arrays(indices, values),
+                    event["s3_bucket_input"],
+                    chunk_stats_key(event["s3_key"], len(stages) - 1))
+    timer.timestamp()
+
+
+def transform_pass(s3_client, arrays, event):
+    """ Run all of the stages and return the transformed CSR arrays. """
+    timer = Timer("CHUNK{0}".format(event["s3_key"])).set_step(
+        "Pipeline transform")
+    stages = event["stages"]
+    arrays = run_stages(s3_client, arrays, stages[:len(event["stats_keys"])],
+                        event["stats_keys"], event)
+    for stage in stages[len(event["stats_keys"]):]:
+        arrays = apply_steps(arrays, stage["steps"])
+    timer.timestamp()
+    return arrays
+
+
+def chunk_stats_key(chunk, stage):
+    """ Get the key of the column stats of a chunk for a stage. """
+    return "{0}_pipeline_stats_{1}".format(chunk, stage)
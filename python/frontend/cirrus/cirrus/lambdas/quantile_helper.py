@@ -0,0 +1,30 @@
+""" Helper functions for robust and quantile scaling. """
+
+import numpy as np
+
+
+def scale_data(indices, values, table, mode):
+    """ Scale the values of a CSR chunk using the ColumnTable computed by
+    the driver. With mode "ROBUST", each row of the table holds a column's
+    median and interquartile range, and values become (x - median) / IQR.
+    With mode "QUANTILE", each row holds the values at evenly spaced
+    quantiles of a column, and values are mapped to their quantile in
+    [0, 1]. Returns the new values array; indices are unchanged. """
+    values = np.asarray(values)
+    if mode == "ROBUST":
+        n_cols = int(indices.max()) + 1 if len(indices) else 0
+        lookup = table.dense(n_cols)
+        scaled = (values - lookup[indices, 0]) / lookup[indices, 1]
+    elif mode == "QUANTILE":
+        scaled = np.empty(len(values))
+        fractions = np.linspace(0, 1, table.table.shape[1])
+        order = np.argsort(indices, kind="mergesort")
+        columns, starts = np.unique(indices[order], return_index=True)
+        rows = np.searchsorted(table.columns, columns)
+        for row, positions in zip(rows.tolist(),
+                                  np.split(order, starts[1:])):
+            scaled[positions] = np.interp(values[positions], table.table[row],
+                                          fractions)
+    else:
+        raise ValueError("Unknown quantile scaling mode: {0}".format(mode))
+    return scaled.astype(values.dtype)
@@ -5,6 +5,12 @@ pip2 install mmh3
 mmh3_loc=`pip2 show mmh3 | grep Location | awk '{print \$2}'`
 cp -r ${mmh3_loc}/mmh* .
 
+# numpy is used to decode and encode chunks
+pip2 install numpy -t .
+
+# cirrus/utils.py runs map_in_threads on a concurrent.futures thread pool
+pip2 install futures -t .
+
 mkdir temp_files
 cd temp_files
 
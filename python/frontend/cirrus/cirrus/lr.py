@@ -1,10 +1,14 @@
 # Logistic Regression
 
 from core import BaseTask
+from utils import chunks_for_rows
 
 
 class LogisticRegressionTask(BaseTask):
     def __init__(self, *args, **kwargs):
+        # If set, train_set and test_set are ranges of rows rather than of
+        # chunks, looked up in the dataset's manifest
+        self.split_by_rows = kwargs.pop("split_by_rows", False)
         # pass all arguments of init to parent class
         super(LogisticRegressionTask, self).__init__(*args, **kwargs)
 
@@ -18,6 +22,14 @@ class LogisticRegressionTask(BaseTask):
         else:
             grad_t = 0
 
+        train_set = self.train_set
+        test_set = self.test_set
+        if self.split_by_rows:
+            # The workers read whole chunks, so each range of rows becomes
+            # the range of chunks holding it
+            train_set = chunks_for_rows(self.dataset, *self.train_set)
+            test_set = chunks_for_rows(self.dataset, *self.test_set)
+
         config = "load_input_path: /mnt/efs/criteo_kaggle/train.csv \n" + \
                  "load_input_type: csv\n" + \
                  "dataset_format: binary\n" + \
@@ -36,8 +48,8 @@ class LogisticRegressionTask(BaseTask):
                  "s3_bucket: %s \n" % self.dataset + \
                  "use_grad_threshold: %d \n" % grad_t + \
                  "grad_threshold: %lf \n" % self.grad_threshold + \
-                 "train_set: %d-%d \n" % self.train_set + \
-                 "test_set: %d-%d" % self.test_set
+                 "train_set: %d-%d \n" % train_set + \
+                 "test_set: %d-%d" % test_set
         return config
 
 
@@ -61,7 +73,8 @@ def LogisticRegression(
             timeout=60,
             threshold_loss=0,
             experiment_id=0,
-            lambda_size=128
+            lambda_size=128,
+            split_by_rows=False
             ):
     return LogisticRegressionTask(
             n_workers=n_workers,
@@ -82,7 +95,8 @@ def LogisticRegression(
             threshold_loss=threshold_loss,
             progress_callback=progress_callback,
             experiment_id=experiment_id,
-            lambda_size=lambda_size
+            lambda_size=lambda_size,
+            split_by_rows=split_by_rows
            )
 
 
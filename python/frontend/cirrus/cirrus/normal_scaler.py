@@ -1,22 +1,21 @@
 """ Unit normal normalization """
 
-import json
-
-import boto3
-from cirrus.lambda_thread import LambdaThread
-from cirrus.utils import get_all_keys, launch_threads, Timer,\
-    get_redis_creds
+from cirrus.lambda_thread import LambdaThread, get_executor, key_fields
+from cirrus.utils import get_all_chunks, launch_threads, Timer,\
+    get_s3_client, raise_failures, batch_keys, delete_keys, IO_THREADS, \
+    invalidate_manifest, write_output_manifest
+from cirrus.s3_io import get_global_stats
 
 MAX_LAMBDAS = 400
-EPSILON = .0001
+# The mean and std. dev. of each column, from the stats of all chunks
+TABLE_KEY = "normal_global_table"
 
 class LocalRange(LambdaThread):
-    """ Get the mean and standard deviation for this chunk """
-    def __init__(self, s3_key, s3_bucket_input, creds):
+    """ Get the mean and standard deviation for each chunk in a batch """
+    def __init__(self, s3_keys, s3_bucket_input, creds):
         LambdaThread.__init__(self)
         self.lamdba_dict = {
             "s3_bucket_input": s3_bucket_input,
-            "s3_key": s3_key,
             "action": "LOCAL_RANGE",
             "normalization": "NORMAL",
             "redis_host": creds["host"],
@@ -24,107 +23,79 @@ class LocalRange(LambdaThread):
             "redis_password": creds["password"],
             "redis_port": creds["port"]
         }
+        self.lamdba_dict.update(key_fields(s3_keys))
 
 
 class LocalScale(LambdaThread):
     """ Subtract the global mean and divide by the standard
     deviation """
-    def __init__(self, s3_key, s3_bucket_input, s3_bucket_output, creds):
+    def __init__(self, s3_keys, s3_bucket_input, s3_bucket_output, creds):
         LambdaThread.__init__(self)
         self.lamdba_dict = {
             "s3_bucket_input": s3_bucket_input,
-            "s3_key": s3_key,
             "s3_bucket_output": s3_bucket_output,
             "action": "LOCAL_SCALE",
             "normalization": "NORMAL",
             "redis_host": creds["host"],
             "redis_db": creds["db"],
             "redis_password": creds["password"],
-            "redis_port": creds["port"]
+            "redis_port": creds["port"],
+            "table_key": TABLE_KEY
         }
+        self.lamdba_dict.update(key_fields(s3_keys))
 
 
-def normal_scaler(s3_bucket_input, s3_bucket_output, objects=(), dry_run=False):
-    """ Scale the values in a dataset to fit a unit normal distribution. """
+def normal_scaler(s3_bucket_input, s3_bucket_output, objects=(), dry_run=False,
+                  io_threads=IO_THREADS):
+    """ Scale the values in a dataset to fit a unit normal distribution.
+    The driver reads and deletes the stats of the chunks from io_threads
+    threads. """
+    # The output manifest is only written if every chunk is transformed
+    all_chunks = not objects
+    entries = None
     if not objects:
         # Allow user to specify objects, or otherwise get all objects.
-        objects = get_all_keys(s3_bucket_input)
+        entries = get_all_chunks(s3_bucket_input)
+        objects = [entry["Key"] for entry in entries]
+
+    # Each Lambda processes a batch of chunks
+    batches = batch_keys(s3_bucket_input, objects, MAX_LAMBDAS,
+                         entries=entries)
+    # The chunks of the output bucket are about to change
+    invalidate_manifest(s3_bucket_output)
 
     # Calculate bounds for each chunk.
     timer = Timer("NORMAL_SCALING").set_step("LocalRange")
-    creds = get_redis_creds()
-    launch_threads(LocalRange, objects, MAX_LAMBDAS, s3_bucket_input, creds)
+    creds = get_executor().redis_creds()
+    results = launch_threads(LocalRange, batches, MAX_LAMBDAS,
+                             s3_bucket_input, creds)
+    raise_failures(results, "LocalRange")
 
-    timer.timestamp().set_step("Creating the global map")
+    timer.timestamp().set_step("Creating the global stats")
 
-    client = boto3.client("s3")
-    f_ranges = get_global_map(s3_bucket_input, objects, client)
+    client = get_s3_client()
+    keys = [str(i) + "_stats" for i in objects]
+    stats = get_global_stats(s3_bucket_input, keys, io_threads)
 
-    timer.timestamp().set_step("Putting local maps")
+    timer.timestamp().set_step("Putting the global table")
 
-    s3_resource = boto3.resource("s3")
-    update_local_maps(s3_bucket_input, objects, f_ranges, client,
-                      s3_resource)
+    client.put_object(Bucket=s3_bucket_input, Key=TABLE_KEY,
+                      Body=stats.normal_table().serialize())
+
+    timer.timestamp().set_step("Deleting the chunk stats")
+    delete_keys(s3_bucket_input, keys, io_threads)
 
     timer.timestamp().set_step("Local scaling")
     if not dry_run:
         # Scale the chunks and put them in the output bucket.
-        launch_threads(LocalScale, objects, MAX_LAMBDAS,
-                       s3_bucket_input, s3_bucket_output, creds)
+        results = launch_threads(LocalScale, batches, MAX_LAMBDAS,
+                                 s3_bucket_input, s3_bucket_output, creds)
+        raise_failures(results, "LocalScale")
+        write_output_manifest(s3_bucket_output, objects, results, all_chunks)
 
-    timer.timestamp().set_step("Deleting local maps")
+    timer.timestamp().set_step("Deleting the global table")
 
     # Delete any intermediary keys.
-    for i in objects:
-        s3_resource.Object(s3_bucket_input, str(i) + "_final_bounds").delete()
+    client.delete_object(Bucket=s3_bucket_input, Key=TABLE_KEY)
 
     timer.timestamp()
-
-
-def get_global_map(s3_bucket_input, objects, client):
-    """ Aggregate the sample means, std. devs., etc. to get the global map. """
-    f_ranges = {}
-    for i in objects:
-        obj = client.get_object(Bucket=s3_bucket_input,
-                                Key=str(i) + "_bounds")["Body"].read()
-        local_map = json.loads(obj.decode("utf-8"))
-        for idx in local_map:
-            sample_x_squared, sample_x, n_samples = local_map[idx]
-            if idx not in f_ranges:
-                f_ranges[idx] = [
-                    sample_x_squared,
-                    sample_x,
-                    n_samples]
-            else:
-                f_ranges[idx][0] += sample_x_squared
-                f_ranges[idx][1] += sample_x
-                f_ranges[idx][2] += n_samples
-    return f_ranges
-
-
-def update_local_maps(s3_bucket_input, objects, f_ranges,
-                      s3_client, s3_resource):
-    """ Update the local maps of means, std. devs., etc. """
-    for i in objects:
-        s3_obj = s3_resource.Object(s3_bucket_input, str(i) + "_bounds")
-        obj = s3_obj.get()["Body"].read()
-        local_map = json.loads(obj.decode("utf-8"))
-        for idx in local_map:
-            mean_x_sq = f_ranges[idx][0] / float(f_ranges[idx][2])
-            mean = f_ranges[idx][1] / float(f_ranges[idx][2])
-            try:
-                diff = mean_x_sq - mean**2
-                std_dev = 0
-                if abs(diff) > EPSILON:
-                    std_dev = (diff)**(.5)
-                local_map[idx] = [std_dev, mean]
-            except Exception as exc:
-                print(exc)
-                print("Index: {0}, E[X^2]: {1}, E[X]^2: {2}".format(idx,
-                                                                    mean_x_sq,
-                                                                    mean**2))
-                raise exc
-        serialized = json.dumps(local_map)
-        s3_client.put_object(Bucket=s3_bucket_input,
-                             Key=str(i) + "_final_bounds", Body=serialized)
-        s3_obj.delete()
@@ -0,0 +1,134 @@
+""" Run several preprocessing steps in as few passes over the data as
+possible """
+
+from cirrus.lambda_thread import LambdaThread, get_executor, key_fields
+from cirrus.utils import get_all_chunks, launch_threads, Timer, \
+    get_s3_client, raise_failures, batch_keys, delete_keys, IO_THREADS, \
+    invalidate_manifest, write_output_manifest
+from cirrus.s3_io import get_global_stats
+
+MAX_LAMBDAS = 400
+SCALING_STEPS = ("MIN_MAX", "NORMAL")
+STATELESS_STEPS = ("FEATURE_HASHING",)
+
+
+class PipelineThread(LambdaThread):
+    """ Run a pass of a compiled pipeline on a batch of chunks """
+    def __init__(self, s3_keys, s3_bucket_input, s3_bucket_output, action,
+                 stages, stats_keys, creds):
+        LambdaThread.__init__(self)
+        self.lamdba_dict = {
+            "s3_bucket_input": s3_bucket_input,
+            "s3_bucket_output": s3_bucket_output,
+            "action": action,
+            "stages": stages,
+            "stats_keys": stats_keys,
+            "use_redis": "1",
+            "redis_host": creds["host"],
+            "redis_db": creds["db"],
+            "redis_password": creds["password"],
+            "redis_port": creds["port"]
+        }
+        self.lamdba_dict.update(key_fields(s3_keys))
+
+
+def hashing_step(columns, n_buckets, signed=False, n_hashes=1,
+                 keep_values=False, crosses=()):
+    """ A step that hashes the given columns into n_buckets buckets. See
+    feature_hashing.feature_hashing for the options. """
+    return {"op": "FEATURE_HASHING", "columns": list(columns),
+            "n_buckets": n_buckets, "signed": signed, "n_hashes": n_hashes,
+            "keep_values": keep_values,
+            "crosses": [[int(a), int(b)] for a, b in crosses]}
+
+
+def min_max_step(lower, upper):
+    """ A step that scales each column to the range [lower, upper] """
+    return {"op": "MIN_MAX", "min_v": lower, "max_v": upper}
+
+
+def normal_step():
+    """ A step that scales each column to a unit normal distribution """
+    return {"op": "NORMAL"}
+
+
+def compile_steps(steps):
+    """ Group a list of steps into stages of stateless steps followed by
+    scaling steps. All of the scaling steps of a stage are computed from
+    one statistics pass, so only a scaling step that comes after a
+    stateless step that comes after a scaling step needs another pass. """
+    stages = [{"steps": [], "scale": []}]
+    for step in steps:
+        if step["op"] in SCALING_STEPS:
+            stages[-1]["scale"].append(step)
+        elif step["op"] in STATELESS_STEPS:
+            if stages[-1]["scale"]:
+                stages.append({"steps": [], "scale": []})
+            stages[-1]["steps"].append(step)
+        else:
+            raise ValueError("Unknown pipeline step: {0}".format(step["op"]))
+    return stages
+
+
+def pipeline(s3_bucket_input, s3_bucket_output, steps, objects=(),
+             io_threads=IO_THREADS):
+    """ Apply a list of steps to a dataset. Each chunk is read once per
+    statistics pass, usually once, and once more to be transformed, and
+    written only once. The driver reads and deletes the stats of the
+    chunks from io_threads threads. """
+    # The output manifest is only written if every chunk is transformed
+    all_chunks = not objects
+    entries = None
+    if not objects:
+        # Allow user to specify objects, or otherwise get all objects.
+        entries = get_all_chunks(s3_bucket_input)
+        objects = [entry["Key"] for entry in entries]
+
+    stages = compile_steps(steps)
+    timer = Timer("PIPELINE")
+    client = get_s3_client()
+    creds = get_executor().redis_creds()
+    batches = batch_keys(s3_bucket_input, objects, MAX_LAMBDAS,
+                         entries=entries)
+    # The chunks of the output bucket are about to change
+    invalidate_manifest(s3_bucket_output)
+
+    stats_keys = []
+    for stage, stage_steps in enumerate(stages):
+        if not stage_steps["scale"]:
+            continue
+        timer.set_step("Statistics pass {0}".format(stage))
+        results = launch_threads(PipelineThread, batches, MAX_LAMBDAS,
+                                 s3_bucket_input, s3_bucket_output,
+                                 "PIPELINE_STATS", stages[:stage + 1],
+                                 stats_keys, creds)
+        raise_failures(results, "PipelineStats")
+        timer.timestamp().set_step("Merging statistics {0}".format(stage))
+        stats_keys.append(put_global_stats(s3_bucket_input, objects, stage,
+                                           client, io_threads))
+        timer.timestamp()
+
+    timer.set_step("Transform pass")
+    results = launch_threads(PipelineThread, batches, MAX_LAMBDAS,
+                             s3_bucket_input, s3_bucket_output,
+                             "PIPELINE_TRANSFORM", stages, stats_keys, creds)
+    raise_failures(results, "PipelineTransform")
+    write_output_manifest(s3_bucket_output, objects, results, all_chunks)
+
+    timer.timestamp().set_step("Deleting statistics")
+    delete_keys(s3_bucket_input, stats_keys, io_threads)
+    timer.timestamp()
+    timer.global_timestamp()
+
+
+def put_global_stats(s3_bucket_input, objects, stage, client,
+                     io_threads=IO_THREADS):
+    """ Merge the column stats of each chunk into one object, deleting the
+    stats of each chunk. Returns the key of the merged stats. """
+    keys = ["{0}_pipeline_stats_{1}".format(i, stage) for i in objects]
+    stats = get_global_stats(s3_bucket_input, keys, io_threads)
+    key = "pipeline_stats_{0}".format(stage)
+    client.put_object(Bucket=s3_bucket_input, Key=key,
+                      Body=stats.serialize())
+    delete_keys(s3_bucket_input, keys, io_threads)
+    return key
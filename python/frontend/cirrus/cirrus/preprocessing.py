@@ -1,15 +1,22 @@
 """ Preprocessing module for Cirrus """
 
 from enum import Enum
+from itertools import islice
 import sklearn.datasets
 
-import boto3
+import numpy as np
 import cirrus.feature_hashing as feature_hashing
 import cirrus.min_max_scaler as min_max_scaler
 import cirrus.normal_scaler as normal_scaler
-from cirrus.utils import serialize_data, Timer
+import cirrus.pipeline as pipeline
+import cirrus.quantile_scaler as quantile_scaler
+from cirrus.s3_io import ParallelUploader, UPLOAD_THREADS, \
+    MAX_INFLIGHT_CHUNKS
+from cirrus.utils import serialize_arrays, serialize_data, Timer, \
+    write_manifest, invalidate_manifest
 
 ROWS_PER_CHUNK = 50000
+READ_BLOCK_BYTES = 1 << 24
 
 
 class Normalization(Enum):
@@ -17,6 +24,8 @@ class Normalization(Enum):
     Use with the Preprocessing.normalize function. """
     MIN_MAX = 1,
     NORMAL = 2
+    QUANTILE = 3
+    ROBUST = 4
 
 
 class Preprocessing(object):
@@ -31,6 +40,10 @@ class Preprocessing(object):
                                 Normalization.MIN_MAX, 0.0, 1.0)
         Preprocessing.normalize(s3_bucket_input, s3_bucket_output,
                                 Normalization.NORMAL)
+        Preprocessing.normalize(s3_bucket_input, s3_bucket_output,
+                                Normalization.QUANTILE)
+        Preprocessing.normalize(s3_bucket_input, s3_bucket_output,
+                                Normalization.ROBUST)
         """
         if normalization_type == Normalization.MIN_MAX:
             assert len(args) >= 2, "Must specify min and max."
@@ -42,21 +55,87 @@ class Preprocessing(object):
         elif normalization_type == Normalization.NORMAL:
             normal_scaler.normal_scaler(s3_bucket_input, s3_bucket_output,
                                         *args)
+        elif normalization_type == Normalization.QUANTILE:
+            quantile_scaler.quantile_scaler(s3_bucket_input,
+                                            s3_bucket_output, *args)
+        elif normalization_type == Normalization.ROBUST:
+            quantile_scaler.robust_scaler(s3_bucket_input, s3_bucket_output,
+                                          *args)
 
     @staticmethod
     def feature_hashing(s3_bucket_input, s3_bucket_output, columns,
-                        n_buckets, objects=()):
+                        n_buckets, objects=(), cache_size=None, hot_values=(),
+                        signed=False, n_hashes=1, keep_values=False,
+                        crosses=()):
         """ Perform feature hashing on the specified columns.
-        All other columns are untouched. """
+        All other columns are untouched. Hashes of repeated values are
+        cached by the Lambdas. For signed and k-way hashing, keeping the
+        hashed columns and crosses, see feature_hashing.feature_hashing. """
+        feature_hashing.feature_hashing(
+            s3_bucket_input, s3_bucket_output, columns, n_buckets, objects,
+            cache_size, hot_values, signed, n_hashes, keep_values, crosses)
+
+    @staticmethod
+    def feature_crosses(s3_bucket_input, s3_bucket_output, pairs, n_buckets,
+                        objects=(), signed=False, n_hashes=1):
+        """ Hash the pair of values of each pair of columns in pairs into
+        n_buckets buckets. All columns are kept, like the unhashed columns
+        of feature_hashing. To also hash single columns in the same pass,
+        pass crosses to feature_hashing. """
         feature_hashing.feature_hashing(
-            s3_bucket_input, s3_bucket_output, columns, n_buckets, objects)
+            s3_bucket_input, s3_bucket_output, [], n_buckets, objects,
+            signed=signed, n_hashes=n_hashes, crosses=pairs)
 
     @staticmethod
-    def load_libsvm(path, s3_bucket):
-        """ Load a libsvm file into S3 in the specified bucket. """
-        client = boto3.client("s3")
+    def pipeline(s3_bucket_input, s3_bucket_output, steps, objects=()):
+        """ Apply several steps to a dataset in one statistics pass and one
+        transform pass, without writing intermediate datasets. Usage:
+        Preprocessing.pipeline(s3_bucket_input, s3_bucket_output, [
+            ("feature_hashing", columns, n_buckets[, options]),
+            ("normalize", Normalization.MIN_MAX, 0.0, 1.0)])
+        A scaling step after a hashing step after a scaling step needs
+        another statistics pass. """
+        compiled = []
+        for step in steps:
+            if step[0] == "feature_hashing":
+                compiled.append(pipeline.hashing_step(
+                    step[1], step[2], **(step[3] if len(step) > 3 else {})))
+            elif step[0] == "normalize" and step[1] == Normalization.MIN_MAX:
+                assert len(step) >= 4, "Must specify min and max."
+                compiled.append(pipeline.min_max_step(step[2], step[3]))
+            elif step[0] == "normalize" and step[1] == Normalization.NORMAL:
+                compiled.append(pipeline.normal_step())
+            else:
+                raise ValueError("Unknown pipeline step: {0}".format(step))
+        pipeline.pipeline(s3_bucket_input, s3_bucket_output, compiled,
+                          objects)
+
+    @staticmethod
+    def load_libsvm(path, s3_bucket, streaming=False, zero_based="auto",
+                    upload_threads=UPLOAD_THREADS,
+                    max_inflight=MAX_INFLIGHT_CHUNKS, column_stats=False,
+                    compression=None, columnar=False):
+        """ Load a libsvm file into S3 in the specified bucket.
+        If streaming is set, the file is read ROWS_PER_CHUNK rows at a time,
+        so memory use does not grow with the size of the file.
+        Chunks are uploaded by upload_threads threads while the next ones
+        are being encoded, with at most max_inflight chunks waiting.
+        The bucket's manifest records the rows, nonzero values and checksum
+        of each chunk, and the bounds of its columns if column_stats is
+        set. If compression names a codec in utils.CODECS, chunks are
+        written compressed with it. If columnar is set, chunks are written
+        in the columnar format of utils.serialize_columnar. """
+        if streaming:
+            Preprocessing.load_libsvm_streaming(
+                path, s3_bucket, zero_based, upload_threads, max_inflight,
+                column_stats, compression, columnar)
+            return
+        invalidate_manifest(s3_bucket)
+        uploader = ParallelUploader(s3_bucket, upload_threads, max_inflight,
+                                    column_stats=column_stats)
         timer = Timer("LOAD_LIBSVM").set_step("Reading file")
-        data = sklearn.datasets.load_svmlight_file(path)[0]
+        data = sklearn.datasets.load_svmlight_file(
+            path, zero_based=zero_based)[0]
         timer.timestamp().set_step("Starting loop")
         batch = [0] * ROWS_PER_CHUNK
         batch_num = 1
@@ -77,9 +156,9 @@ class Preprocessing(object):
                 # Put the lines in S3, 50000 lines at a time
                 timer.timestamp().set_step("Writing batch of {0} to S3"
                                            .format(ROWS_PER_CHUNK))
-                serialized = serialize_data(batch)
-                client.put_object(Bucket=s3_bucket, Key=str(batch_num),
-                                  Body=serialized)
+                serialized = serialize_data(batch, compression=compression,
+                                            columnar=columnar)
+                uploader.put(str(batch_num), serialized)
                 batch = [0] * ROWS_PER_CHUNK
                 batch_num += 1
                 batch_size = 0
@@ -90,9 +169,119 @@ class Preprocessing(object):
             timer.set_step("Trimming final batch")
             batch = batch[0:batch_size]
             timer.timestamp().set_step("Writing final batch to S3")
-            serialized = serialize_data(batch)
-            client.put_object(Bucket=s3_bucket, Key=str(batch_num),
-                              Body=serialized)
+            serialized = serialize_data(batch, compression=compression,
+                                        columnar=columnar)
+            uploader.put(str(batch_num), serialized)
             timer.timestamp()
 
-        timer.global_timestamp()
+        timer.set_step("Waiting for uploads")
+        uploader.close()
+        timer.timestamp().set_step("Writing the manifest")
+        write_manifest(s3_bucket, uploader.objects)
+        timer.timestamp().global_timestamp()
+
+    @staticmethod
+    def load_libsvm_streaming(path, s3_bucket, zero_based="auto",
+                              upload_threads=UPLOAD_THREADS,
+                              max_inflight=MAX_INFLIGHT_CHUNKS,
+                              column_stats=False, compression=None,
+                              columnar=False):
+        """ Load a libsvm file into S3 one chunk at a time. Each chunk is
+        encoded straight from its CSR arrays, as in load_libsvm. """
+        timer = Timer("LOAD_LIBSVM").set_step("Reading chunk 1")
+        batch_num = 1
+        invalidate_manifest(s3_bucket)
+        with ParallelUploader(s3_bucket, upload_threads, max_inflight,
+                              column_stats=column_stats) as uploader:
+            for indptr, indices, values, _ in stream_libsvm(
+                    path, ROWS_PER_CHUNK, zero_based):
+                timer.timestamp().set_step("Queueing chunk {0} for upload"
+                                           .format(batch_num))
+                # Labels are not written, as in load_libsvm
+                uploader.put(str(batch_num),
+                             serialize_arrays(indptr, indices, values,
+                                              compression=compression,
+                                              columnar=columnar))
+                batch_num += 1
+                timer.timestamp().set_step("Reading chunk {0}"
+                                           .format(batch_num))
+            timer.set_step("Waiting for uploads")
+        timer.timestamp().set_step("Writing the manifest")
+        write_manifest(s3_bucket, uploader.objects)
+        timer.timestamp().global_timestamp()
+
+
+def stream_libsvm(path, rows_per_chunk=ROWS_PER_CHUNK, zero_based="auto"):
+    """ Read a libsvm file rows_per_chunk rows at a time, yielding CSR
+    arrays (indptr, indices, values, labels) for each chunk.
+
+    As with sklearn.datasets.load_svmlight_file, zero_based="auto" treats
+    the indices as one-based unless some index in the file is 0. This
+    costs an extra scan of the file, so pass a boolean when the base is
+    known. Column indices are sorted within each row. """
+    if zero_based == "auto":
+        zero_based = _has_zero_index(path)
+    with open(path, "rb") as f_handle:
+        while True:
+            lines = list(islice(f_handle, rows_per_chunk))
+            if not lines:
+                break
+            yield _parse_libsvm_lines(lines, zero_based)
+
+
+def _has_zero_index(path):
+    """ Check if any feature in a libsvm file has index 0. """
+    tail = b""
+    with open(path, "rb") as f_handle:
+        while True:
+            block = f_handle.read(READ_BLOCK_BYTES)
+            if not block:
+                return False
+            # Keep the end of the last block in case a token spans two blocks
+            block = tail + block
+            if b" 0:" in block or b"\t0:" in block:
+                return True
+            tail = block[-2:]
+
+
+def _parse_libsvm_lines(lines, zero_based):
+    """ Parse libsvm lines into CSR arrays (indptr, indices, values,
+    labels). """
+    labels = []
+    counts = []
+    tokens = []
+    for line in lines:
+        if b"#" in line:
+            line = line[:line.index(b"#")]
+        parts = line.split()
+        if not parts:
+            continue
+        features = parts[1:]
+        if features and features[0].startswith(b"qid:"):
+            features = features[1:]
+        labels.append(parts[0])
+        counts.append(len(features))
+        tokens.extend(features)
+
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    pairs = np.fromstring(b" ".join(tokens).replace(b":", b" "),
+                          dtype=np.float64, sep=" ")
+    if len(pairs) != 2 * indptr[-1]:
+        raise ValueError("Could not parse {0} features from libsvm rows"
+                         .format(indptr[-1]))
+    indices = pairs[0::2].astype(np.int64)
+    values = pairs[1::2].astype(np.float32)
+    if not zero_based:
+        indices -= 1
+
+    # Sort the columns within each row, if the file didn't
+    row_ids = np.repeat(np.arange(len(counts)), counts)
+    unsorted = np.diff(indices) < 0
+    if unsorted.any() and (row_ids[1:][unsorted] ==
+                           row_ids[:-1][unsorted]).any():
+        order = np.lexsort((indices, row_ids))
+        indices = indices[order]
+        values = values[order]
+    return indptr, indices.astype(np.int32), values, \
+        np.array(labels, dtype=np.float32)
@@ -0,0 +1,132 @@
+""" Robust and quantile normalization """
+
+import numpy as np
+from cirrus.column_stats import ColumnSketches, ColumnTable, DEFAULT_K
+from cirrus.lambda_thread import LambdaThread, get_executor, key_fields
+from cirrus.utils import get_all_chunks, launch_threads, Timer,\
+    get_s3_client, raise_failures, batch_keys, delete_keys, IO_THREADS, \
+    invalidate_manifest, write_output_manifest
+from cirrus.s3_io import get_global_stats
+
+MAX_LAMBDAS = 400
+N_QUANTILES = 100
+# The table of quantiles that the chunks are scaled with
+TABLE_KEY = "quantile_global_table"
+
+
+class LocalSketch(LambdaThread):
+    """ Sketch the quantiles of each column for each chunk in a batch """
+    def __init__(self, s3_keys, s3_bucket_input, mode, sketch_k, creds):
+        LambdaThread.__init__(self)
+        self.lamdba_dict = {
+            "s3_bucket_input": s3_bucket_input,
+            "action": "LOCAL_SKETCH",
+            "normalization": mode,
+            "sketch_k": sketch_k,
+            "redis_host": creds["host"],
+            "redis_db": creds["db"],
+            "redis_password": creds["password"],
+            "redis_port": creds["port"]
+        }
+        self.lamdba_dict.update(key_fields(s3_keys))
+
+
+class LocalScale(LambdaThread):
+    """ Scale a batch of chunks using the global quantiles """
+    def __init__(self, s3_keys, s3_bucket_input, s3_bucket_output, mode,
+                 creds):
+        LambdaThread.__init__(self)
+        self.lamdba_dict = {
+            "s3_bucket_input": s3_bucket_input,
+            "s3_bucket_output": s3_bucket_output,
+            "action": "LOCAL_SCALE",
+            "normalization": mode,
+            "redis_host": creds["host"],
+            "redis_db": creds["db"],
+            "redis_password": creds["password"],
+            "redis_port": creds["port"],
+            "table_key": TABLE_KEY
+        }
+        self.lamdba_dict.update(key_fields(s3_keys))
+
+
+def robust_scaler(s3_bucket_input, s3_bucket_output, objects=(),
+                  dry_run=False, sketch_k=DEFAULT_K, io_threads=IO_THREADS):
+    """ Scale each column by subtracting its median and dividing by its
+    interquartile range, which outliers barely move. """
+    quantile_scaler(s3_bucket_input, s3_bucket_output, objects, dry_run,
+                    sketch_k, mode="ROBUST", io_threads=io_threads)
+
+
+def quantile_scaler(s3_bucket_input, s3_bucket_output, objects=(),
+                    dry_run=False, sketch_k=DEFAULT_K,
+                    n_quantiles=N_QUANTILES, mode="QUANTILE",
+                    io_threads=IO_THREADS):
+    """ Map each value to its approximate quantile in its column, in
+    [0, 1]. The driver reads and deletes the sketches of the chunks from
+    io_threads threads. """
+    # The output manifest is only written if every chunk is transformed
+    all_chunks = not objects
+    entries = None
+    if not objects:
+        # Allow user to specify objects, or otherwise get all objects.
+        entries = get_all_chunks(s3_bucket_input)
+        objects = [entry["Key"] for entry in entries]
+
+    # Each Lambda processes a batch of chunks
+    batches = batch_keys(s3_bucket_input, objects, MAX_LAMBDAS,
+                         entries=entries)
+    # The chunks of the output bucket are about to change
+    invalidate_manifest(s3_bucket_output)
+
+    # Sketch each chunk.
+    timer = Timer(mode).set_step("LocalSketch")
+    creds = get_executor().redis_creds()
+    results = launch_threads(LocalSketch, batches, MAX_LAMBDAS,
+                             s3_bucket_input, mode, sketch_k, creds)
+    raise_failures(results, "LocalSketch")
+
+    timer.timestamp().set_step("Merging the sketches")
+
+    client = get_s3_client()
+    keys = [str(i) + "_sketch" for i in objects]
+    sketches = get_global_stats(s3_bucket_input, keys, io_threads,
+                                stats_cls=ColumnSketches)
+
+    timer.timestamp().set_step("Putting the global quantiles")
+
+    if mode == "ROBUST":
+        table = robust_table(sketches)
+    else:
+        table = sketches.quantiles(np.linspace(0, 1, n_quantiles + 1))
+    client.put_object(Bucket=s3_bucket_input, Key=TABLE_KEY,
+                      Body=table.serialize())
+
+    timer.timestamp().set_step("Deleting the chunk sketches")
+    delete_keys(s3_bucket_input, keys, io_threads)
+
+    timer.timestamp().set_step("Local scaling")
+    if not dry_run:
+        # Scale the chunks and put them in the output bucket.
+        results = launch_threads(LocalScale, batches, MAX_LAMBDAS,
+                                 s3_bucket_input, s3_bucket_output, mode,
+                                 creds)
+        raise_failures(results, "LocalScale")
+        write_output_manifest(s3_bucket_output, objects, results, all_chunks)
+
+    timer.timestamp().set_step("Deleting the global quantiles")
+
+    # Delete any intermediary keys.
+    client.delete_object(Bucket=s3_bucket_input, Key=TABLE_KEY)
+
+    timer.timestamp()
+
+
+def robust_table(sketches):
+    """ Get a ColumnTable of the median and interquartile range of each
+    column that has values. Columns with an interquartile range of 0 are
+    only centered. """
+    quartiles = sketches.quantiles([.25, .5, .75])
+    spread = quartiles.table[:, 2] - quartiles.table[:, 0]
+    return ColumnTable(quartiles.columns, np.column_stack(
+        [quartiles.table[:, 1], np.where(spread > 0, spread, 1.0)]))
@@ -0,0 +1,136 @@
+""" Concurrent S3 transfers for the preprocessing drivers """
+
+import io
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from cirrus.column_stats import ColumnStats
+from cirrus.utils import get_s3_client, map_in_threads, raise_failures, \
+    chunk_entry, IO_THREADS
+
+UPLOAD_THREADS = 8
+MAX_INFLIGHT_CHUNKS = 16
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+
+
+class ParallelUploader(object):
+    """ Upload objects to an S3 bucket from a bounded pool of threads.
+
+    put() hands an object to the pool and returns immediately, unless
+    max_inflight objects are already waiting to be uploaded, in which case
+    it blocks until one of them has been sent. This lets the caller keep
+    encoding the next object while the previous ones are on the network,
+    with memory bounded by max_inflight objects. Objects of at least
+    multipart_threshold bytes are sent as multipart uploads. Objects are
+    chunks, whose chunk_entry is recorded for write_manifest, with the
+    bounds of each column if column_stats is set. """
+
+    def __init__(self, bucket, num_threads=UPLOAD_THREADS,
+                 max_inflight=MAX_INFLIGHT_CHUNKS,
+                 multipart_threshold=MULTIPART_THRESHOLD,
+                 multipart_chunksize=MULTIPART_CHUNKSIZE,
+                 column_stats=False):
+        self.bucket = bucket
+        self.column_stats = column_stats
+        self.multipart_threshold = multipart_threshold
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize)
+        # Multipart uploads use several connections each
+        self.client = get_s3_client(config=Config(
+            max_pool_connections=num_threads *
+            (self.transfer_config.max_request_concurrency + 1)))
+        self.pending = queue.Queue(maxsize=max_inflight)
+        self.errors = []
+        self.uploaded = 0
+        # The chunk_entry of each object uploaded
+        self.objects = []
+        self.lock = threading.Lock()
+        self.threads = []
+        for _ in range(num_threads):
+            thread = threading.Thread(target=self._upload_loop)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def put(self, key, body):
+        """ Queue an object for upload, blocking while the queue is full.
+        Raises the first upload error seen so far, if any. """
+        self._raise_errors()
+        self.pending.put((key, body))
+
+    def close(self, raise_errors=True):
+        """ Wait for all queued objects to be uploaded and stop the
+        threads. """
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if raise_errors:
+            self._raise_errors()
+
+    def _raise_errors(self):
+        with self.lock:
+            if self.errors:
+                key, exc = self.errors[0]
+                raise IOError("Uploading {0} to bucket {1} failed: {2}"
+                              .format(key, self.bucket, exc))
+
+    def _upload_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            key, body = item
+            try:
+                entry = chunk_entry(key, body, self._upload(key, body),
+                                    self.column_stats)
+                with self.lock:
+                    self.uploaded += 1
+                    self.objects.append(entry)
+            except Exception as exc:
+                with self.lock:
+                    self.errors.append((key, exc))
+
+    def _upload(self, key, body):
+        """ Upload an object, returning its ETag """
+        if len(body) < self.multipart_threshold:
+            return self.client.put_object(Bucket=self.bucket, Key=key,
+                                          Body=body)["ETag"]
+        self.client.upload_fileobj(io.BytesIO(body), self.bucket, key,
+                                   Config=self.transfer_config)
+        return self.client.head_object(Bucket=self.bucket, Key=key)["ETag"]
+
+
+def get_global_stats(bucket, keys, num_threads=IO_THREADS,
+                     stats_cls=ColumnStats):
+    """ Read the ColumnStats objects stored at keys in parallel, and merge
+    them with a tree reduction. stats_cls can be any class with
+    deserialize and merge_all methods, like ColumnSketches. """
+    client = get_s3_client()
+
+    def read(key):
+        """ Read one ColumnStats object """
+        return stats_cls.deserialize(
+            client.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+    def parallel_map(func, items):
+        """ Map func over items on num_threads threads """
+        results = map_in_threads(func, items, num_threads)
+        raise_failures(results, "Merging column stats")
+        return [res.result for res in results]
+
+    return stats_cls.merge_all(parallel_map(read, keys), parallel_map)
@@ -51,9 +51,7 @@ def jittery_exponential_backoff(exception_names, initial_wait=0.1,
                 except Exception as e:
                     name = type(e).__name__
                     if name in exception_names and retries < max_retries:
-                        wait_min = (1 - MAX_JITTER_FACTOR) * wait
-                        wait_max = (1 + MAX_JITTER_FACTOR) * wait
-                        jittered_wait = random.uniform(wait_min, wait_max)
+                        jittered_wait = jitter(wait)
                         log.debug("jittery_exponential_backoff: Waiting %fs."
                                   % jittered_wait)
                         time.sleep(jittered_wait)
@@ -67,6 +65,20 @@ def jittery_exponential_backoff(exception_names, initial_wait=0.1,
     return decorator
 
 
+def jitter(wait):
+    """Jitters a wait by up to `MAX_JITTER_FACTOR` in either direction.
+
+    Args:
+        wait (float): The wait, in seconds.
+
+    Returns:
+        float: The jittered wait, in seconds.
+    """
+    wait_min = (1 - MAX_JITTER_FACTOR) * wait
+    wait_max = (1 + MAX_JITTER_FACTOR) * wait
+    return random.uniform(wait_min, wait_max)
+
+
 def set_logging_handler():
     """Set up a logging handler for Cirrus' logs."""
     handler = logging.StreamHandler(sys.stdout)
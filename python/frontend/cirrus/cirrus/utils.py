@@ -1,17 +1,84 @@
 """ Utility functions for Cirrus """
 
+import hashlib
+import json
+import mmap
+import os
 import random
 import struct
+import tempfile
+import threading
 import time
-from collections import deque
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from urllib import quote, unquote
+except ImportError:
+    from urllib.parse import quote, unquote
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import numpy as np
 from redis import StrictRedis
 import toml
+# Optional chunk compression codecs; zlib is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 DEFAULT_LABEL = struct.pack("i", 0)
+# The first word of a compressed chunk, where an uncompressed chunk holds
+# its number of bytes, which is never negative
+COMPRESSED_FLAG = -1
+# The flag, number of rows, codec id and number of values of a compressed
+# chunk
+COMPRESSED_HEADER = struct.Struct("<iiiq")
+# The id of each codec in the header of a compressed chunk
+CODECS = {"zlib": 1, "zstd": 2, "lz4": 3}
+# The first word of a columnar chunk
+COLUMNAR_FLAG = -2
+# The flag, number of rows and number of values of a columnar chunk
+COLUMNAR_HEADER = struct.Struct("<iiq")
 REDIS_TOML = "redis.toml"
 
+# If set, S3 requests go to a LocalS3Client rooted at this directory
+LOCAL_S3_ROOT = None
+
+# Enough connections for one client to be shared by all of the threads
+# launched by launch_threads
+MAX_POOL_CONNECTIONS = 400
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+# The threads map_in_threads runs on, kept across calls; see get_thread_pool
+THREAD_POOL = None
+THREAD_POOL_LOCK = threading.Lock()
+
+# Bytes of chunks read by one Lambda invocation, for batch_keys
+BATCH_BYTES = 64 * 1024 * 1024
+
+# The default number of threads the drivers list, read and delete objects
+# with
+IO_THREADS = 32
+# The most keys a DeleteObjects request can hold
+DELETE_BATCH = 1000
+# Chunk keys are decimal numbers, so splitting the key space at each
+# leading digit balances parallel listings
+LIST_SPLIT_KEYS = tuple("123456789")
+# The key of the manifest of a bucket's chunks; see write_manifest
+MANIFEST_KEY = "manifest"
+# Manifest entries keyed by (bucket, ETag of the manifest)
+LISTINGS = {}
+LISTINGS_LOCK = threading.Lock()
+
+ChunkResult = namedtuple("ChunkResult", ["key", "result", "exception"])
+
 class Timer(object):
     """ A class to time functions. """
 
@@ -49,6 +116,11 @@ class Timer(object):
                        .format(self.step, time.time() - self.last_time))
         return self
 
+    def report(self, name, value):
+        """ Print a named value, like a counter, next to the timings """
+        self.__print__("{0}: {1}".format(name, value))
+        return self
+
 
 def prefix_print(prefix):
     """ Get a function that prints with a prefix. """
@@ -73,46 +145,245 @@ def get_redis_creds():
     }
 
 
-def wipe_redis():
+def wipe_redis(creds=None):
     """ Wipe all keys from Redis """
-    creds = get_redis_creds()
+    if creds is None:
+        creds = get_redis_creds()
     redis_client = StrictRedis(
         host=creds["host"], port=creds["port"], password=creds["password"],
         db=creds["db"])
     redis_client.flushdb()
 
 
+def set_local_s3_root(root):
+    """ Send the S3 requests made through get_s3_client to a LocalS3Client
+    rooted at the given directory, or back to S3 if root is None. """
+    global LOCAL_S3_ROOT
+    LOCAL_S3_ROOT = root
+
+
+def get_client(service, **config):
+    """ Get a boto3 client shared by all threads. Clients are thread-safe,
+    but creating them is not, and each one holds a connection pool, so
+    one client is kept per service and configuration. """
+    config.setdefault("max_pool_connections", MAX_POOL_CONNECTIONS)
+    key = (service, tuple(sorted(config.items())))
+    with CLIENTS_LOCK:
+        if key not in CLIENTS:
+            CLIENTS[key] = boto3.client(service, config=Config(**config))
+        return CLIENTS[key]
+
+
+def get_s3_client(config=None):
+    """ Get an S3 client, which is a LocalS3Client if a local root
+    directory has been set with set_local_s3_root. Without a config, the
+    shared client from get_client is returned. """
+    if LOCAL_S3_ROOT is not None:
+        return LocalS3Client(LOCAL_S3_ROOT)
+    if config is None:
+        return get_client("s3")
+    return boto3.client("s3", config=config)
+
+
+class LocalS3Client(object):
+    """ A directory-backed stand-in for the subset of the boto3 S3 client
+    used by Cirrus. Each bucket is a subdirectory of the root directory
+    and each object is a file in its bucket. Writes are atomic, so
+    several processes can share a root directory. """
+
+    class Body(object):
+        """ The streaming body of an object. """
+        def __init__(self, data):
+            self.data = data
+
+        def read(self):
+            """ Get the contents of the object. """
+            return self.data
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, quote(key, safe=""))
+
+    def create_bucket(self, Bucket, **_):
+        """ Create a bucket directory. """
+        path = os.path.join(self.root, Bucket)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another process may have created it first
+            if not os.path.isdir(path):
+                raise
+
+    def put_object(self, Bucket, Key, Body, **_):
+        """ Write an object. """
+        if not isinstance(Body, bytes):
+            Body = Body.encode("utf-8")
+        self.create_bucket(Bucket)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, Bucket),
+                                        prefix=".tmp")
+        with os.fdopen(fd, "wb") as f_handle:
+            f_handle.write(Body)
+        os.rename(tmp_path, self._path(Bucket, Key))
+        return {"ETag": '"{0}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **_):
+        """ Write an object from a file-like object. """
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def get_object(self, Bucket, Key, **_):
+        """ Read an object. """
+        try:
+            with open(self._path(Bucket, Key), "rb") as f_handle:
+                data = f_handle.read()
+        except (IOError, OSError):
+            raise ClientError({"Error": {"Code": "NoSuchKey",
+                                         "Message": Key}}, "GetObject")
+        return {"Body": LocalS3Client.Body(data), "ContentLength": len(data)}
+
+    def head_object(self, Bucket, Key, **_):
+        """ Get the size and ETag of an object. """
+        try:
+            with open(self._path(Bucket, Key), "rb") as f_handle:
+                data = f_handle.read()
+        except (IOError, OSError):
+            raise ClientError({"Error": {"Code": "404",
+                                         "Message": Key}}, "HeadObject")
+        return {"ContentLength": len(data),
+                "ETag": '"{0}"'.format(hashlib.md5(data).hexdigest())}
+
+    def delete_object(self, Bucket, Key, **_):
+        """ Delete an object, if it exists. """
+        try:
+            os.remove(self._path(Bucket, Key))
+        except OSError:
+            pass
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **_):
+        """ Delete a batch of objects. """
+        for obj in Delete["Objects"]:
+            self.delete_object(Bucket=Bucket, Key=obj["Key"])
+        return {"Deleted": [{"Key": obj["Key"]} for obj in Delete["Objects"]]}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None,
+                        MaxKeys=1000, StartAfter=None, **_):
+        """ List the objects in a bucket, in key order. """
+        ContinuationToken = ContinuationToken or StartAfter
+        path = os.path.join(self.root, Bucket)
+        names = os.listdir(path) if os.path.isdir(path) else []
+        keys = sorted(unquote(name) for name in names
+                      if not name.startswith(".tmp"))
+        keys = [key for key in keys if key.startswith(Prefix)
+                and (ContinuationToken is None or key > ContinuationToken)]
+        result = {"KeyCount": min(len(keys), MaxKeys),
+                  "IsTruncated": len(keys) > MaxKeys}
+        if keys:
+            result["Contents"] = [
+                {"Key": key, "Size": os.path.getsize(self._path(Bucket, key))}
+                for key in keys[:MaxKeys]]
+        if len(keys) > MaxKeys:
+            result["NextContinuationToken"] = keys[MaxKeys - 1]
+        return result
+
+
 def launch_threads(lambda_cls, objects, max_lambdas=400, *params):
-    """ Launch one thread for each of the objects passed in, with the
-    specified parameters. """
-    threads = deque()
-    for i in objects:
-        while len(threads) > max_lambdas:
-            other = threads.popleft()
-            other.join()
-        thread = lambda_cls(i, *params)
-        thread.start()
-        threads.append(thread)
+    """ Run lambda_cls(obj, *params).run() for each of the objects passed in,
+    on a pool of at most max_lambdas threads. Returns a ChunkResult for each
+    object, in order, holding what run() returned or raised. Classes with
+    a run_all classmethod, like LambdaThread, schedule the tasks
+    themselves. """
+    def run(obj):
+        """ Build and run the task for one object """
+        return lambda_cls(obj, *params).run()
+
+    if hasattr(lambda_cls, "run_all"):
+        results = lambda_cls.run_all(objects, max_lambdas, *params)
+    else:
+        results = map_in_threads(run, objects, max_lambdas)
+    failed = [res for res in results if res.exception is not None]
+    if failed:
+        print("{0} of {1} {2} tasks failed, first on {3}: {4}".format(
+            len(failed), len(results), lambda_cls.__name__, failed[0].key,
+            failed[0].exception))
+    return results
+
+
+def get_thread_pool():
+    """ Get the thread pool shared by every map_in_threads call, starting
+    it on first use """
+    global THREAD_POOL
+    with THREAD_POOL_LOCK:
+        if THREAD_POOL is None:
+            THREAD_POOL = ThreadPoolExecutor(MAX_POOL_CONNECTIONS)
+        return THREAD_POOL
+
+
+def map_in_threads(func, items, num_threads):
+    """ Call func on each item from at most num_threads threads of the
+    shared thread pool. Returns a ChunkResult for each item, in order.
+    Exceptions are caught and returned rather than raised. """
+    items = list(items)
+    results = [None] * len(items)
+    next_item = [0]
+    lock = threading.Lock()
 
-    for thread in threads:
-        thread.join()
+    def worker():
+        """ Take items until there are none left """
+        while True:
+            with lock:
+                idx = next_item[0]
+                next_item[0] += 1
+            if idx >= len(items):
+                return
+            try:
+                results[idx] = ChunkResult(items[idx], func(items[idx]), None)
+            except Exception as exc:
+                results[idx] = ChunkResult(items[idx], None, exc)
+
+    pool = get_thread_pool()
+    futures = [pool.submit(worker)
+               for _ in range(min(num_threads, len(items)) - 1)]
+    # The calling thread takes items too, so that calls made from the pool
+    # finish even when every thread of the pool is busy
+    worker()
+    for future in futures:
+        # Workers that haven't started have nothing left to take
+        if not future.cancel():
+            future.result()
+    return results
+
+
+def raise_failures(results, name):
+    """ Raise an exception if any of the ChunkResults failed """
+    failed = [res for res in results if res.exception is not None]
+    if failed:
+        raise RuntimeError("{0} failed on {1} of {2} chunks ({3}), first "
+                           "error: {4}".format(
+                               name, len(failed), len(results),
+                               ", ".join(str(res.key) for res in failed[:10]),
+                               failed[0].exception))
 
 
 def retry_loop(func, exceptions=(), handle_exception=None, max_attempts=3,
                name="Function"):
     """ Retry a function however many times, but stop if
-    one of the specified exceptions occurs. """
+    one of the specified exceptions occurs. Returns what the function
+    returned. """
     curr_attempt = 1
     timer = Timer(name).set_step("Attempt #1")
     while curr_attempt <= max_attempts:
         try:
-            func()
+            result = func()
             timer.timestamp().global_timestamp()
-            break
+            return result
         except exceptions as exc:
             if handle_exception is not None:
                 handle_exception(exc)
             curr_attempt += 1
+            if curr_attempt > max_attempts:
+                raise exc
         except Exception as exc:
             curr_attempt += 1
             if curr_attempt > max_attempts:
@@ -126,79 +397,700 @@ def delete_all_keys(bucket):
     return get_all_keys(bucket, "")
 
 
-def get_all_keys(bucket, contains="_"):
-    """ Get all keys from an S3 bucket, deleting any key that has
-    the substring "contains" """
-    s3_client = boto3.client("s3")
-    s3_resource = boto3.resource("s3")
-    keys = []
+def delete_keys(bucket, keys, num_threads=IO_THREADS,
+                batch_size=DELETE_BATCH):
+    """ Delete keys from a bucket with DeleteObjects requests of up to
+    batch_size keys each, sent from num_threads threads. Returns the
+    number of keys deleted. """
+    keys = list(keys)
+    client = get_s3_client()
+
+    def delete(batch):
+        """ Delete one batch of keys """
+        response = client.delete_objects(Bucket=bucket, Delete={
+            "Objects": [{"Key": str(key)} for key in batch],
+            "Quiet": True})
+        if response.get("Errors"):
+            error = response["Errors"][0]
+            raise IOError("Deleting {0} from bucket {1} failed: {2}".format(
+                error["Key"], bucket, error.get("Message")))
+        return len(batch)
+
+    batches = [keys[i:i + batch_size]
+               for i in range(0, len(keys), batch_size)]
+    results = map_in_threads(delete, batches, num_threads)
+    raise_failures(results, "Deleting keys")
+    return sum(res.result for res in results)
+
+
+def list_objects(bucket, s3_client=None, split_keys=(),
+                 num_threads=IO_THREADS):
+    """ Get the entries, with "Key" and "Size", of all objects in an S3
+    bucket, in key order.
+
+    The key space is split at each of the sorted split_keys, and the
+    ranges are listed in parallel, so large buckets with keys spread
+    across the ranges are listed num_threads pages at a time. """
+    s3_client = s3_client or get_s3_client()
+    bounds = [None] + sorted(split_keys)
+    ranges = list(zip(bounds, bounds[1:] + [None]))
+    results = map_in_threads(
+        lambda key_range: _list_range(s3_client, bucket, *key_range),
+        ranges, num_threads)
+    raise_failures(results, "Listing bucket {0}".format(bucket))
+    return [obj for res in results for obj in res.result]
+
+
+def _list_range(s3_client, bucket, start_after, last):
+    """ List the objects with keys after start_after, up to and including
+    last. Either bound can be None. """
+    objects = []
     kwargs = {"Bucket": bucket}
-    # Get all keys
+    if start_after is not None:
+        kwargs["StartAfter"] = start_after
     while True:
         result = s3_client.list_objects_v2(**kwargs)
-        if "Contents" not in result:
+        contents = result.get("Contents", [])
+        if last is not None and contents and contents[-1]["Key"] > last:
+            objects.extend(obj for obj in contents if obj["Key"] <= last)
             break
-        for obj in result["Contents"]:
-            keys.append(obj["Key"])
-        try:
-            kwargs["ContinuationToken"] = result["NextContinuationToken"]
-        except KeyError:
+        objects.extend(contents)
+        if "NextContinuationToken" not in result:
             break
+        kwargs["ContinuationToken"] = result["NextContinuationToken"]
+    return objects
+
+
+def write_manifest(bucket, objects, s3_client=None):
+    """ Write the manifest of the chunks of a bucket, a list of entries
+    with "Key", "Size" and "ETag", and usually the other fields of
+    chunk_entry. Drivers that write every chunk of a bucket write its
+    manifest, so get_all_chunks and batch_keys can read it instead of
+    listing the bucket. """
+    s3_client = s3_client or get_s3_client()
+    objects = sorted((dict(obj, Key=str(obj["Key"]), Size=int(obj["Size"]),
+                           ETag=obj.get("ETag")) for obj in objects),
+                     key=lambda obj: obj["Key"])
+    response = s3_client.put_object(
+        Bucket=bucket, Key=MANIFEST_KEY,
+        Body=json.dumps({"chunks": objects}, sort_keys=True))
+    with LISTINGS_LOCK:
+        LISTINGS[(bucket, response["ETag"])] = objects
+    return objects
+
+
+def read_manifest(bucket, s3_client=None):
+    """ Get the entries of the manifest of a bucket, or None if it has
+    none. Manifests are cached by bucket and ETag, so a manifest is only
+    downloaded again once it has been rewritten. """
+    s3_client = s3_client or get_s3_client()
+    try:
+        etag = s3_client.head_object(Bucket=bucket, Key=MANIFEST_KEY)["ETag"]
+    except ClientError:
+        return None
+    with LISTINGS_LOCK:
+        if (bucket, etag) in LISTINGS:
+            return list(LISTINGS[(bucket, etag)])
+    response = s3_client.get_object(Bucket=bucket, Key=MANIFEST_KEY)
+    objects = json.loads(response["Body"].read().decode("utf-8"))["chunks"]
+    with LISTINGS_LOCK:
+        LISTINGS[(bucket, response.get("ETag", etag))] = objects
+    return list(objects)
+
+
+def chunk_entry(key, body, etag=None, column_stats=False):
+    """ Get the manifest entry of a serialized chunk: its "Key", its
+    "Size" in bytes, its "ETag", its number of "Rows" and of nonzero
+    values ("Nnz"), and the CRC32 of its bytes ("Checksum"). Rows and Nnz
+    are read from the header, without decoding the chunk. If column_stats
+    is set, "Columns" also holds a [column, min, max] triple for each
+    column of the chunk. """
+    n_rows, nnz = chunk_counts(body)
+    entry = {"Key": str(key), "Size": len(body), "ETag": etag,
+             "Rows": n_rows, "Nnz": nnz,
+             "Checksum": zlib.crc32(body) & 0xffffffff}
+    if column_stats:
+        _, indices, values, _ = deserialize_data(body)
+        entry["Columns"] = _column_bounds(indices, values)
+    return entry
+
+
+def _column_bounds(indices, values):
+    """ Get a [column, min, max] triple for each column of CSR arrays """
+    order = np.argsort(indices, kind="mergesort")
+    columns, starts = np.unique(indices[order], return_index=True)
+    if not len(columns):
+        return []
+    values = values[order].astype(np.float64)
+    return [[col, low, high] for col, low, high in zip(
+        columns.tolist(), np.minimum.reduceat(values, starts).tolist(),
+        np.maximum.reduceat(values, starts).tolist())]
+
+
+def write_output_manifest(bucket, objects, results, all_chunks=True):
+    """ Write the manifest of a bucket whose chunks were all just written
+    by Lambdas, from the chunk_entry of each chunk in their results. If
+    only some of the chunks were written, or a Lambda did not report a
+    chunk, the bucket is left without a manifest. Returns whether one was
+    written. """
+    entries = dict((entry["Key"], entry) for res in results
+                   if isinstance(res.result, dict)
+                   for entry in res.result.get("chunks", []))
+    if not all_chunks or any(str(key) not in entries for key in objects):
+        return False
+    write_manifest(bucket, [entries[str(key)] for key in objects])
+    return True
+
+
+def chunks_for_rows(bucket, start_row, end_row, s3_client=None):
+    """ Get the range of chunk numbers holding the rows start_row up to
+    end_row of a dataset, counting rows from 0 across its chunks in
+    numeric order, from the row counts in its manifest. Like the
+    train_set and test_set of a task, both ranges include their start and
+    exclude their end. """
+    objects = read_manifest(bucket, s3_client)
+    if objects is None or any("Rows" not in obj for obj in objects):
+        raise ValueError("Bucket {0} has no manifest with row counts"
+                         .format(bucket))
+    objects = sorted(objects, key=lambda obj: int(obj["Key"]))
+    ends = np.cumsum([obj["Rows"] for obj in objects])
+    if not 0 <= start_row < end_row <= (ends[-1] if len(ends) else 0):
+        raise ValueError("Rows {0}-{1} are not in bucket {2}".format(
+            start_row, end_row, bucket))
+    first = np.searchsorted(ends, start_row, side="right")
+    last = np.searchsorted(ends, end_row - 1, side="right")
+    return int(objects[first]["Key"]), int(objects[last]["Key"]) + 1
+
+
+def convert_chunks(bucket_input, bucket_output, objects=(), columnar=True,
+                   compression=None, num_threads=IO_THREADS):
+    """ Rewrite the chunks of a bucket in another format: columnar if
+    columnar is set, compressed with a codec if compression is set, or in
+    the row format if neither is. Chunks can be in any format, and are
+    converted on num_threads threads. The manifest of the output bucket
+    is written if every chunk was converted. Returns the chunk_entry of
+    each converted chunk. """
+    s3_client = get_s3_client()
+    all_chunks = not objects
+    if not objects:
+        objects = get_all_keys(bucket_input)
+    invalidate_manifest(bucket_output, s3_client)
+
+    def convert(key):
+        """ Convert one chunk """
+        body = s3_client.get_object(Bucket=bucket_input,
+                                    Key=key)["Body"].read()
+        converted = serialize_arrays(*deserialize_data(body),
+                                     compression=compression,
+                                     columnar=columnar)
+        response = s3_client.put_object(Bucket=bucket_output, Key=key,
+                                        Body=converted)
+        return chunk_entry(key, converted, response.get("ETag"))
+
+    results = map_in_threads(convert, objects, num_threads)
+    raise_failures(results, "Converting chunks")
+    entries = [res.result for res in results]
+    if all_chunks:
+        write_manifest(bucket_output, entries, s3_client)
+    return entries
+
+
+def invalidate_manifest(bucket, s3_client=None):
+    """ Delete the manifest of a bucket, before its chunks are
+    rewritten """
+    s3_client = s3_client or get_s3_client()
+    s3_client.delete_object(Bucket=bucket, Key=MANIFEST_KEY)
+
+
+def list_chunks(bucket, s3_client=None):
+    """ Get the entries of the chunks of a bucket, from its manifest if it
+    has one, or by listing it otherwise """
+    objects = read_manifest(bucket, s3_client)
+    if objects is None:
+        objects = [obj for obj in list_objects(bucket, s3_client,
+                                               LIST_SPLIT_KEYS)
+                   if obj["Key"] != MANIFEST_KEY]
+    return objects
+
 
-    print("Found {0} chunks...".format(len(keys)))
+def get_all_chunks(bucket, contains="_", use_manifest=True):
+    """ Get the entries, with "Key" and "Size", of all chunks in an S3
+    bucket, deleting any key that has the substring "contains". If the
+    bucket has a manifest and use_manifest is set, its entries are
+    returned without listing or pruning the bucket; drivers delete the
+    manifest before they rewrite the chunks of a bucket. """
+    s3_client = get_s3_client()
+    if contains and use_manifest:
+        objects = read_manifest(bucket, s3_client)
+        if objects is not None:
+            print("Found {0} chunks in the manifest".format(len(objects)))
+            return objects
+    objects = list_objects(bucket, s3_client, LIST_SPLIT_KEYS)
+    print("Found {0} chunks...".format(len(objects)))
     # Delete the objects with keys that have the substring "contains"
-    final_objects = []
-    for obj in keys:
-        if contains in obj:
-            s3_resource.Object(bucket, obj).delete()
-        else:
-            final_objects.append(obj)
+    delete_keys(bucket, [obj["Key"] for obj in objects
+                         if contains in obj["Key"]])
+    final_objects = [obj for obj in objects if contains not in obj["Key"]
+                     and obj["Key"] != MANIFEST_KEY]
     print("Chunks after pruning: {0}".format(len(final_objects)))
     return final_objects
 
 
+def get_all_keys(bucket, contains="_", use_manifest=True):
+    """ Get all keys from an S3 bucket, deleting any key that has
+    the substring "contains". See get_all_chunks. """
+    return [obj["Key"] for obj in get_all_chunks(bucket, contains,
+                                                 use_manifest)]
+
+
+def batch_keys(bucket, objects, max_lambdas, target_bytes=BATCH_BYTES,
+               entries=None):
+    """ Group the keys of chunks in an S3 bucket into batches, each to be
+    processed by one Lambda invocation. Consecutive chunks are split into
+    enough batches to keep max_lambdas invocations busy, with about the
+    same amount of work each, and batches are split further so that none
+    holds more than target_bytes. The work of a chunk is estimated from
+    its row and nonzero counts in the manifest, or from its size, given
+    the entries of the chunks, like those from get_all_chunks, or from
+    list_chunks if entries is None. Returns a list of tuples. """
+    objects = list(objects)
+    if entries is None:
+        entries = list_chunks(bucket)
+    entries = dict((obj["Key"], obj) for obj in entries)
+    weights = [_chunk_weight(entries.get(str(key)), target_bytes)
+               for key in objects]
+    n_batches = min(len(objects), max_lambdas)
+    total = float(sum(weights)) or 1.0
+    batches = []
+    batch = []
+    batch_bytes = 0
+    group = 0
+    done = 0
+    for key, weight in zip(objects, weights):
+        # Each chunk goes to the share of the work it starts in
+        start_group = int(done * n_batches // total)
+        if batch and (start_group != group or
+                      batch_bytes + weight > target_bytes):
+            batches.append(tuple(batch))
+            batch = []
+            batch_bytes = 0
+        group = start_group
+        batch.append(key)
+        batch_bytes += weight
+        done += weight
+    if batch:
+        batches.append(tuple(batch))
+    return batches
+
+
+def _chunk_weight(entry, default):
+    """ Estimate the bytes of a chunk once decoded, from its manifest or
+    listing entry, or default if it is unknown """
+    if entry is None:
+        return default
+    if "Rows" in entry and "Nnz" in entry:
+        return 8 + 8 * (entry["Rows"] + entry["Nnz"])
+    return entry["Size"]
+
+
 def get_data_from_s3(client, src_bucket, src_object, keep_label=False):
     """ Return a 2D list, where each element is a row of the dataset. """
     b_data = client.get_object(Bucket=src_bucket, Key=src_object)["Body"].read()
-    data = []
-    labels = []
-    current_line = []
-    idx = None
-    label_bytes = None
-    num_values = None
-    seen = 0
-    for i in range(8, len(b_data), 4):
-        # Ignore the first 8 bytes, and get each 4 byte chunk one at a time
-        if label_bytes is None:
-            # If we haven't gotten the label for this line
-            label_bytes = b_data[i:i + 4]
-            if keep_label:
-                labels.append(label_bytes)
-            continue
-        if num_values is None:
-            # If we haven't gotten the number of values for this line
-            num_values = struct.unpack("i", b_data[i:i + 4])[0]
-            continue
-        if seen % 2 == 0:
-            # Index
-            idx = struct.unpack("i", b_data[i:i + 4])[0]
-        else:
-            # Value
-            current_line.append((idx, struct.unpack("f", b_data[i:i + 4])[0]))
-        seen += 1
-        if seen == num_values * 2:
-            # If we've finished this line
-            data.append(current_line)
-            current_line = []
-            label_bytes = None
-            num_values = None
-            seen = 0
+    indptr, indices, values, labels = deserialize_data(b_data)
+    data = arrays_to_rows(indptr, indices, values)
     if keep_label:
-        return data, labels
+        raw_labels = labels.tobytes()
+        return data, [raw_labels[i:i + 4]
+                      for i in range(0, len(raw_labels), 4)]
     return data
 
 
-def serialize_data(data, labels=None):
+def get_arrays_from_s3(client, src_bucket, src_object):
+    """ Return the CSR arrays (indptr, indices, values, labels) of a chunk,
+    compressed or not. """
+    b_data = client.get_object(Bucket=src_bucket, Key=src_object)["Body"].read()
+    return deserialize_data(b_data)
+
+
+def _row_offsets(words, n_rows):
+    """ Get the position of each row header in a chunk viewed as int32
+    words (without the 8 byte chunk header), along with the number of
+    values in each row.
+
+    Each row starts where the previous one ends, so the starts can only
+    be found by a sequential scan of the row headers. The scan reads each
+    header as a Python int, which is much cheaper than a NumPy scalar. """
+    header = _word_reader(words)
+    n_words = len(words)
+    starts = [0] * n_rows
+    pos = 0
+    for row in range(n_rows):
+        # Only the row headers are visited here, never the values
+        if pos + 1 >= n_words:
+            raise ValueError("Chunk ends at row {0} of {1}"
+                             .format(row, n_rows))
+        count = header(pos + 1)
+        if count < 0:
+            raise ValueError("Row {0} has {1} values".format(row, count))
+        starts[row] = pos
+        pos += 2 + 2 * count
+    if pos != n_words:
+        raise ValueError("Chunk has {0} words but its {1} rows span {2}"
+                         .format(n_words, n_rows, pos))
+    starts = np.array(starts, dtype=np.int64)
+    return starts, words[starts + 1].astype(np.int64)
+
+
+def _word_reader(words):
+    """ Get a function returning the int32 word at a position as a Python
+    int. Indexing a memoryview of the words does this without creating a
+    NumPy scalar, on Python 3. """
+    if str is not bytes and words.flags.c_contiguous:
+        return memoryview(words).__getitem__
+    return words.item
+
+
+def deserialize_data(b_data):
+    """ Decode a chunk in the format written by serialize_data, compressed,
+    columnar or neither. Returns CSR arrays (indptr, indices, values,
+    labels), where the values of row i are values[indptr[i]:indptr[i + 1]].
+    The arrays of a columnar chunk are read-only views of b_data. """
+    if is_compressed(b_data):
+        return decompress_arrays(b_data)
+    if is_columnar(b_data):
+        return columnar_arrays(b_data)
+    return SparseChunk(b_data).to_arrays()
+
+
+def is_compressed(buf):
+    """ Check the header of a chunk for the compressed format flag """
+    return len(buf) >= 4 and \
+        int(np.frombuffer(buf, dtype=np.int32, count=1)[0]) == COMPRESSED_FLAG
+
+
+def is_columnar(buf):
+    """ Check the header of a chunk for the columnar format flag """
+    return len(buf) >= 4 and \
+        int(np.frombuffer(buf, dtype=np.int32, count=1)[0]) == COLUMNAR_FLAG
+
+
+def chunk_counts(buf):
+    """ Get the number of rows and of values of a chunk from its header,
+    without decoding it """
+    if is_compressed(buf):
+        _, n_rows, _, nnz = COMPRESSED_HEADER.unpack_from(buf)
+        return n_rows, nnz
+    if is_columnar(buf):
+        _, n_rows, nnz = COLUMNAR_HEADER.unpack_from(buf)
+        return n_rows, nnz
+    n_rows = int(np.frombuffer(buf, dtype=np.int32, count=2)[1])
+    return n_rows, (len(buf) // 4 - 2 - 2 * n_rows) // 2
+
+
+def available_codecs():
+    """ Get the names of the codecs whose libraries are installed """
+    return [codec for codec in sorted(CODECS, key=CODECS.get)
+            if codec == "zlib" or
+            (codec == "zstd" and zstandard is not None) or
+            (codec == "lz4" and lz4_frame is not None)]
+
+
+def _codec_functions(codec):
+    """ Get the compress and decompress functions of a codec """
+    if codec not in CODECS:
+        raise ValueError("Unknown chunk compression: {0}".format(codec))
+    if codec not in available_codecs():
+        raise ValueError("Chunk compression {0} needs the {1} package"
+                         .format(codec, {"zstd": "zstandard",
+                                         "lz4": "lz4"}[codec]))
+    if codec == "zstd":
+        return (zstandard.ZstdCompressor().compress,
+                zstandard.ZstdDecompressor().decompress)
+    if codec == "lz4":
+        return lz4_frame.compress, lz4_frame.decompress
+    return zlib.compress, zlib.decompress
+
+
+def compress_arrays(indptr, indices, values, labels=None, codec="zlib"):
+    """ Serialize CSR arrays as a compressed chunk. After a
+    COMPRESSED_HEADER, the chunk holds the codec's compression of the
+    labels (float32), the number of values of each row (int32), the
+    indices (int32) and the values (float32) of the chunk. Indices are
+    stored as the difference to the previous index of their row, which
+    keeps them small when the indices of each row are sorted. """
+    indptr = np.asarray(indptr, dtype=np.int64)
+    n_rows = len(indptr) - 1
+    counts = np.diff(indptr)
+    indices = np.asarray(indices, dtype=np.int64)[indptr[0]:indptr[-1]]
+    deltas = np.empty(len(indices), dtype=np.int64)
+    deltas[:1] = indices[:1]
+    deltas[1:] = np.diff(indices)
+    # The first index of each row is kept as it is
+    firsts = (indptr[:-1] - indptr[0])[counts > 0]
+    deltas[firsts] = indices[firsts]
+    payload = b"".join([
+        _label_words(labels, n_rows).tobytes(),
+        counts.astype(np.int32).tobytes(),
+        deltas.astype(np.int32).tobytes(),
+        np.asarray(values, dtype=np.float32)[
+            indptr[0]:indptr[-1]].tobytes()])
+    compress = _codec_functions(codec)[0]
+    return COMPRESSED_HEADER.pack(COMPRESSED_FLAG, n_rows, CODECS[codec],
+                                  len(indices)) + compress(payload)
+
+
+def decompress_arrays(buf):
+    """ Decode a chunk written by compress_arrays into CSR arrays
+    (indptr, indices, values, labels) """
+    _, n_rows, codec_id, nnz = COMPRESSED_HEADER.unpack_from(buf)
+    codecs = dict((codec_id, codec) for codec, codec_id in CODECS.items())
+    if codec_id not in codecs:
+        raise ValueError("Unknown chunk compression id: {0}"
+                         .format(codec_id))
+    decompress = _codec_functions(codecs[codec_id])[1]
+    words = np.frombuffer(
+        decompress(bytes(buf[COMPRESSED_HEADER.size:])), dtype=np.int32)
+    if len(words) != 2 * n_rows + 2 * nnz:
+        raise ValueError("Compressed chunk has {0} words for {1} rows and "
+                         "{2} values".format(len(words), n_rows, nnz))
+    counts = words[n_rows:2 * n_rows]
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    # Each index is the sum of the deltas of its row up to it
+    sums = np.cumsum(words[2 * n_rows:2 * n_rows + nnz], dtype=np.int64)
+    before = np.concatenate([np.zeros(1, dtype=np.int64), sums])[indptr[:-1]]
+    indices = (sums - np.repeat(before, counts)).astype(np.int32)
+    return (indptr, indices, words[2 * n_rows + nnz:].view(np.float32),
+            words[:n_rows].view(np.float32))
+
+
+def columnar_arrays(buf):
+    """ Decode a chunk written by serialize_columnar into CSR arrays
+    (indptr, indices, values, labels), which are views of buf """
+    _, n_rows, nnz = COLUMNAR_HEADER.unpack_from(buf)
+    offset = COLUMNAR_HEADER.size
+    if n_rows < 0 or nnz < 0 or \
+            len(buf) != offset + 8 * (n_rows + 1) + 4 * (2 * nnz + n_rows):
+        raise ValueError("Columnar chunk has {0} bytes for {1} rows and {2} "
+                         "values".format(len(buf), n_rows, nnz))
+    indptr = np.frombuffer(buf, dtype=np.int64, count=n_rows + 1,
+                           offset=offset)
+    offset += indptr.nbytes
+    arrays = []
+    for dtype, count in ((np.int32, nnz), (np.float32, nnz),
+                         (np.float32, n_rows)):
+        arrays.append(np.frombuffer(buf, dtype=dtype, count=count,
+                                    offset=offset))
+        offset += arrays[-1].nbytes
+    if indptr[0] != 0 or indptr[-1] != nnz:
+        raise ValueError("Columnar chunk has rows spanning values {0} to "
+                         "{1} of {2}".format(indptr[0], indptr[-1], nnz))
+    return (indptr,) + tuple(arrays)
+
+
+def serialize_columnar(indptr, indices, values, labels=None):
+    """ Serialize CSR arrays as a columnar chunk. After a
+    COLUMNAR_HEADER, the chunk holds indptr (int64), the indices (int32),
+    the values (float32) and the labels (float32) of the chunk, each as
+    one contiguous array. indptr comes first, right after the 16 byte
+    header, so that every array is aligned to its item size and can be
+    read without copying. """
+    indptr = np.asarray(indptr, dtype=np.int64)
+    n_rows = len(indptr) - 1
+    start, end = int(indptr[0]), int(indptr[-1])
+    return b"".join([
+        COLUMNAR_HEADER.pack(COLUMNAR_FLAG, n_rows, end - start),
+        (indptr - start).tobytes(),
+        np.asarray(indices, dtype=np.int32)[start:end].tobytes(),
+        np.asarray(values, dtype=np.float32)[start:end].tobytes(),
+        _label_words(labels, n_rows).tobytes()])
+
+
+class SparseChunk(object):
+    """ A read-only view of a chunk in the format written by serialize_data.
+
+    The chunk is never copied: rows are returned as strided views into the
+    underlying buffer, which can be a bytes object, a memoryview or a
+    memory-mapped file. Only the row headers are read, the first time a
+    row or label is accessed. A compressed or columnar chunk is copied
+    into the row format first. """
+
+    def __init__(self, buf):
+        if is_compressed(buf) or is_columnar(buf):
+            buf = serialize_arrays(*deserialize_data(buf))
+        header = np.frombuffer(buf, dtype=np.int32, count=2)
+        self.num_bytes = int(header[0])
+        self.num_rows = int(header[1])
+        self._buffer = buf
+        self._words = np.frombuffer(buf, dtype=np.int32, offset=8)
+        self._starts = None
+        self._counts = None
+
+    @classmethod
+    def from_file(cls, path):
+        """ Memory-map a chunk stored in a local file. """
+        with open(path, "rb") as f_handle:
+            mapped = mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped)
+
+    @classmethod
+    def from_s3(cls, client, src_bucket, src_object):
+        """ Wrap a chunk downloaded from S3. """
+        return cls(client.get_object(
+            Bucket=src_bucket, Key=src_object)["Body"].read())
+
+    def close(self):
+        """ Release the buffer. A memory-mapped file is unmapped once the
+        views returned by this chunk are gone too, so they stay valid. """
+        self._words = None
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, row):
+        return self.row(row)
+
+    def __iter__(self):
+        for row in range(self.num_rows):
+            yield self.row(row)
+
+    def _index(self):
+        """ Find the row headers, if we haven't already. """
+        if self._starts is None:
+            self._starts, self._counts = _row_offsets(self._words,
+                                                      self.num_rows)
+        return self._starts, self._counts
+
+    @property
+    def counts(self):
+        """ The number of values in each row. """
+        return self._index()[1]
+
+    @property
+    def nnz(self):
+        """ The number of values in the chunk. """
+        return int(self.counts.sum())
+
+    @property
+    def labels(self):
+        """ The label of each row. """
+        return self._words[self._index()[0]].view(np.float32)
+
+    def row(self, row):
+        """ Get views of the indices and values of a row. """
+        if row < 0:
+            row += self.num_rows
+        if not 0 <= row < self.num_rows:
+            raise IndexError("Row {0} out of range for a chunk of {1} rows"
+                             .format(row, self.num_rows))
+        starts, counts = self._index()
+        begin = int(starts[row]) + 2
+        end = begin + 2 * int(counts[row])
+        return (self._words[begin:end:2],
+                self._words[begin + 1:end:2].view(np.float32))
+
+    def row_slice(self, start, stop):
+        """ Get CSR arrays (indptr, indices, values, labels) for the rows
+        in [start, stop). """
+        starts, counts = self._index()
+        start, stop, _ = slice(start, stop).indices(self.num_rows)
+        stop = max(start, stop)
+        end = int(starts[stop]) if stop < self.num_rows else len(self._words)
+        begin = int(starts[start]) if start < stop else end
+        return self._decode(self._words[begin:end], starts[start:stop] - begin,
+                            counts[start:stop])
+
+    def column_slice(self, start, stop):
+        """ Get CSR arrays (indptr, indices, values) containing only the
+        values whose column index is in [start, stop). The chunk is not
+        decoded: row headers and index / value pairs are both two words
+        long, so the index words are a strided view of the buffer, and
+        only the values that pass the filter are gathered. """
+        starts, _ = self._index()
+        # Every other word, starting with the first, is either the label of
+        # a row or an index
+        firsts = self._words[0::2]
+        keep = firsts >= start
+        keep &= firsts < stop
+        header_pairs = starts // 2
+        keep[header_pairs] = False
+        kept = np.flatnonzero(keep)
+        del keep
+        row_ids = np.searchsorted(header_pairs, kept, side="right") - 1
+        kept_indptr = np.zeros(self.num_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_ids, minlength=self.num_rows),
+                  out=kept_indptr[1:])
+        return (kept_indptr, firsts[kept],
+                self._words[1::2][kept].view(np.float32))
+
+    def sample(self, n_rows, seed=None):
+        """ Get CSR arrays (indptr, indices, values, labels) for n_rows rows
+        picked uniformly at random, without replacement. """
+        rand = np.random.RandomState(seed)
+        rows = np.sort(rand.choice(self.num_rows, min(n_rows, self.num_rows),
+                                   replace=False))
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(self.counts[rows], out=indptr[1:])
+        pairs = [self.row(row) for row in rows]
+        indices = np.concatenate([p[0] for p in pairs] +
+                                 [np.empty(0, dtype=np.int32)])
+        values = np.concatenate([p[1] for p in pairs] +
+                                [np.empty(0, dtype=np.float32)])
+        return indptr, indices, values, self.labels[rows]
+
+    def validate(self):
+        """ Check that the chunk is well formed, raising a ValueError
+        if it is not. """
+        if self.num_bytes != 8 + 4 * len(self._words):
+            raise ValueError("Chunk header says {0} bytes, buffer has {1}"
+                             .format(self.num_bytes, 8 + 4 * len(self._words)))
+        if self.num_rows < 0:
+            raise ValueError("Chunk header says {0} rows"
+                             .format(self.num_rows))
+        indices = self.to_arrays()[1]
+        if len(indices) and indices.min() < 0:
+            raise ValueError("Chunk has negative column indices")
+        return True
+
+    def to_arrays(self):
+        """ Get CSR arrays (indptr, indices, values, labels) for the whole
+        chunk. """
+        starts, counts = self._index()
+        return self._decode(self._words, starts, counts)
+
+    @staticmethod
+    def _decode(words, starts, counts):
+        """ Gather the labels, indices and values of consecutive rows. """
+        indptr = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        labels = words[starts].view(np.float32)
+
+        # Every word that is not a row header is part of an index / value
+        # pair
+        is_pair = np.ones(len(words), dtype=bool)
+        is_pair[starts] = False
+        is_pair[starts + 1] = False
+        pairs = words[is_pair]
+        return indptr, pairs[0::2], pairs[1::2].view(np.float32), labels
+
+
+def arrays_to_rows(indptr, indices, values):
+    """ Convert CSR arrays to a list of rows of (index, value) tuples. """
+    indices = indices.tolist()
+    values = values.tolist()
+    bounds = indptr.tolist()
+    return [list(zip(indices[start:end], values[start:end]))
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def serialize_data(data, labels=None, compression=None, columnar=False):
     """ Serialize a sparse matrix for S3.
     The format is as follows:
 
@@ -211,23 +1103,79 @@ def serialize_data(data, labels=None):
     where each data row is formatted as follows:
 
     label | num_col_for_row | col_idx1 | val1 | col_idx2 | val2 | ...
+
+    If compression names a codec in CODECS, the chunk is written in the
+    compressed format of compress_arrays instead. If columnar is set, it
+    is written in the columnar format of serialize_columnar.
     """
-    lines = []
-    num_bytes = 0
-    for idx, row in enumerate(data):
-        current_line = []
-        label = DEFAULT_LABEL
-        if labels is not None:
-            label = labels[idx]
-        current_line.append(label)
-        current_line.append(struct.pack("i", len(row)))
-        for idx2, val in row:
-            current_line.append(struct.pack("i", int(idx2)))
-            current_line.append(struct.pack("f", float(val)))
-        lines.append(b"".join(current_line))
-        num_bytes += len(lines[-1])
-    return struct.pack("i", num_bytes + 8) + \
-        struct.pack("i", len(lines)) + b"".join(lines)
+    counts = [len(row) for row in data]
+    indptr = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    pairs = [pair for row in data for pair in row]
+    if pairs:
+        indices, values = zip(*pairs)
+    else:
+        indices, values = (), ()
+    return serialize_arrays(indptr, np.array(indices, dtype=np.int32),
+                            np.array(values, dtype=np.float32), labels,
+                            compression, columnar)
+
+
+def serialize_sparse_matrix(matrix, labels=None, compression=None,
+                            columnar=False):
+    """ Serialize a scipy.sparse matrix for S3, in the format described
+    in serialize_data. """
+    matrix = matrix.tocsr()
+    return serialize_arrays(matrix.indptr, matrix.indices, matrix.data,
+                            labels, compression, columnar)
+
+
+def _label_words(labels, n_rows):
+    """ Get the labels of a chunk as int32 words. Labels can be raw 4 byte
+    strings (as returned by get_data_from_s3) or numbers. """
+    if labels is None:
+        return np.zeros(n_rows, dtype=np.int32)
+    if len(labels) and isinstance(labels[0], bytes):
+        return np.frombuffer(b"".join(labels), dtype=np.int32)
+    return np.asarray(labels, dtype=np.float32).view(np.int32)
+
+
+def serialize_arrays(indptr, indices, values, labels=None, compression=None,
+                     columnar=False):
+    """ Serialize CSR arrays for S3, in the format described in
+    serialize_data. The whole chunk is written into one preallocated
+    int32 buffer. """
+    if compression is not None and columnar:
+        raise ValueError("Columnar chunks can't be compressed")
+    if compression is not None:
+        return compress_arrays(indptr, indices, values, labels, compression)
+    if columnar:
+        return serialize_columnar(indptr, indices, values, labels)
+    indptr = np.asarray(indptr, dtype=np.int64)
+    indices = np.asarray(indices)
+    values = np.asarray(values)
+    n_rows = len(indptr) - 1
+    nnz = int(indptr[-1] - indptr[0])
+    counts = np.diff(indptr)
+    row_ids = np.arange(n_rows, dtype=np.int64)
+
+    words = np.empty(2 + 2 * n_rows + 2 * nnz, dtype=np.int32)
+    words[0] = 4 * len(words)
+    words[1] = n_rows
+
+    # Row i starts after the chunk header, the headers of the previous rows
+    # and the index / value pairs of the previous rows
+    starts = 2 + 2 * row_ids + 2 * (indptr[:-1] - indptr[0])
+    words[starts] = _label_words(labels, n_rows)
+    words[starts + 1] = counts
+
+    # The k-th pair of the chunk is preceded by the headers of its row
+    # and of every row before it
+    positions = 4 + 2 * np.repeat(row_ids, counts) + \
+        2 * np.arange(nnz, dtype=np.int64)
+    words[positions] = indices[indptr[0]:indptr[-1]]
+    words.view(np.float32)[positions + 1] = values[indptr[0]:indptr[-1]]
+    return words.tobytes()
 
 
 def get_random_color():
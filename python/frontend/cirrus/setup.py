@@ -15,5 +15,5 @@ setup(
     packages=find_packages(exclude=('tests', 'docs')),
     license=open('LICENSE'),
     long_description=open('README.md').read(),
-    scripts=["scripts/cirrus_setup"]
+    scripts=["scripts/cirrus_setup", "scripts/cirrus_convert_chunks"]
 )
@@ -0,0 +1,69 @@
+""" Benchmark of the compressed and columnar chunk formats against the
+plain one.
+
+For the columnar format and each codec in cirrus.utils.available_codecs(),
+reports the bytes of the chunks of a libsvm file, and the time taken to
+encode and decode them. You can get the test data from
+{CIRRUS_ROOT}/tests/test_data/small_test_criteo.sh
+
+Usage: python compression_benchmark.py [libsvm_file] [rows_per_chunk] """
+
+import sys
+import time
+
+from context import cirrus
+from cirrus.preprocessing import stream_libsvm, ROWS_PER_CHUNK
+from cirrus.utils import serialize_arrays, deserialize_data, \
+    available_codecs
+
+LIBSVM_FILE = "criteo.small.svm"
+# Each chunk is encoded and decoded this many times, keeping the fastest
+REPEATS = 3
+
+
+def best_time(func, *args):
+    """ Get the result of func and the least time it took, in seconds """
+    times = []
+    for _ in range(REPEATS):
+        start = time.time()
+        result = func(*args)
+        times.append(time.time() - start)
+    return result, min(times)
+
+
+def benchmark(path, rows_per_chunk=ROWS_PER_CHUNK):
+    """ Encode and decode the chunks of a libsvm file in every format.
+    Returns (format, bytes, encode seconds, decode seconds) tuples. """
+    formats = ["plain", "columnar"] + available_codecs()
+    totals = dict((fmt, [0, 0.0, 0.0]) for fmt in formats)
+    for indptr, indices, values, labels in stream_libsvm(
+            path, rows_per_chunk):
+        for fmt in formats:
+            compression = fmt if fmt in available_codecs() else None
+            serialized, encode_time = best_time(
+                serialize_arrays, indptr, indices, values, labels,
+                compression, fmt == "columnar")
+            _, decode_time = best_time(deserialize_data, serialized)
+            totals[fmt][0] += len(serialized)
+            totals[fmt][1] += encode_time
+            totals[fmt][2] += decode_time
+    return [(fmt,) + tuple(totals[fmt]) for fmt in formats]
+
+
+def main():
+    """ Print the results of the benchmark as a table """
+    path = sys.argv[1] if len(sys.argv) > 1 else LIBSVM_FILE
+    rows_per_chunk = int(sys.argv[2]) if len(sys.argv) > 2 \
+        else ROWS_PER_CHUNK
+    results = benchmark(path, rows_per_chunk)
+    plain_bytes = results[0][1]
+    print("{0:<8}{1:>14}{2:>8}{3:>12}{4:>12}".format(
+        "format", "bytes", "ratio", "encode s", "decode s"))
+    for fmt, n_bytes, encode_time, decode_time in results:
+        print("{0:<8}{1:>14}{2:>8.3f}{3:>12.3f}{4:>12.3f}".format(
+            fmt, n_bytes, n_bytes / float(plain_bytes), encode_time,
+            decode_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import random
+import shutil
+import tempfile
+
+import pytest
+
+from cirrus import utils
+from cirrus.lambda_thread import use_local_backend, set_executor
+
+
+@pytest.fixture
+def local_backend():
+    """Run the drivers on a temporary, empty local backend. Returns its S3
+    client.
+    """
+    root = tempfile.mkdtemp()
+    previous = use_local_backend(root, max_workers=2)
+    yield utils.get_s3_client()
+    set_executor(previous).shutdown()
+    utils.set_local_s3_root(None)
+    shutil.rmtree(root)
+
+
+@pytest.fixture
+def put_chunks(local_backend):
+    """Get a function that puts chunks of random rows, with 4 of 10 columns
+    each, in a bucket of the local backend. It returns the rows of each
+    chunk by key.
+    """
+    def put(bucket, keys, n_rows=50, seed=0):
+        rand = random.Random(seed)
+        data = {}
+        for key in keys:
+            data[key] = [[(col, float(rand.randint(0, 20)))
+                          for col in sorted(rand.sample(range(10), 4))]
+                         for _ in range(n_rows)]
+            local_backend.put_object(Bucket=bucket, Key=key,
+                                     Body=utils.serialize_data(data[key]))
+        return data
+    return put
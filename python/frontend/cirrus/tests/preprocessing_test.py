@@ -121,7 +121,7 @@ def load_data(path):
 
 
 def test_load_libsvm(src_file, s3_bucket_output, wipe_keys=False,
-                     no_load=False, check_output=False):
+                     no_load=False, check_output=False, streaming=False):
     """ Test the load libsvm to S3 function. """
     printer = prefix_print("TEST_LOAD")
     timer = Timer("TEST_LOAD", verbose=True)
@@ -131,7 +131,8 @@ def test_load_libsvm(src_file, s3_bucket_output, wipe_keys=False,
         timer.timestamp()
     if not no_load:
         timer.set_step("Loading libsvm file into S3")
-        Preprocessing.load_libsvm(src_file, s3_bucket_output)
+        Preprocessing.load_libsvm(src_file, s3_bucket_output,
+                                  streaming=streaming)
         timer.timestamp()
 
     if not check_output:
@@ -0,0 +1,69 @@
+"""Tests that the Lambda invoker limits concurrency, retries throttled calls
+    and reports a result for every chunk.
+"""
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from cirrus.async_invoker import AsyncInvoker
+
+
+class FakeEndpoint(object):
+    """A Lambda endpoint that throttles the first call for each payload and
+    fails on negative payloads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = {}
+
+    def invoke(self, payload):
+        with self.lock:
+            self.calls[payload] = self.calls.get(payload, 0) + 1
+            calls = self.calls[payload]
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(0.01)
+            if calls == 1:
+                raise ClientError({"Error": {
+                    "Code": "TooManyRequestsException"}}, "Invoke")
+            if payload < 0:
+                raise ValueError("Bad chunk")
+            return payload * 2
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def test_results_per_chunk():
+    """Test that throttled calls are retried and errors are returned.
+    """
+    endpoint = FakeEndpoint()
+    invoker = AsyncInvoker(endpoint.invoke, max_concurrency=8,
+                           initial_wait=0.001)
+    payloads = list(range(50)) + [-1]
+    threads = threading.active_count()
+    results = invoker.run(["key%d" % p for p in payloads], payloads)
+    # The threads of the pool are stopped
+    assert threading.active_count() == threads
+    assert [res.key for res in results] == ["key%d" % p for p in payloads]
+    assert [res.result for res in results[:-1]] == \
+        [2 * p for p in payloads[:-1]]
+    assert isinstance(results[-1].exception, ValueError)
+    assert all(calls == 2 for calls in endpoint.calls.values())
+    assert endpoint.max_in_flight == 8
+
+
+def test_retries_are_bounded():
+    """Test that a call is given up on after max_retries retries.
+    """
+    endpoint = FakeEndpoint()
+    invoker = AsyncInvoker(endpoint.invoke, initial_wait=0.001,
+                           max_retries=0)
+    results = invoker.run(["key"], [1])
+    assert isinstance(results[0].exception, ClientError)
+    assert endpoint.calls[1] == 1
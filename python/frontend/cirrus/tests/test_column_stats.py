@@ -0,0 +1,101 @@
+"""Tests that ColumnStats merge and serialize like the stats of the whole
+    dataset.
+"""
+import random
+
+import numpy as np
+
+from cirrus.column_stats import ColumnStats, ColumnSketches, ColumnTable
+
+
+def test_merge_matches_whole_dataset():
+    """Test that a tree of merges gives the stats of all of the chunks.
+    """
+    chunks = [_random_rows(20, seed) for seed in range(7)]
+    merged = ColumnStats.merge_all(
+        [ColumnStats.from_rows(chunk) for chunk in chunks])
+    whole = ColumnStats.from_rows([row for chunk in chunks for row in chunk])
+    assert merged.n_cols == whole.n_cols
+    for name in ("min", "max", "mean", "m2", "count"):
+        assert np.allclose(getattr(merged, name), getattr(whole, name))
+
+    values = {}
+    for row in [row for chunk in chunks for row in chunk]:
+        for idx, val in row:
+            values.setdefault(idx, []).append(val)
+    assert merged.columns.tolist() == sorted(values)
+    bounds = merged.bounds().dense()
+    normal = merged.normal_table().dense()
+    for idx, col in values.items():
+        assert bounds[idx].tolist() == [min(col), max(col)]
+        assert np.isclose(normal[idx, 0], np.mean(col))
+        assert np.isclose(normal[idx, 1], np.std(col))
+
+
+def test_serialize_round_trip():
+    """Test that stats survive an encode / decode round trip.
+    """
+    stats = ColumnStats.from_rows(_random_rows(20, 0))
+    decoded = ColumnStats.deserialize(stats.serialize())
+    for name in ("min", "max", "mean", "m2", "count"):
+        assert getattr(decoded, name).tolist() == getattr(stats, name).tolist()
+    assert ColumnStats.merge_all([]).n_cols == 0
+
+    # Only the columns that have values are stored
+    wide = ColumnStats.from_arrays([2**20, 5, 2**20], [1.0, 2.0, 3.0])
+    assert wide.columns.tolist() == [5, 2**20]
+    assert wide.n_cols == 2**20 + 1
+    assert len(wide.serialize()) < 200
+    merged = wide.merge(ColumnStats.from_arrays([7], [4.0]))
+    assert merged.columns.tolist() == [5, 7, 2**20]
+    assert merged.mean.tolist() == [2.0, 4.0, 2.0]
+
+    bounds = stats.bounds()
+    decoded = ColumnTable.deserialize(bounds.serialize())
+    assert decoded.columns.tolist() == stats.columns.tolist()
+    assert decoded.table.tolist() == bounds.table.tolist()
+    assert ColumnTable.deserialize(ColumnTable().serialize()).dense().size == 0
+
+
+def test_large_values_keep_precision():
+    """Test that the variance of large values with a small spread survives
+    merging, where E[X^2] - E[X]^2 would cancel.
+    """
+    rand = random.Random(0)
+    chunks = [[[(0, 1e9 + rand.randint(0, 4))] for _ in range(100)]
+              for _ in range(10)]
+    merged = ColumnStats.merge_all(
+        [ColumnStats.from_rows(chunk) for chunk in chunks])
+    values = [row[0][1] for chunk in chunks for row in chunk]
+    assert np.isclose(merged.std_dev()[0], np.std(np.array(values) - 1e9))
+    assert np.isclose(merged.sum[0], sum(values))
+    constant = ColumnStats.from_rows([[(0, 0.1)]] * 3)
+    assert constant.std_dev()[0] == 0
+
+
+def test_sketches_estimate_quantiles():
+    """Test that merged sketches of heavy-tailed columns estimate their
+    quantiles to within a few percent of the rank.
+    """
+    rand = np.random.RandomState(0)
+    values = rand.standard_cauchy(100000)
+    indices = rand.randint(0, 3, 100000)
+    parts = [ColumnSketches.from_arrays(indices[i::8], values[i::8], k=200)
+             for i in range(8)]
+    merged = ColumnSketches.deserialize(
+        ColumnSketches.merge_all(parts).serialize())
+    fractions = [.01, .25, .5, .75, .99]
+    table = merged.quantiles(fractions)
+    assert table.columns.tolist() == [0, 1, 2]
+    for col in range(3):
+        column = np.sort(values[indices == col])
+        ranks = np.searchsorted(column, table.table[col]) / float(len(column))
+        assert np.abs(ranks - fractions).max() < .03
+        assert sum(len(items) for items in merged.sketches[col].levels) < 400
+
+
+def _random_rows(n_rows, seed):
+    rand = random.Random(seed)
+    return [[(col, float(rand.randint(-50, 50)))
+             for col in sorted(rand.sample(range(30), 5))]
+            for _ in range(n_rows)]
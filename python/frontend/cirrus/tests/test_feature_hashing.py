@@ -0,0 +1,111 @@
+"""Tests that the feature hashing driver matches mmh3 on the local backend.
+"""
+import mmh3
+
+from cirrus import feature_hashing, utils
+
+INPUT_BUCKET = "input"
+OUTPUT_BUCKET = "output"
+OBJECTS = ["1", "2", "3"]
+HASH_SEED = 42  # Must be equal to the seed in feature_hashing_helper.py
+
+
+def test_feature_hashing(local_backend, put_chunks):
+    """Test that columns are hashed by a locally run handler.
+    """
+    data = put_chunks(INPUT_BUCKET, OBJECTS)
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [3], 100,
+                                    OBJECTS)
+    for key in OBJECTS:
+        hashed = utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, key)
+        for row, hashed_row in zip(data[key], hashed):
+            expected = {}
+            for col, val in row:
+                if col == 3:
+                    bucket = mmh3.hash(str(val), HASH_SEED, signed=False) % 100
+                    expected[bucket] = expected.get(bucket, 0) + 1
+                else:
+                    expected[100 + col] = val
+            assert dict(hashed_row) == expected
+
+
+def test_feature_hashing_edge_values(local_backend):
+    """Test that hashing matches mmh3 on the printed float32 values,
+    including values that compare equal but print differently.
+    """
+    rows = [[(0, 0.0), (1, 0.1), (2, 7.0)], [(0, -0.0), (1, 0.1)],
+            [(0, 1e-8), (1, 123456.789)], []]
+    local_backend.put_object(Bucket=INPUT_BUCKET, Key="edge",
+                             Body=utils.serialize_data(rows))
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [0, 1], 7,
+                                    ["edge"])
+    hashed = utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, "edge")
+    decoded = utils.get_data_from_s3(local_backend, INPUT_BUCKET, "edge")
+    for row, hashed_row in zip(decoded, hashed):
+        expected = {}
+        for col, val in row:
+            if col in (0, 1):
+                bucket = mmh3.hash(str(val), HASH_SEED, signed=False) % 7
+                expected[bucket] = expected.get(bucket, 0) + 1
+            else:
+                expected[7 + col] = val
+        assert dict(hashed_row) == expected
+        assert [col for col, _ in hashed_row] == sorted(expected)
+
+
+def test_feature_hashing_options(local_backend, put_chunks):
+    """Test signed, k-way hashing that keeps the hashed columns.
+    """
+    put_chunks(INPUT_BUCKET, OBJECTS[:1])
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [3], 100,
+                                    OBJECTS[:1], signed=True, n_hashes=2,
+                                    keep_values=True)
+    decoded = utils.get_data_from_s3(local_backend, INPUT_BUCKET, OBJECTS[0])
+    hashed = utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, OBJECTS[0])
+    for row, hashed_row in zip(decoded, hashed):
+        expected = {}
+        for col, val in row:
+            expected[100 + col] = val
+            if col != 3:
+                continue
+            for seed in (HASH_SEED, HASH_SEED + 1):
+                hash_val = mmh3.hash(str(val), seed, signed=False)
+                sign = -1 if hash_val >> 31 else 1
+                bucket = hash_val % 100
+                expected[bucket] = expected.get(bucket, 0) + sign
+        assert dict(hashed_row) == expected
+
+
+def test_feature_crosses(local_backend, put_chunks):
+    """Test that crosses of columns are hashed in the hashing pass.
+    """
+    put_chunks(INPUT_BUCKET, OBJECTS[:1])
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [2], 50,
+                                    OBJECTS[:1], crosses=[(1, 4), (0, 9)])
+    decoded = utils.get_data_from_s3(local_backend, INPUT_BUCKET, OBJECTS[0])
+    hashed = utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, OBJECTS[0])
+    for row, hashed_row in zip(decoded, hashed):
+        row = dict(row)
+        texts = [str(val) for col, val in row.items() if col == 2]
+        for col_a, col_b in ((1, 4), (0, 9)):
+            if col_a in row and col_b in row:
+                texts.append("{0}:{1}x{2}:{3}".format(
+                    col_a, str(row[col_a]), col_b, str(row[col_b])))
+        expected = dict((50 + col, val) for col, val in row.items()
+                        if col != 2)
+        for text in texts:
+            bucket = mmh3.hash(text, HASH_SEED, signed=False) % 50
+            expected[bucket] = expected.get(bucket, 0) + 1
+        assert dict(hashed_row) == expected
+
+
+def test_hash_cache_reported(put_chunks, capsys):
+    """Test that the hit rate of the hash caches is printed.
+    """
+    put_chunks(INPUT_BUCKET, OBJECTS[:1], n_rows=10)
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [3], 100,
+                                    OBJECTS[:1], cache_size=4,
+                                    hot_values=[1.0])
+    out = capsys.readouterr().out
+    assert "[FEATURE_HASHING] Hash cache hits: " in out
+    assert "[FEATURE_HASHING] Hash cache hit rate: " in out
@@ -0,0 +1,33 @@
+"""Tests that the local backend runs the preprocessing handler in batches,
+    and reports failed chunks.
+"""
+import pytest
+
+from cirrus import feature_hashing, min_max_scaler, utils
+
+INPUT_BUCKET = "input"
+OUTPUT_BUCKET = "output"
+OBJECTS = ["1", "2", "3"]
+
+
+def test_batched_invocations(local_backend, put_chunks, monkeypatch):
+    """Test that one handler invocation processes a whole batch of chunks.
+    """
+    data = put_chunks(INPUT_BUCKET, OBJECTS, n_rows=5)
+    monkeypatch.setattr(feature_hashing, "MAX_LAMBDAS", 1)
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [], 100,
+                                    OBJECTS)
+    for key in OBJECTS:
+        hashed = utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, key)
+        assert [dict(row) for row in hashed] == \
+            [dict((100 + col, val) for col, val in row) for row in data[key]]
+
+
+def test_failures_are_reported(put_chunks):
+    """Test that a failing chunk stops the driver instead of vanishing.
+    """
+    put_chunks(INPUT_BUCKET, OBJECTS[:1], n_rows=1)
+    with pytest.raises(RuntimeError):
+        # There is no Redis server to hold the bounds
+        min_max_scaler.min_max_scaler(INPUT_BUCKET, OUTPUT_BUCKET, 0.0, 1.0,
+                                      OBJECTS[:1], use_redis=True)
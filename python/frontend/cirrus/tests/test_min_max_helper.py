@@ -0,0 +1,158 @@
+"""Tests that the min max helper of the Lambda merges and reads the global
+    bounds in sharded Redis hashes, on a fake Redis.
+"""
+import os
+
+import numpy as np
+import pytest
+from redis import StrictRedis
+
+from cirrus.lambda_thread import LAMBDAS_DIR
+
+# Encodes script arguments like redis-py does
+ENCODER = StrictRedis().connection_pool.get_encoder()
+
+
+class FakeRedis(object):
+    """A Redis node holding hashes, with pipelines and the bounds script
+    of min_max_helper run in Python.
+    """
+
+    def __init__(self, hashes=None, scripts=None):
+        self.hashes = {} if hashes is None else hashes
+        # Script texts by SHA1, shared by the nodes of a cluster
+        self.scripts = {} if scripts is None else scripts
+        self.connection_pool = StrictRedis().connection_pool
+        self.calls = []
+
+    def register_script(self, script):
+        script = StrictRedis().register_script(script)
+        self.scripts[script.sha] = script.script
+        return script
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def evalsha(self, sha, numkeys, *args):
+        assert sha in self.scripts
+        (max_key, min_key), argv = args[:numkeys], args[numkeys:]
+        for i in range(0, len(argv), 3):
+            col, max_v, min_v = [ENCODER.encode(arg)
+                                 for arg in argv[i:i + 3]]
+            current = self.hashes.setdefault(max_key, {}).get(col)
+            if current is None or float(max_v) > float(current):
+                self.hashes[max_key][col] = max_v
+            current = self.hashes.setdefault(min_key, {}).get(col)
+            if current is None or float(min_v) < float(current):
+                self.hashes[min_key][col] = min_v
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(ENCODER.encode(field))
+                for field in fields]
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+
+class FakePipeline(object):
+    """Queues calls to a FakeRedis until execute."""
+
+    def __init__(self, client):
+        self.client = client
+        self.queued = []
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self.queued.append((name, args))
+        return queue
+
+    def execute(self):
+        self.client.calls.append([name for name, _ in self.queued])
+        return [getattr(self.client, name)(*args)
+                for name, args in self.queued]
+
+
+class FakeNodes(object):
+    """Puts the shards with even and odd numbers on two nodes."""
+
+    def keyslot(self, key):
+        return int(key[len("{bounds"):key.index("}")])
+
+    def node_from_slot(self, slot):
+        return {"host": "node{0}".format(slot % 2), "port": 6379}
+
+
+@pytest.fixture
+def min_max_helper(monkeypatch):
+    """Import the helper, which imports its neighbours as top level
+    modules, like run_local_handler does.
+    """
+    monkeypatch.syspath_prepend(os.path.dirname(LAMBDAS_DIR))
+    monkeypatch.syspath_prepend(LAMBDAS_DIR)
+    import min_max_helper
+    monkeypatch.setattr(min_max_helper, "NODE_CLIENTS", {})
+    return min_max_helper
+
+
+def _bounds(helper, rows):
+    columns = sorted(set(col for row in rows for col, _ in row))
+    return helper.ColumnTable(columns, [
+        [min(val for row in rows for c, val in row if c == col),
+         max(val for row in rows for c, val in row if c == col)]
+        for col in columns])
+
+
+def test_global_bounds(min_max_helper):
+    """Test that the script merges the bounds of each chunk, and that they
+    are read back for some columns and for all of them.
+    """
+    chunks = [[[(0, 2.0), (3, -1.0)], [(5, 4.0)]],
+              [[(0, -2.5), (3, 7.0)], [(300, 1.5)]]]
+    client = FakeRedis()
+    for chunk, rows in enumerate(chunks):
+        min_max_helper.put_bounds_in_db(
+            client, _bounds(min_max_helper, rows), chunk)
+    # The script is emulated by FakeRedis.evalsha
+    assert list(client.scripts.values()) == [min_max_helper.BOUNDS_SCRIPT]
+    # One pipeline of script calls per chunk
+    assert client.calls == [["evalsha"] * 3, ["evalsha"] * 3]
+
+    expected = _bounds(min_max_helper, chunks[0] + chunks[1])
+    found = min_max_helper.get_global_bounds(client, 0)
+    assert found.columns.tolist() == expected.columns.tolist()
+    assert found.table.tolist() == expected.table.tolist()
+    assert set(client.calls[-1]) == set(["hgetall"])
+
+    found = min_max_helper.get_global_bounds(client, 0,
+                                             np.array([3, 300, 9]))
+    assert found.columns.tolist() == [3, 300]
+    assert found.table.tolist() == [[-1.0, 7.0], [1.5, 1.5]]
+    # Two hashes for each of the 3 shards of the columns
+    assert client.calls[-1] == ["hmget"] * 6
+
+
+def test_node_clients_are_cached(min_max_helper, monkeypatch):
+    """Test that one client is connected to each node of a cluster, and
+    kept across calls.
+    """
+    hashes = {"node0": {}, "node1": {}}
+    scripts = {}
+    connected = []
+
+    def connect(host, port, password):
+        connected.append((host, port))
+        return FakeRedis(hashes[host], scripts)
+
+    monkeypatch.setattr(min_max_helper, "StrictRedis", connect)
+    cluster = FakeRedis(scripts=scripts)
+    cluster.connection_pool.nodes = FakeNodes()
+    rows = [[(0, 1.0), (1, 2.0), (2, 3.0)]]
+    for chunk in range(3):
+        min_max_helper.put_bounds_in_db(
+            cluster, _bounds(min_max_helper, rows), chunk)
+    found = min_max_helper.get_global_bounds(cluster, 0, [0, 1, 2])
+    assert found.table.tolist() == [[1.0, 1.0], [2.0, 2.0], [3.0, 3.0]]
+    assert sorted(connected) == [("node0", 6379), ("node1", 6379)]
+    assert sorted(hashes["node0"]) == ["{bounds0}_max", "{bounds0}_min",
+                                       "{bounds2}_max", "{bounds2}_min"]
+    assert sorted(hashes["node1"]) == ["{bounds1}_max", "{bounds1}_min"]
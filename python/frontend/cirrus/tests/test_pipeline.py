@@ -0,0 +1,45 @@
+"""Tests that pipelines fuse their steps, and match running the steps one
+    by one on the local backend.
+"""
+from cirrus import feature_hashing, min_max_scaler, normal_scaler, \
+    pipeline, utils
+
+INPUT_BUCKET = "input"
+OUTPUT_BUCKET = "output"
+OBJECTS = ["1", "2", "3"]
+EPSILON = .0001
+
+
+def test_pipeline(local_backend, put_chunks):
+    """Test that a pipeline matches running its steps one by one.
+    """
+    put_chunks(INPUT_BUCKET, OBJECTS)
+    feature_hashing.feature_hashing(INPUT_BUCKET, "hashed", [3], 100,
+                                    OBJECTS)
+    normal_scaler.normal_scaler("hashed", "normal", OBJECTS)
+    min_max_scaler.min_max_scaler("normal", "expected", -1.0, 1.0, OBJECTS,
+                                  use_redis=False)
+    pipeline.pipeline(INPUT_BUCKET, OUTPUT_BUCKET, [
+        pipeline.hashing_step([3], 100), pipeline.normal_step(),
+        pipeline.min_max_step(-1.0, 1.0)], OBJECTS)
+    for key in OBJECTS:
+        expected = utils.get_data_from_s3(local_backend, "expected", key)
+        actual = utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, key)
+        for expected_row, row in zip(expected, actual):
+            assert [col for col, _ in expected_row] == [col for col, _ in row]
+            for (_, expected_val), (_, val) in zip(expected_row, row):
+                assert abs(expected_val - val) < EPSILON
+    assert sorted(utils.get_all_keys(INPUT_BUCKET)) == OBJECTS
+
+
+def test_pipeline_stages():
+    """Test that only scaling after hashing after scaling adds a pass.
+    """
+    stages = pipeline.compile_steps([
+        pipeline.hashing_step([1], 10), pipeline.hashing_step([2], 10),
+        pipeline.min_max_step(0.0, 1.0), pipeline.normal_step()])
+    assert len(stages) == 1
+    stages = pipeline.compile_steps([
+        pipeline.normal_step(), pipeline.hashing_step([1], 10),
+        pipeline.min_max_step(0.0, 1.0)])
+    assert len(stages) == 2
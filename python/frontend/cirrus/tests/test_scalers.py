@@ -0,0 +1,71 @@
+"""Tests that the scaling drivers run end to end on the local backend,
+    without AWS or Redis.
+"""
+from cirrus import min_max_scaler, normal_scaler, quantile_scaler, utils
+
+INPUT_BUCKET = "input"
+OUTPUT_BUCKET = "output"
+OBJECTS = ["1", "2", "3"]
+EPSILON = .0001
+
+
+def test_min_max_scaler(local_backend, put_chunks):
+    """Test that min / max scaling without Redis maps columns to [0, 1].
+    """
+    data = put_chunks(INPUT_BUCKET, OBJECTS)
+    min_max_scaler.min_max_scaler(INPUT_BUCKET, OUTPUT_BUCKET, 0.0, 1.0,
+                                  OBJECTS, use_redis=False)
+    columns = {}
+    for key in OBJECTS:
+        scaled = utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, key)
+        assert [[col for col, _ in row] for row in scaled] == \
+            [[col for col, _ in row] for row in data[key]]
+        for row in scaled:
+            for col, val in row:
+                columns.setdefault(int(col), []).append(val)
+    for values in columns.values():
+        assert abs(min(values)) < EPSILON
+        assert abs(max(values) - 1) < EPSILON
+    # The stats of the chunks and the global bounds are deleted
+    assert sorted(obj["Key"] for obj in utils.list_objects(INPUT_BUCKET)) \
+        == OBJECTS
+
+
+def test_normal_scaler(local_backend, put_chunks):
+    """Test that normal scaling centers every column.
+    """
+    put_chunks(INPUT_BUCKET, OBJECTS)
+    normal_scaler.normal_scaler(INPUT_BUCKET, OUTPUT_BUCKET, OBJECTS)
+    columns = {}
+    for key in OBJECTS:
+        for row in utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, key):
+            for col, val in row:
+                columns.setdefault(int(col), []).append(val)
+    for values in columns.values():
+        assert abs(sum(values) / len(values)) < EPSILON
+
+
+def test_quantile_scalers(local_backend, put_chunks):
+    """Test that quantile scaling maps columns to [0, 1] in order, and that
+    robust scaling centers them on their medians.
+    """
+    data = put_chunks(INPUT_BUCKET, OBJECTS)
+    quantile_scaler.quantile_scaler(INPUT_BUCKET, OUTPUT_BUCKET, OBJECTS)
+    quantile_scaler.robust_scaler(INPUT_BUCKET, "robust", OBJECTS)
+    quantiles = {}
+    robust = {}
+    for key in OBJECTS:
+        for bucket, columns in ((OUTPUT_BUCKET, quantiles),
+                                ("robust", robust)):
+            scaled = utils.get_data_from_s3(local_backend, bucket, key)
+            for row, scaled_row in zip(data[key], scaled):
+                for (col, val), (_, scaled_val) in zip(row, scaled_row):
+                    columns.setdefault(col, []).append((val, scaled_val))
+    for pairs in quantiles.values():
+        scaled = [scaled_val for _, scaled_val in sorted(pairs)]
+        assert scaled == sorted(scaled)
+        assert scaled[0] >= 0 and scaled[-1] == 1
+    for pairs in robust.values():
+        median = sorted(pairs)[(len(pairs) - 1) // 2][0]
+        assert all(scaled_val == 0 for val, scaled_val in pairs
+                   if val == median)
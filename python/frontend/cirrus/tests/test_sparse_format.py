@@ -0,0 +1,249 @@
+"""Tests that the sparse chunk encoders and decoders in cirrus.utils agree
+    with each other and with the original struct-based encoder.
+"""
+import random
+import struct
+import tempfile
+
+import numpy as np
+import pytest
+import scipy.sparse
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from cirrus import utils
+
+
+def test_serialize_data_matches_reference():
+    """Test that serialize_data writes the same bytes as the original encoder.
+    """
+    data, labels = _random_rows(200)
+    assert utils.serialize_data(data, labels) == \
+        _reference_serialize(data, labels)
+    assert utils.serialize_data(data) == _reference_serialize(data)
+
+
+def test_serialize_arrays_round_trip():
+    """Test that CSR arrays survive an encode / decode round trip.
+    """
+    data, labels = _random_rows(200)
+    indptr, indices, values, decoded_labels = utils.deserialize_data(
+        _reference_serialize(data, labels))
+    serialized = utils.serialize_arrays(indptr, indices, values,
+                                        decoded_labels)
+    assert serialized == _reference_serialize(data, labels)
+    assert utils.arrays_to_rows(indptr, indices, values) == \
+        [[(idx, _to_float32(val)) for idx, val in row] for row in data]
+
+
+def test_serialize_sparse_matrix():
+    """Test that a scipy.sparse matrix is encoded like its rows.
+    """
+    matrix = scipy.sparse.random(50, 1000, density=0.02, format="csr",
+                                 dtype=np.float32, random_state=0)
+    labels = np.arange(50) % 2
+    rows = [list(zip(matrix.indices[start:end], matrix.data[start:end]))
+            for start, end in zip(matrix.indptr[:-1], matrix.indptr[1:])]
+    raw_labels = [struct.pack("f", label) for label in labels]
+    assert utils.serialize_sparse_matrix(matrix.tocoo(), labels) == \
+        _reference_serialize(rows, raw_labels)
+
+
+def test_empty_rows():
+    """Test that rows without any values are preserved.
+    """
+    data = [[(3, 1.0)], [], [(5, 2.0), (7, 3.0)], []]
+    serialized = utils.serialize_data(data)
+    assert serialized == _reference_serialize(data)
+    indptr = utils.deserialize_data(serialized)[0]
+    assert indptr.tolist() == [0, 1, 1, 3, 3]
+
+
+def test_sparse_chunk_views():
+    """Test that a memory-mapped SparseChunk exposes rows, labels and slices.
+    """
+    data, labels = _random_rows(100)
+    serialized = utils.serialize_data(data, labels)
+    indptr, indices, values, decoded_labels = utils.deserialize_data(
+        serialized)
+    with tempfile.NamedTemporaryFile() as chunk_file:
+        chunk_file.write(serialized)
+        chunk_file.flush()
+        chunk = utils.SparseChunk.from_file(chunk_file.name)
+        assert chunk.validate()
+        assert len(chunk) == 100
+        assert chunk.nnz == len(indices)
+        assert chunk.labels.tolist() == decoded_labels.tolist()
+        for row, (row_indices, row_values) in enumerate(chunk):
+            assert row_indices.tolist() == \
+                indices[indptr[row]:indptr[row + 1]].tolist()
+            assert row_values.tolist() == \
+                values[indptr[row]:indptr[row + 1]].tolist()
+
+        sliced = chunk.row_slice(10, 20)
+        assert sliced[0].tolist() == (indptr[10:21] - indptr[10]).tolist()
+        assert sliced[1].tolist() == \
+            indices[indptr[10]:indptr[20]].tolist()
+
+        col_indptr, col_indices, _ = chunk.column_slice(0, 2**18)
+        assert len(col_indices) == (indices < 2**18).sum()
+        assert (col_indices < 2**18).all()
+        assert col_indptr[-1] == len(col_indices)
+
+        sample = chunk.sample(5, seed=0)
+        assert len(sample[0]) == 6
+        assert sample[0][-1] == len(sample[1])
+        chunk.close()
+
+
+def test_close_keeps_views():
+    """Test that closing a memory-mapped chunk leaves its views valid.
+    """
+    data, labels = _random_rows(10)
+    serialized = utils.serialize_data(data, labels)
+    with tempfile.NamedTemporaryFile() as chunk_file:
+        chunk_file.write(serialized)
+        chunk_file.flush()
+        with utils.SparseChunk.from_file(chunk_file.name) as chunk:
+            row_indices, row_values = chunk.row(3)
+            chunk_labels = chunk.labels
+    assert row_indices.tolist() == [idx for idx, _ in data[3]]
+    assert row_values.tolist() == [_to_float32(val) for _, val in data[3]]
+    assert chunk_labels.tolist() == \
+        utils.deserialize_data(serialized)[3].tolist()
+
+
+def test_column_slice_is_lazy(monkeypatch):
+    """Test that a column slice of a memory-mapped chunk gathers only the
+    values in the slice, without decoding the chunk.
+    """
+    rand = np.random.RandomState(0)
+    indptr = np.arange(0, 200001, 100)
+    indices = rand.randint(0, 2**20, indptr[-1])
+    values = rand.rand(indptr[-1])
+    serialized = utils.serialize_arrays(indptr, indices, values)
+
+    def no_decode(*args):
+        raise AssertionError("column_slice decoded the chunk")
+    monkeypatch.setattr(utils.SparseChunk, "_decode",
+                        staticmethod(no_decode))
+    with tempfile.NamedTemporaryFile() as chunk_file:
+        chunk_file.write(serialized)
+        chunk_file.flush()
+        chunk = utils.SparseChunk.from_file(chunk_file.name)
+        # Find the row headers before measuring
+        assert chunk.nnz == len(indices)
+        if tracemalloc is not None:
+            tracemalloc.start()
+        col_indptr, col_indices, col_values = chunk.column_slice(0, 2**10)
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            # Much less than the decoded indices and values
+            assert peak < len(serialized) // 3
+        chunk.close()
+
+    keep = indices < 2**10
+    assert col_indices.tolist() == indices[keep].tolist()
+    assert col_values.tolist() == values[keep].astype(np.float32).tolist()
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    assert col_indptr.tolist() == np.r_[0, np.cumsum(np.bincount(
+        rows[keep], minlength=len(indptr) - 1))].tolist()
+
+
+def test_sparse_chunk_validate():
+    """Test that truncated chunks are rejected.
+    """
+    serialized = utils.serialize_data(_random_rows(10)[0])
+    with pytest.raises(ValueError):
+        utils.SparseChunk(serialized[:-8]).validate()
+
+
+@pytest.mark.parametrize("codec", utils.available_codecs())
+def test_compressed_round_trip(codec):
+    """Test that compressed chunks decode to the same arrays as plain ones,
+    whether or not the indices of each row are sorted.
+    """
+    data, labels = _random_rows(200)
+    data += [[], [(0, 1.0)], []]
+    labels += [utils.DEFAULT_LABEL] * 3
+    for rows in (data, [sorted(row) for row in data]):
+        plain = utils.serialize_data(rows, labels)
+        compressed = utils.serialize_data(rows, labels, compression=codec)
+        assert utils.is_compressed(compressed)
+        assert not utils.is_compressed(plain)
+        assert len(compressed) < len(plain)
+        assert utils.chunk_counts(compressed) == utils.chunk_counts(plain)
+        for expected, decoded in zip(utils.deserialize_data(plain),
+                                     utils.deserialize_data(compressed)):
+            assert expected.tolist() == decoded.tolist()
+        assert utils.SparseChunk(compressed).row(5)[0].tolist() == \
+            [idx for idx, _ in rows[5]]
+
+
+def test_unknown_compression():
+    """Test that unknown codecs are rejected.
+    """
+    with pytest.raises(ValueError):
+        utils.serialize_data(_random_rows(10)[0], compression="rar")
+
+
+def test_columnar_round_trip():
+    """Test that columnar chunks decode to views of the same arrays as
+    chunks in the row format.
+    """
+    data, labels = _random_rows(200)
+    data += [[], [(0, 1.0)], []]
+    labels += [utils.DEFAULT_LABEL] * 3
+    plain = utils.serialize_data(data, labels)
+    columnar = utils.serialize_data(data, labels, columnar=True)
+    assert utils.is_columnar(columnar)
+    assert not utils.is_columnar(plain)
+    assert utils.chunk_counts(columnar) == utils.chunk_counts(plain)
+    decoded = utils.deserialize_data(columnar)
+    for expected, array in zip(utils.deserialize_data(plain), decoded):
+        assert expected.tolist() == array.tolist()
+        assert array.base is not None
+    assert utils.SparseChunk(columnar).row(5)[0].tolist() == \
+        [idx for idx, _ in data[5]]
+    with pytest.raises(ValueError):
+        utils.deserialize_data(columnar[:-4])
+    with pytest.raises(ValueError):
+        utils.serialize_data(data, columnar=True, compression="zlib")
+
+
+def _random_rows(n_rows, seed=0):
+    rand = random.Random(seed)
+    data = []
+    labels = []
+    for _ in range(n_rows):
+        data.append([(rand.randint(0, 2**19), rand.uniform(-100, 100))
+                     for _ in range(rand.randint(1, 40))])
+        labels.append(struct.pack("f", rand.randint(0, 1)))
+    return data, labels
+
+
+def _reference_serialize(data, labels=None):
+    """The per-element encoder that serialize_data replaced."""
+    lines = []
+    num_bytes = 0
+    for idx, row in enumerate(data):
+        current_line = []
+        label = utils.DEFAULT_LABEL
+        if labels is not None:
+            label = labels[idx]
+        current_line.append(label)
+        current_line.append(struct.pack("i", len(row)))
+        for idx2, val in row:
+            current_line.append(struct.pack("i", int(idx2)))
+            current_line.append(struct.pack("f", float(val)))
+        lines.append(b"".join(current_line))
+        num_bytes += len(lines[-1])
+    return struct.pack("i", num_bytes + 8) + \
+        struct.pack("i", len(lines)) + b"".join(lines)
+
+
+def _to_float32(val):
+    return struct.unpack("f", struct.pack("f", val))[0]
@@ -0,0 +1,188 @@
+"""Tests of the threading, listing and manifest helpers in cirrus.utils.
+"""
+import pytest
+
+from cirrus import feature_hashing, utils
+
+INPUT_BUCKET = "input"
+OUTPUT_BUCKET = "output"
+OBJECTS = ["1", "2", "3"]
+
+
+def test_map_in_threads():
+    """Test that results and exceptions are returned per item, in order.
+    """
+    def invert(item):
+        return 1.0 / item
+
+    results = utils.map_in_threads(invert, [1, 2, 0, 4], 2)
+    assert [res.key for res in results] == [1, 2, 0, 4]
+    assert [res.result for res in results] == [1.0, 0.5, None, 0.25]
+    assert isinstance(results[2].exception, ZeroDivisionError)
+
+
+def test_nested_map_in_threads(monkeypatch):
+    """Test that calls made from the shared pool finish when every thread
+    of the pool is busy.
+    """
+    monkeypatch.setattr(utils, "THREAD_POOL",
+                        utils.ThreadPoolExecutor(2))
+
+    def total(item):
+        return sum(res.result for res in
+                   utils.map_in_threads(abs, range(item), 4))
+
+    results = utils.map_in_threads(total, [3, 4, 5, 6], 4)
+    assert [res.result for res in results] == [3, 6, 10, 15]
+    utils.THREAD_POOL.shutdown()
+
+
+def test_delete_keys(local_backend):
+    """Test that keys are deleted in batches from several threads.
+    """
+    keys = ["{0}_stats".format(i) for i in range(7)]
+    for key in keys:
+        local_backend.put_object(Bucket=INPUT_BUCKET, Key=key, Body=b"")
+    assert utils.delete_keys(INPUT_BUCKET, keys[:6], num_threads=2,
+                             batch_size=4) == 6
+    assert [obj["Key"] for obj in utils.list_objects(INPUT_BUCKET)] == \
+        keys[6:]
+
+
+def test_list_objects_in_ranges(local_backend):
+    """Test that listing split key ranges in parallel finds every key once.
+    """
+    keys = ["1", "10", "20", "25", "5", "9", "a_stats", "manifest"]
+    for key in keys:
+        local_backend.put_object(Bucket=INPUT_BUCKET, Key=key, Body=b"")
+    listed = [obj["Key"] for obj in utils.list_objects(
+        INPUT_BUCKET, split_keys=("2", "1", "5", "50"), num_threads=3)]
+    assert listed == keys
+
+
+def test_get_all_keys_from_manifest(local_backend, monkeypatch):
+    """Test that chunk keys are read from the manifest without listing the
+    bucket, and listed and pruned without one.
+    """
+    for key in OBJECTS + ["1_stats"]:
+        local_backend.put_object(Bucket=INPUT_BUCKET, Key=key, Body=b"")
+    utils.write_manifest(INPUT_BUCKET, [
+        {"Key": key, "Size": 0, "ETag": None} for key in OBJECTS[:2]])
+    with monkeypatch.context() as patch:
+        patch.setattr(utils, "list_objects", None)
+        assert utils.get_all_keys(INPUT_BUCKET) == OBJECTS[:2]
+    assert utils.get_all_keys(INPUT_BUCKET, use_manifest=False) == OBJECTS
+    assert sorted(obj["Key"] for obj in utils.list_objects(INPUT_BUCKET)) \
+        == OBJECTS + [utils.MANIFEST_KEY]
+    utils.invalidate_manifest(INPUT_BUCKET)
+    assert utils.get_all_chunks(INPUT_BUCKET) == \
+        [{"Key": key, "Size": 0} for key in OBJECTS]
+
+
+def test_drivers_list_once(put_chunks, monkeypatch):
+    """Test that a driver lists a bucket without a manifest once, and
+    batches its chunks from that listing.
+    """
+    put_chunks(INPUT_BUCKET, OBJECTS, n_rows=5)
+    listings = []
+    list_objects = utils.list_objects
+
+    def counted(bucket, *args, **kwargs):
+        listings.append(bucket)
+        return list_objects(bucket, *args, **kwargs)
+
+    monkeypatch.setattr(utils, "list_objects", counted)
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [], 100)
+    assert listings == [INPUT_BUCKET]
+    assert [entry["Key"] for entry in utils.read_manifest(OUTPUT_BUCKET)] \
+        == OBJECTS
+
+
+def test_batch_keys(put_chunks):
+    """Test that chunks are batched by count, and by size without a
+    manifest.
+    """
+    put_chunks(INPUT_BUCKET, OBJECTS, n_rows=5)
+    assert utils.batch_keys(INPUT_BUCKET, OBJECTS, 1) == [tuple(OBJECTS)]
+    assert utils.batch_keys(INPUT_BUCKET, OBJECTS, 2) == \
+        [tuple(OBJECTS[:2]), tuple(OBJECTS[2:])]
+    assert utils.batch_keys(INPUT_BUCKET, OBJECTS, 1, target_bytes=1) == \
+        [(key,) for key in OBJECTS]
+
+
+def test_batches_balance_work(local_backend):
+    """Test that batches hold about the same work, from the manifest.
+    """
+    utils.write_manifest(INPUT_BUCKET, [
+        {"Key": key, "Size": 1, "Rows": rows, "Nnz": 0}
+        for key, rows in zip(OBJECTS, [150, 50, 50])])
+    assert utils.batch_keys(INPUT_BUCKET, OBJECTS, 2) == \
+        [tuple(OBJECTS[:1]), tuple(OBJECTS[1:])]
+
+
+def test_transforms_write_manifest(local_backend, put_chunks):
+    """Test that a transform of every chunk writes the manifest of its
+    output, with the rows, nonzero values and checksum of each chunk.
+    """
+    data = put_chunks(INPUT_BUCKET, OBJECTS, n_rows=5)
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [0], 100)
+    manifest = utils.read_manifest(OUTPUT_BUCKET)
+    assert [entry["Key"] for entry in manifest] == OBJECTS
+    for entry in manifest:
+        body = local_backend.get_object(Bucket=OUTPUT_BUCKET,
+                                        Key=entry["Key"])["Body"].read()
+        assert entry == utils.chunk_entry(entry["Key"], body, entry["ETag"])
+        assert entry["Rows"] == len(data[entry["Key"]])
+        assert entry["Nnz"] == sum(len(row) for row in data[entry["Key"]])
+
+    # Transforming some of the chunks leaves no manifest
+    feature_hashing.feature_hashing(INPUT_BUCKET, OUTPUT_BUCKET, [0], 100,
+                                    OBJECTS[:1])
+    assert utils.read_manifest(OUTPUT_BUCKET) is None
+
+
+def test_chunk_entry_stats():
+    """Test that chunk entries hold the bounds of each column.
+    """
+    rows = [[(0, 2.0), (3, -1.0)], [(3, 4.0)], [(0, 1.0), (7, 0.5)]]
+    entry = utils.chunk_entry("1", utils.serialize_data(rows),
+                              column_stats=True)
+    assert entry["Columns"] == [[0, 1.0, 2.0], [3, -1.0, 4.0],
+                                [7, 0.5, 0.5]]
+
+
+def test_chunks_for_rows(local_backend):
+    """Test that row ranges map to the chunks holding them.
+    """
+    with pytest.raises(ValueError):
+        utils.chunks_for_rows(INPUT_BUCKET, 0, 10)
+    utils.write_manifest(INPUT_BUCKET, [
+        {"Key": key, "Size": 1, "Rows": 50} for key in OBJECTS])
+    assert utils.chunks_for_rows(INPUT_BUCKET, 0, 50) == (1, 2)
+    assert utils.chunks_for_rows(INPUT_BUCKET, 49, 51) == (1, 3)
+    assert utils.chunks_for_rows(INPUT_BUCKET, 100, 150) == (3, 4)
+    with pytest.raises(ValueError):
+        utils.chunks_for_rows(INPUT_BUCKET, 100, 151)
+
+
+def test_convert_chunks(local_backend, put_chunks):
+    """Test that converted chunks hold the same rows, and that the handler
+    reads them.
+    """
+    data = put_chunks(INPUT_BUCKET, OBJECTS, n_rows=5)
+    entries = utils.convert_chunks(INPUT_BUCKET, OUTPUT_BUCKET)
+    assert [entry["Key"] for entry in utils.read_manifest(OUTPUT_BUCKET)] \
+        == [entry["Key"] for entry in entries] == OBJECTS
+    for key in OBJECTS:
+        body = local_backend.get_object(Bucket=OUTPUT_BUCKET,
+                                        Key=key)["Body"].read()
+        assert utils.is_columnar(body)
+        assert [dict(row) for row in
+                utils.get_data_from_s3(local_backend, OUTPUT_BUCKET, key)] \
+            == [dict(row) for row in data[key]]
+
+    feature_hashing.feature_hashing(OUTPUT_BUCKET, INPUT_BUCKET, [], 100)
+    for key in OBJECTS:
+        assert [dict(row) for row in
+                utils.get_data_from_s3(local_backend, INPUT_BUCKET, key)] == \
+            [dict((100 + col, val) for col, val in row) for row in data[key]]